@@ -19,6 +19,7 @@ import os
 import sys
 import csv
 import logging
+from collections import OrderedDict
 
 import biolib.seq_io as seq_io
 from biolib.taxonomy import Taxonomy
@@ -56,47 +57,84 @@ class Arb(object):
         fout.write("aligned_seq=%s\n" % (aligned_seq))
         fout.write("END\n\n")
 
+    def _read_metadata(self, metadata_file, taxonomy, genomes_to_keep):
+        """Index metadata of genomes to write by genome ID.
+
+        Parameters
+        ----------
+        metadata_file : str
+            GTDB metadata file (CSV or TSV).
+        taxonomy : d[genome_id] -> [d__, p__, ..., s__]
+            Optional GTDB taxonomy to append to each record.
+        genomes_to_keep : set
+            Genomes to retain, or empty set to retain all genomes.
+
+        Returns
+        -------
+        list
+            Names of metadata fields.
+        collections.OrderedDict : d[genome_id] -> [field values]
+            Metadata values in the order given in the metadata file.
+        """
+
+        delimiter = ','
+        if metadata_file.endswith('.tsv'):
+            delimiter = '\t'
+
+        metadata = OrderedDict()
+        with open(metadata_file, 'rb') as f_in:
+            reader = csv.reader(f_in, delimiter=delimiter)
+
+            header = next(reader)
+            fields = [f.lower().replace(' ', '_').replace('-', '_') for f in header[1:]]
+            if taxonomy:
+                fields.append('gtdb_taxonomy')
+
+            for row in reader:
+                genome_id = row[0]
+                if genomes_to_keep and genome_id not in genomes_to_keep:
+                    continue
+
+                values = row[1:]
+                if taxonomy:
+                    values.append('; '.join(taxonomy[genome_id]))
+                metadata[genome_id] = values
+
+        return fields, metadata
+
     def create_records(self, metadata_file, msa_file, taxonomy_file, genome_list, output_file):
-        """Create ARB records from GTDB metadata."""
-        
-        seqs = {}
-        if msa_file:
-            seqs = seq_io.read(msa_file)
-        
+        """Create ARB records from GTDB metadata.
+
+        Metadata is indexed by genome ID before the MSA is streamed
+        one sequence at a time, with the record of each genome written
+        as soon as its aligned sequence is read. Genomes without an
+        aligned sequence are written once the MSA has been exhausted.
+        """
+
         taxonomy = {}
         if taxonomy_file:
             taxonomy = Taxonomy().read(taxonomy_file)
-            
+
         genomes_to_keep = set()
         if genome_list:
             for line in open(genome_list):
                 genomes_to_keep.add(line.strip())
-                
+
+        fields, metadata = self._read_metadata(metadata_file, taxonomy, genomes_to_keep)
+
         fout = open(output_file, 'w')
-        
-        delimiter = ','
-        if metadata_file.endswith('.tsv'):
-            delimiter = '\t'
-        
-        header = True
-        for row in csv.reader(open(metadata_file, 'rb'), delimiter=delimiter):
-            if header:
-                fields = [f.lower().replace(' ', '_').replace('-', '_') for f in row[1:]]
-                if taxonomy:
-                    fields.append('gtdb_taxonomy')
-                header = False
-            else:
-                genome_id = row[0]
-                values = row[1:]
-                if taxonomy:
-                    values.append('; '.join(taxonomy[genome_id]))
-                aligned_seq = seqs.get(genome_id, '')
-                
-                if not genomes_to_keep or genome_id in genomes_to_keep:
+
+        if msa_file:
+            for genome_id, aligned_seq in seq_io.read_seq(msa_file):
+                values = metadata.pop(genome_id, None)
+                if values is not None:
                     self._record(fout, genome_id, fields, values, aligned_seq)
 
+        for genome_id, values in metadata.iteritems():
+            self._record(fout, genome_id, fields, values, '')
+
         fout.close()
-        
+
     def write(self, hashes, io):
         """Write data to a GreenGenes formatted files.
 
@@ -31,6 +31,8 @@ from collections import defaultdict
 from biolib.taxonomy import Taxonomy
 from biolib.external.execute import check_dependencies
 
+from genometreetk.common import TaxonomyTable
+
 csv.field_size_limit(sys.maxsize)
 
 
@@ -331,19 +333,14 @@ class AssignGenomes(object):
     def _genome_genus_clusters(self, genomes_to_process, full_gtdb_taxonomy):
         """Create clusters of genomes in the same genus."""
         
-        genus_clusters = defaultdict(set)
-        for gid in genomes_to_process:
-            taxa = full_gtdb_taxonomy[gid]
-            
-            # *** [DEBUG] Useful case for debugging.
-            #if taxa[5] != 'g__Pyrobaculum': #'g__Lactobacillus':
-            #    continue
+        genus_clusters = full_gtdb_taxonomy.genomes_by_rank(5, genomes_to_process, skip_empty=False)
+        
+        # *** [DEBUG] Useful case for debugging.
+        #genus_clusters = {'g__Pyrobaculum': genus_clusters['g__Pyrobaculum']}
 
-            if taxa[5] == 'g__':
-                self.logger.error('Genome does not have a defined genus: %s' % gid)
-                sys.exit(-1)
-            else:
-                genus_clusters[taxa[5]].add(gid)
+        if 'g__' in genus_clusters:
+            self.logger.error('Genome does not have a defined genus: %s' % next(iter(genus_clusters['g__'])))
+            sys.exit(-1)
 
         return genus_clusters
         
@@ -355,12 +352,10 @@ class AssignGenomes(object):
         mash_genus_clusters = {}
         mash_genus_reps = {}
         mash_rep_assignments = {}
+        canonical_genus_reps = canonical_gtdb_taxonomy.genomes_by_rank(5)
         for i, genus in enumerate(genus_clusters):
             # get representatives for this genus
-            genus_rep_ids = set()
-            for gid, taxa in canonical_gtdb_taxonomy.items():
-                if taxa[5] == genus:
-                    genus_rep_ids.add(gid)
+            genus_rep_ids = canonical_genus_reps.get(genus, set())
             
             rep_assignments = self._mash_assignments(genus_clusters[genus] - genus_rep_ids, 
                                                             genus_rep_ids, 
@@ -438,7 +433,7 @@ class AssignGenomes(object):
 
         # read taxonomy of all genomes
         self.logger.info('Reading taxonomy of all genomes.')
-        full_gtdb_taxonomy = Taxonomy().read(full_taxonomy_file)
+        full_gtdb_taxonomy = TaxonomyTable.from_dict(Taxonomy().read(full_taxonomy_file))
         self.logger.info('Identified taxonomy for %d genomes.' % len(full_gtdb_taxonomy))
 
         # determining genomes to process
@@ -465,7 +460,7 @@ class AssignGenomes(object):
 
         # read taxonomy of canonical genomes
         self.logger.info('Reading taxonomy of canonical genomes.')
-        canonical_gtdb_taxonomy = Taxonomy().read(canonical_taxonomy_file)
+        canonical_gtdb_taxonomy = TaxonomyTable.from_dict(Taxonomy().read(canonical_taxonomy_file))
         for gid in canonical_gtdb_taxonomy:
             if gid not in genomic_files or gid not in genomes_to_process:
                 self.logger.error('Canonical genome is not in genome path file or list of genomes to process: %s' % gid)
@@ -513,7 +508,7 @@ class AssignGenomes(object):
                 fout.write('%s\t%s\t%s\t%s\n' % (gid, '; '.join(canonical_gtdb_taxonomy[rep_id]), rep_id, ani_str))
                 num_assigned += 1
             else:
-                taxa = full_gtdb_taxonomy[gid][0:6] + ['s__']
+                taxa = full_gtdb_taxonomy[gid][0:6] + ('s__',)
                 fout.write('%s\t%s\t%s\n' % (gid, '; '.join(taxa), 'unassigned'))
                 num_unassigned += 1
         fout.close()
@@ -0,0 +1,310 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import re
+import random
+from collections import namedtuple
+
+import dendropy
+
+from biolib.newick import parse_label, create_label
+
+from genometreetk.exceptions import GenomeTreeTkError
+
+
+# clades of a parsed tree in postorder, with the parent of each clade
+# (-1 for the root) and the clade of each taxon given as indices
+NewickTree = namedtuple('NewickTree', 'clades labels parents taxa leaves taxa_hash')
+
+
+class BipartitionHasher(object):
+    """Hash bipartitions of trees spanning a fixed set of taxa.
+
+    Each taxon is assigned a random 64-bit value and a clade is
+    hashed as the XOR of the values of its taxa. The hash of a
+    clade is therefore obtained in constant time from the hashes
+    of its children, and the hash of the complement of a clade is
+    its hash XORed with the hash of all taxa. Bipartitions are keyed
+    by the smaller hash of their two sides so a bipartition has the
+    same key regardless of how a tree is rooted. The chance of two
+    distinct bipartitions sharing a key is negligible.
+    """
+
+    newick_token = re.compile(r"\[[^\]]*\]|'(?:[^']|'')*'|[(),:;]|[^(),:;\[\]'\s]+")
+
+    def __init__(self, taxa, seed=0):
+        """Initialization.
+
+        Parameters
+        ----------
+        taxa : iterable
+            Labels of taxa spanned by trees.
+        seed : int
+            Seed for assigning hash values to taxa.
+        """
+
+        rng = random.Random(seed)
+
+        self.taxon_hash = {}
+        self.all_taxa = 0
+        for taxon in taxa:
+            h = rng.getrandbits(64)
+            self.taxon_hash[taxon] = h
+            self.all_taxa ^= h
+
+    def key(self, clade_hash, taxa_hash=None):
+        """Get key of bipartition separating clade from all other taxa.
+
+        Parameters
+        ----------
+        clade_hash : int
+            Hash of clade.
+        taxa_hash : int
+            Hash of taxa spanned by tree, if not all taxa.
+        """
+
+        if taxa_hash is None:
+            taxa_hash = self.all_taxa
+
+        return min(clade_hash, clade_hash ^ taxa_hash)
+
+    def tree_clades(self, tree):
+        """Get hash of clade below each node of a tree.
+
+        Parameters
+        ----------
+        tree : dendropy.Tree
+            Tree spanning taxa of hasher.
+
+        Returns
+        -------
+        d[node] -> hash
+            Hash of clade below each node.
+        """
+
+        clade_hash = {}
+        for node in tree.postorder_node_iter():
+            if node.is_leaf():
+                clade_hash[node] = self.taxon_hash[node.taxon.label]
+            else:
+                h = 0
+                for child in node.child_node_iter():
+                    h ^= clade_hash[child]
+                clade_hash[node] = h
+
+        return clade_hash
+
+    def parse_newick(self, newick_file):
+        """Tokenize trees in a Newick file.
+
+        Trees are tokenized directly rather than being converted
+        into tree objects. Clades are listed in postorder, so the
+        root of a tree is its last clade.
+
+        Parameters
+        ----------
+        newick_file : str
+            File containing one or more trees in Newick format.
+
+        Yields
+        ------
+        NewickTree
+            Clades of tree along with their hash, label and parent.
+        """
+
+        with open(newick_file) as f:
+            newick = f.read()
+
+        clades = []
+        labels = []
+        parents = []
+        taxa = []
+        leaves = []
+        stack = [0]
+        children = [[]]
+        expect_leaf = True
+        in_branch_length = False
+        for token in self.newick_token.finditer(newick):
+            token = token.group()
+            c = token[0]
+            if c == '[':
+                continue
+
+            if in_branch_length:
+                in_branch_length = False
+                if c not in '(),:;':
+                    continue
+
+            if c == "'":
+                token = token[1:-1].replace("''", "'")
+
+            if c == '(':
+                stack.append(0)
+                children.append([])
+                expect_leaf = True
+            elif c == ',':
+                expect_leaf = True
+            elif c == ')':
+                h = stack.pop()
+                clade_index = len(clades)
+                for child in children.pop():
+                    parents[child] = clade_index
+                children[-1].append(clade_index)
+                clades.append(h)
+                labels.append(None)
+                parents.append(-1)
+                stack[-1] ^= h
+                expect_leaf = False
+            elif c == ':':
+                in_branch_length = True
+            elif c == ';':
+                yield NewickTree(clades, labels, parents, taxa, leaves, stack[0])
+
+                clades = []
+                labels = []
+                parents = []
+                taxa = []
+                leaves = []
+                stack = [0]
+                children = [[]]
+                expect_leaf = True
+            elif expect_leaf:
+                h = self.taxon_hash.get(token, None)
+                if h is None:
+                    raise GenomeTreeTkError('Unexpected taxon %s in %s.' % (token, newick_file))
+
+                children[-1].append(len(clades))
+                leaves.append(len(clades))
+                taxa.append(token)
+                clades.append(h)
+                labels.append(None)
+                parents.append(-1)
+                stack[-1] ^= h
+                expect_leaf = False
+            else:
+                labels[-1] = token
+
+    def check_taxa(self, newick_file, taxa, taxa_hash):
+        """Check that tree spans all taxa."""
+
+        if taxa_hash != self.all_taxa or len(taxa) != len(self.taxon_hash):
+            raise GenomeTreeTkError('Tree in %s does not span the expected taxa.' % newick_file)
+
+    def newick_bipartitions(self, newick_file, subset=False):
+        """Get bipartitions of each tree in a Newick file.
+
+        Bipartitions with a single taxon on one side are included.
+
+        Parameters
+        ----------
+        newick_file : str
+            File containing one or more trees in Newick format.
+        subset : bool
+            Flag indicating trees may span a subset of all taxa.
+
+        Yields
+        ------
+        set
+            Keys of bipartitions within tree.
+        list
+            Labels of taxa within tree.
+        """
+
+        for tree in self.parse_newick(newick_file):
+            if not subset:
+                self.check_taxa(newick_file, tree.taxa, tree.taxa_hash)
+
+            yield set(min(h, h ^ tree.taxa_hash) for h in tree.clades), tree.taxa
+
+    def newick_labels(self, newick_file):
+        """Get labels of internal nodes of each tree in a Newick file.
+
+        Parameters
+        ----------
+        newick_file : str
+            File containing one or more trees in Newick format.
+
+        Yields
+        ------
+        d[bipartition] -> label
+            Label of each labelled internal node within tree.
+        """
+
+        for tree in self.parse_newick(newick_file):
+            self.check_taxa(newick_file, tree.taxa, tree.taxa_hash)
+
+            node_labels = {}
+            for h, label in zip(tree.clades, tree.labels):
+                if label is not None:
+                    node_labels[self.key(h)] = label
+
+            yield node_labels
+
+
+def bootstrap_support(input_tree, replicate_trees, output_tree):
+    """Calculate support for tree with replicates covering the same taxon set.
+
+    Replicate trees are read once and only bipartitions found
+    in the input tree are counted, so run time is close to linear
+    in the total size of the replicate trees.
+
+    Parameters
+    ----------
+    input_tree : str
+      Tree inferred from complete data.
+    replicate_trees : iterable
+      Files containing replicate trees.
+    output_tree: str
+      Name of output tree with support values.
+    """
+
+    tree = dendropy.Tree.get_from_path(input_tree,
+                                        schema='newick',
+                                        rooting='force-unrooted',
+                                        preserve_underscores=True)
+    tree.collapse_basal_bifurcation()
+
+    hasher = BipartitionHasher(leaf.taxon.label for leaf in tree.leaf_node_iter())
+    clade_hash = hasher.tree_clades(tree)
+
+    counts = {}
+    for node in tree.internal_nodes():
+        counts[hasher.key(clade_hash[node])] = 0
+
+    num_trees = 0
+    for rep_tree_file in replicate_trees:
+        for bipartitions, _taxa in hasher.newick_bipartitions(rep_tree_file):
+            num_trees += 1
+            for bipartition in bipartitions:
+                if bipartition in counts:
+                    counts[bipartition] += 1
+
+    if num_trees == 0:
+        raise GenomeTreeTkError('No replicate trees were provided.')
+
+    for node in tree.internal_nodes():
+        support = int(float(counts[hasher.key(clade_hash[node])]) / num_trees * 100)
+        if node.label:
+            _support, taxon, aux_info = parse_label(node.label)
+            node.label = create_label(support, taxon, aux_info)
+        else:
+            node.label = str(support)
+
+    tree.write_to_path(output_tree,
+                        schema='newick',
+                        suppress_rooting=True,
+                        unquoted_underscores=True)
@@ -18,12 +18,16 @@
 import os
 import logging
 
-import biolib.seq_io as seq_io
-from biolib.external.fasttree import FastTree
-from biolib.parallel import Parallel
-from biolib.bootstrap import bootstrap_alignment, bootstrap_support
+import numpy as np
+
 from biolib.common import remove_extension, make_sure_path_exists
 
+from genometreetk.common import read_alignment_matrix
+from genometreetk.bipartitions import bootstrap_support
+from genometreetk.transfer_support import TransferSupport
+from genometreetk.fasttree_scheduler import FastTreeScheduler
+from genometreetk.replicate_records import ReplicateRecords, run_signature
+
 
 class Bootstrap(object):
     """Assess robustness of genome tree by bootstrapping multiple sequence alignment."""
@@ -41,8 +45,27 @@ class Bootstrap(object):
 
         self.cpus = cpus
 
-    def _producer(self, replicated_num):
-        """Infer tree from bootstrapped multiple sequence alignment.
+        # number of sequences written to a replicate alignment at a time
+        self.rows_per_write = 1024
+
+    def _write_replicate(self, fout, cols):
+        """Write selected columns of alignment in FASTA format.
+
+        Parameters
+        ----------
+        fout : file
+          Output stream for replicate alignment.
+        cols : array
+          Columns of alignment in replicate.
+        """
+
+        for start in xrange(0, len(self.seq_ids), self.rows_per_write):
+            rows = self.msa[start:start + self.rows_per_write][:, cols]
+            fout.write(''.join(['>%s\n%s\n' % (seq_id, row.tostring())
+                                for seq_id, row in zip(self.seq_ids[start:start + self.rows_per_write], rows)]))
+
+    def _replicate_columns(self, replicated_num):
+        """Resample columns of alignment for replicate.
 
         Parameters
         ----------
@@ -50,20 +73,38 @@ class Bootstrap(object):
           Unique replicate number.
         """
 
-        output_msa = os.path.join(self.replicate_dir, 'bootstrap_msa.r_' + str(replicated_num) + '.fna')
-        bootstrap_alignment(self.msa, output_msa, frac=self.frac)
+        # resample columns with a generator specific to this replicate
+        # so replicates are reproducible regardless of scheduling
+        rng = np.random.RandomState([self.seed, replicated_num])
+        alignment_len = self.msa.shape[1]
+        return rng.randint(0, alignment_len, int(alignment_len * self.frac))
 
-        fast_tree = FastTree(multithreaded=False)
-        output_tree = os.path.join(self.replicate_dir, 'bootstrap_tree.r_' + str(replicated_num) + '.tree')
-        fast_tree_output = os.path.join(self.replicate_dir, 'bootstrap_fasttree.r_' + str(replicated_num) + '.out')
-        fast_tree.run(output_msa, self.base_type, self.model, output_tree, fast_tree_output)
+    def _job(self, replicated_num):
+        """Create job inferring tree from bootstrapped multiple sequence alignment.
+
+        Parameters
+        ----------
+        replicated_num : int
+          Unique replicate number.
 
-        return True
+        Returns
+        -------
+        FastTreeScheduler.Job
+          Job for inferring replicate tree.
+        """
 
-    def _progress(self, processed_items, total_items):
-        """Report progress of replicates."""
+        output_msa = None
+        if self.keep_msa:
+            output_msa = os.path.join(self.replicate_dir, 'bootstrap_msa.r_' + str(replicated_num) + '.fna')
 
-        return '    Processed %d of %d replicates.' % (processed_items, total_items)
+        output_tree = os.path.join(self.replicate_dir, 'bootstrap_tree.r_' + str(replicated_num) + '.tree')
+        fast_tree_output = os.path.join(self.replicate_dir, 'bootstrap_fasttree.r_' + str(replicated_num) + '.out')
+        return FastTreeScheduler.Job(cost=1,
+                                        msa_file=output_msa,
+                                        output_tree=output_tree + '.tmp',
+                                        output_tree_log=fast_tree_output,
+                                        write_msa=lambda fout: self._write_replicate(fout, self._replicate_columns(replicated_num)),
+                                        done=lambda: self.replicates.complete(replicated_num, self.seed, output_tree + '.tmp', output_tree))
 
     def run(self, 
                 input_tree, 
@@ -73,9 +114,16 @@ class Bootstrap(object):
                 base_type, 
                 frac,
                 boot_dir,
-                output_dir):
+                output_dir,
+                seed=None,
+                keep_msa=False,
+                support_only=False,
+                tbe=False):
         """Bootstrap multiple sequence alignment.
 
+        Completed replicates are recorded in the output directory and
+        are not inferred again when a run is restarted with the same seed.
+
         Parameters
         ----------
         input_tree : str
@@ -92,6 +140,15 @@ class Bootstrap(object):
           Fraction of alignment to subsample.
         output_dir : str
           Directory for bootstrap trees.
+        seed : int
+          Seed for generating replicates, or None to continue with the seed of
+          completed replicates or select a seed at random.
+        keep_msa : bool
+          Flag indicating if alignment of each replicate should be written to disk.
+        support_only : bool
+          Flag indicating support should be calculated from completed replicates only.
+        tbe : bool
+          Flag indicating transfer bootstrap expectation (TBE) support should also be calculated.
         """
 
         assert(model in ['wag', 'lg', 'jtt'])
@@ -100,22 +157,39 @@ class Bootstrap(object):
         self.model = model
         self.base_type = base_type
         self.frac = frac
+        self.keep_msa = keep_msa
 
         rep_tree_files = []
         if not boot_dir:
             self.replicate_dir = os.path.join(output_dir, 'replicates')
             make_sure_path_exists(self.replicate_dir)
 
-            # read full multiple sequence alignment
-            self.msa = seq_io.read(msa_file)
+            signature = run_signature((model, base_type, frac), (msa_file,))
+            self.replicates = ReplicateRecords(self.replicate_dir, 'bootstrap', signature)
+            self.seed = self.replicates.seed(seed)
+            completed = self.replicates.completed(self.seed)
+            remaining = [rep_index for rep_index in xrange(num_replicates) if rep_index not in completed]
+            self.logger.info('Generating replicates with seed %d.' % self.seed)
+            if completed:
+                self.logger.info('Found %d completed replicates.' % (num_replicates - len(remaining)))
+
+            if remaining and not support_only:
+                # read full multiple sequence alignment
+                self.seq_ids, self.msa = read_alignment_matrix(msa_file)
 
-            # calculate replicates
-            self.logger.info('Calculating bootstrap replicates:')
-            parallel = Parallel(self.cpus)
-            parallel.run(self._producer, None, xrange(num_replicates), self._progress)
+                # calculate replicates, sharing cpus among concurrent replicates
+                self.logger.info('Calculating bootstrap replicates:')
+                scheduler = FastTreeScheduler(self.cpus)
+                scheduler.run([self._job(rep_index) for rep_index in remaining], self.base_type, self.model)
 
-            for rep_index in xrange(num_replicates):
-                rep_tree_files.append(os.path.join(self.replicate_dir, 'bootstrap_tree.r_' + str(rep_index) + '.tree'))
+                completed = self.replicates.completed(self.seed)
+
+            for rep_index in sorted(completed):
+                if rep_index < num_replicates:
+                    rep_tree_files.append(completed[rep_index])
+
+            if len(rep_tree_files) < num_replicates:
+                self.logger.warning('Only %d of %d replicates are complete.' % (len(rep_tree_files), num_replicates))
         else:
             for f in os.listdir(boot_dir):
                 if f.endswith('.tree') or f.endswith('.tre'):
@@ -127,4 +201,11 @@ class Bootstrap(object):
         output_tree = os.path.join(output_dir, remove_extension(input_tree) + '.bootstrap.tree')
         bootstrap_support(input_tree, rep_tree_files, output_tree)
 
+        if tbe:
+            self.logger.info('Calculating transfer bootstrap expectation (TBE) support values.')
+            tbe_output_tree = os.path.join(output_dir, remove_extension(input_tree) + '.tbe.tree')
+            transfer_support = TransferSupport(self.cpus)
+            transfer_support.run(input_tree, rep_tree_files, tbe_output_tree)
+            self.logger.info('TBE tree written to: %s' % tbe_output_tree)
+
         return output_tree
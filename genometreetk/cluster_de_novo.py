@@ -336,7 +336,7 @@ class ClusterDeNovo(object):
             clustered_gids = [c.gid for c in clusters[rid]]
             
             # get most common GTDB species name 
-            gtdb_sp = [gtdb_taxonomy[gid][6] for gid in clustered_gids] + [gtdb_taxonomy[rid][6]]
+            gtdb_sp = [gtdb_taxonomy.species(gid) for gid in clustered_gids] + [gtdb_taxonomy.species(rid)]
             gtdb_counter = Counter(gtdb_sp)
             gtdb_common_count = 0
             gtdb_common_sp = None
@@ -355,8 +355,9 @@ class ClusterDeNovo(object):
             else:
                 # derive species name from genus, if possible, and accession number
                 taxon = '{manual_curation}'
-                if gtdb_taxonomy[rid][5] != 'g__':
-                    taxon = gtdb_taxonomy[rid][5][3:]
+                genus = gtdb_taxonomy.genus(rid)
+                if genus != 'g__':
+                    taxon = genus[3:]
                 
                 acc = rid
                 if rid.startswith('U_'):
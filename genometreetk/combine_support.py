@@ -19,6 +19,11 @@ import logging
 
 import dendropy
 
+from biolib.newick import parse_label
+
+from genometreetk.bipartitions import BipartitionHasher
+from genometreetk.exceptions import GenomeTreeTkError
+
 
 class CombineSupport(object):
     """Combine all support values into a single tree."""
@@ -28,27 +33,52 @@ class CombineSupport(object):
         
         self.logger = logging.getLogger()
 
-    def _collect_support_values(self, tree):
-        """Get support value for each node in preorder traversal.
+    def _collect_support_values(self, hasher, newick_file):
+        """Get support value for each bipartition in tree.
 
         Parameters
         ----------
-        tree : dendropy.Tree
-          Tree to obtain support values from.
+        hasher : BipartitionHasher
+          Hasher for taxa within tree.
+        newick_file : str
+          File with tree to obtain support values from.
+
+        Returns
+        -------
+        d[bipartition] -> support
+          Support value of each internal node.
+
+        Raises
+        ------
+        GenomeTreeTkError
+          If the file contains no tree or a node label has no support value.
         """
 
-        preorder_support = []
-        for node in tree.preorder_node_iter():
-            if node.is_internal():
-                preorder_support.append(node.label)
+        for node_labels in hasher.newick_labels(newick_file):
+            support = {}
+            for bipartition, label in node_labels.iteritems():
+                support[bipartition] = self._support_value(label, newick_file)
+
+            return support
+
+        raise GenomeTreeTkError('No tree found in %s.' % newick_file)
+
+    def _support_value(self, label, newick_file):
+        """Get support value from node label."""
+
+        support = parse_label(label)[0]
+        if support is None:
+            raise GenomeTreeTkError('Node label %s in %s does not contain a support value.' % (label, newick_file))
 
-        return preorder_support
+        return support
 
     def run(self, support_type, bootstrap_tree, jk_marker_tree, jk_taxa_tree, output_tree):
         """Create new tree indicating combined support values.
 
         Tree can either be decorated with the average support value
         or the minimum support value as determine by support_type.
+        Support values are matched by bipartition so trees may be
+        rooted or ordered differently, but must have the same topology.
 
         Parameters
         ----------
@@ -66,24 +96,28 @@ class CombineSupport(object):
 
         assert(support_type in ['average', 'minimum'])
 
-        tree = dendropy.Tree.get_from_path(bootstrap_tree, schema='newick', rooting='force-rooted', preserve_underscores=True)
-        bootstrap_support = self._collect_support_values(tree)
+        tree = dendropy.Tree.get_from_path(jk_taxa_tree, schema='newick', rooting='force-rooted', preserve_underscores=True)
 
-        tree = dendropy.Tree.get_from_path(jk_marker_tree, schema='newick', rooting='force-rooted', preserve_underscores=True)
-        jk_marker_support = self._collect_support_values(tree)
+        hasher = BipartitionHasher(leaf.taxon.label for leaf in tree.leaf_node_iter())
+        clade_hash = hasher.tree_clades(tree)
 
-        tree = dendropy.Tree.get_from_path(jk_taxa_tree, schema='newick', rooting='force-rooted', preserve_underscores=True)
-        jk_taxa_support = self._collect_support_values(tree)
-
-        internalNodeNum = 0
-        for node in tree.preorder_node_iter():
-            if node.is_internal():
-                if support_type == 'average':
-                    support = (int(bootstrap_support[internalNodeNum]) + int(jk_marker_support[internalNodeNum]) + int(jk_taxa_support[internalNodeNum])) / 3.0
-                elif support_type == 'minimum':
-                    support = min(int(bootstrap_support[internalNodeNum]), int(jk_marker_support[internalNodeNum]), int(jk_taxa_support[internalNodeNum]))
-
-                node.label = '%s' % str(int(support + 0.5))
-                internalNodeNum += 1
+        bootstrap_support = self._collect_support_values(hasher, bootstrap_tree)
+        jk_marker_support = self._collect_support_values(hasher, jk_marker_tree)
+
+        for node in tree.internal_nodes():
+            bipartition = hasher.key(clade_hash[node])
+            if bipartition not in bootstrap_support or bipartition not in jk_marker_support:
+                raise GenomeTreeTkError('Trees with support values do not have the same topology.')
+
+            supports = [int(bootstrap_support[bipartition]),
+                        int(jk_marker_support[bipartition]),
+                        int(self._support_value(node.label, jk_taxa_tree))]
+
+            if support_type == 'average':
+                support = sum(supports) / 3.0
+            elif support_type == 'minimum':
+                support = min(supports)
+
+            node.label = '%s' % str(int(support + 0.5))
 
         tree.write_to_path(output_tree, schema='newick', suppress_rooting=True, unquoted_underscores=True)
@@ -18,13 +18,18 @@
 import os
 import csv
 import sys
+import cPickle
+from array import array
 from collections import defaultdict, namedtuple
 
+import numpy as np
+
 import biolib.seq_io as seq_io
 from biolib.taxonomy import Taxonomy
 
 from genometreetk.default_values import DefaultValues
 from genometreetk.aai import aai_thresholds
+from genometreetk.exceptions import GenomeTreeTkError
 
 
 # make sure large CSV files can be read
@@ -47,30 +52,13 @@ def parse_genome_path(genome_path_file):
 def binomial_species(taxonomy):
     """Get binomial, including Candidatus, species names in NCBI taxonomy."""
     
+    if isinstance(taxonomy, TaxonomyTable):
+        return taxonomy.binomial_species()
+    
     binomial_names = defaultdict(set)
     for gid, taxa in taxonomy.items():
-        species = taxa[6]
-        if species == 's__':
-            continue
-            
-        if any(c.isdigit() for c in species):
-            continue
-        
-        is_candidatus = False
-        if 'Candidatus ' in species:
-            species = species.replace('Candidatus ', '')
-            is_candidatus = True
-            
-        tokens = species[3:].split()
-        if len(tokens) != 2:
-            continue
-            
-        genus, specific = tokens
-
-        if is_candidatus:
-            species = species.replace('s__', 's__Candidatus ')
-            
-        if genus.istitle() and all(c.islower() for c in specific):
+        species = _binomial_species_name(taxa[6])
+        if species:
             binomial_names[species].add(gid)
         
     return binomial_names
@@ -111,7 +99,299 @@ def canonical_species_name(species_name):
     species = species.replace('[','').replace(']','')
         
     return prefix + genus + ' ' + species
+
+
+def _binomial_species_name(species):
+    """Get binomial, including Candidatus, species name or None if species is not binomial."""
+    
+    if species == 's__':
+        return None
+        
+    if any(c.isdigit() for c in species):
+        return None
+    
+    is_candidatus = False
+    if 'Candidatus ' in species:
+        species = species.replace('Candidatus ', '')
+        is_candidatus = True
+        
+    tokens = species[3:].split()
+    if len(tokens) != 2:
+        return None
+        
+    genus, specific = tokens
+
+    if is_candidatus:
+        species = species.replace('s__', 's__Candidatus ')
+        
+    if genus.istitle() and all(c.islower() for c in specific):
+        return species
+        
+    return None
+    
+
+class TaxonStrings(object):
+    """Table of unique taxon strings referenced by integer codes."""
+    
+    def __init__(self):
+        """Initialization."""
+        
+        self.strings = []
+        self.codes = {}
+        
+    def __len__(self):
+        """Number of unique taxon strings."""
+        
+        return len(self.strings)
+        
+    def __getitem__(self, code):
+        """Get taxon string for code."""
+        
+        return self.strings[code]
+        
+    def code(self, taxon):
+        """Get code for taxon string, adding it to the table if required."""
+        
+        code = self.codes.get(taxon)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(intern(taxon))
+            self.codes[self.strings[-1]] = code
+            
+        return code
+        
+        
+class TaxonomyTable(object):
+    """Taxonomy of genomes stored as integer-coded ranks.
+    
+    Each genome is represented by 7 integer codes into a
+    table of taxon strings. The table can be used as a
+    dictionary indicating the taxa for each genome, with
+    taxa returned as a tuple and single ranks available through
+    rank() without building this tuple, while grouping genomes
+    by rank is performed with array operations.
     
+    Every genome has exactly 7 ranks. Lineages with fewer ranks
+    are padded with empty ranks (e.g. 'g__', 's__') and lineages
+    with more ranks are rejected.
+    """
+    
+    NUM_RANKS = len(Taxonomy.rank_prefixes)
+    GENUS_INDEX = Taxonomy.rank_index['g__']
+    SPECIES_INDEX = Taxonomy.rank_index['s__']
+    
+    def __init__(self, taxon_strings=None):
+        """Initialization.
+        
+        Parameters
+        ----------
+        taxon_strings : TaxonStrings
+            Table of taxon strings to share with other taxonomies, defaults to a new table.
+        """
+        
+        if taxon_strings is None:
+            taxon_strings = TaxonStrings()
+        self.taxon_strings = taxon_strings
+        
+        self.gids = []
+        self.gid_index = {}
+        self._rows = array('i')
+        
+        self._codes = None
+        
+        self._empty_taxa = [taxon_strings.code(p) for p in Taxonomy.rank_prefixes]
+        
+    @classmethod
+    def from_dict(cls, taxonomy, taxon_strings=None):
+        """Create table from dictionary indicating taxa for each genome."""
+        
+        table = cls(taxon_strings)
+        for gid, taxa in taxonomy.iteritems():
+            table[gid] = taxa
+            
+        return table
+        
+    def __len__(self):
+        return len(self.gids)
+        
+    def __contains__(self, gid):
+        return gid in self.gid_index
+        
+    def __iter__(self):
+        return iter(self.gids)
+        
+    def __getitem__(self, gid):
+        """Get tuple of taxa for genome."""
+        
+        strings = self.taxon_strings.strings
+        start = self.gid_index[gid] * self.NUM_RANKS
+        return tuple([strings[c] for c in self._rows[start:start + self.NUM_RANKS]])
+        
+    def __setitem__(self, gid, taxa):
+        """Set taxa for genome, padding missing trailing ranks.
+        
+        Raises
+        ------
+        GenomeTreeTkError
+            If more than 7 taxa are given.
+        """
+        
+        if len(taxa) > self.NUM_RANKS:
+            raise GenomeTreeTkError('Taxonomy of %s has more than %d ranks.' % (gid, self.NUM_RANKS))
+            
+        # missing ranks are assumed to be unspecified
+        codes = [self.taxon_strings.code(t) for t in taxa]
+        codes += self._empty_taxa[len(codes):]
+        
+        idx = self.gid_index.get(gid)
+        if idx is None:
+            self.gid_index[gid] = len(self.gids)
+            self.gids.append(gid)
+            self._rows.extend(codes)
+        else:
+            start = idx * self.NUM_RANKS
+            self._rows[start:start + self.NUM_RANKS] = array('i', codes)
+            
+        self._codes = None
+            
+    def get(self, gid, default=None):
+        if gid in self.gid_index:
+            return self[gid]
+            
+        return default
+        
+    def keys(self):
+        return list(self.gids)
+        
+    def iterkeys(self):
+        return iter(self.gids)
+        
+    def values(self):
+        return [self[gid] for gid in self.gids]
+        
+    def items(self):
+        return list(self.iteritems())
+        
+    def iteritems(self):
+        for gid in self.gids:
+            yield gid, self[gid]
+            
+    def rank(self, gid, rank_index):
+        """Get taxon at specified rank for genome."""
+        
+        code = self._rows[self.gid_index[gid] * self.NUM_RANKS + rank_index]
+        return self.taxon_strings.strings[code]
+        
+    def species(self, gid):
+        """Get species of genome."""
+        
+        return self.rank(gid, self.SPECIES_INDEX)
+        
+    def genus(self, gid):
+        """Get genus of genome."""
+        
+        return self.rank(gid, self.GENUS_INDEX)
+        
+    @property
+    def codes(self):
+        """Array of taxon codes with a row per genome and a column per rank."""
+        
+        if self._codes is None:
+            self._codes = np.array(self._rows, dtype=np.int32).reshape(-1, self.NUM_RANKS)
+            
+        return self._codes
+        
+    @property
+    def species_codes(self):
+        """Array of species codes for each genome."""
+        
+        return self.codes[:, self.SPECIES_INDEX]
+        
+    def _map_codes(self, codes, func):
+        """Apply function to each unique code and map result back to all genomes."""
+        
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        mapped = np.array([func(c) for c in unique_codes], dtype=np.int32)
+        
+        return mapped[inverse]
+        
+    def _row_indices(self, gids):
+        """Get row indices for genomes."""
+        
+        if gids is None:
+            return np.arange(len(self.gids))
+        
+        return np.array([self.gid_index[gid] for gid in gids], dtype=np.int64)
+        
+    def _group(self, codes, row_indices, skip_codes):
+        """Group genomes by code using a single stable sort."""
+        
+        groups = {}
+        if len(row_indices) == 0:
+            return groups
+        
+        order = np.argsort(codes, kind='mergesort')
+        sorted_codes = codes[order]
+        boundaries = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+        
+        strings = self.taxon_strings.strings
+        for group in np.split(order, boundaries):
+            code = codes[group[0]]
+            if code in skip_codes:
+                continue
+                
+            groups[strings[code]] = set(self.gids[i] for i in row_indices[group])
+            
+        return groups
+        
+    def genomes_by_rank(self, rank_index, gids=None, skip_empty=True):
+        """Group genomes by taxon at the specified rank.
+        
+        Parameters
+        ----------
+        rank_index : int
+            Index of rank to group genomes by.
+        gids : iterable
+            Genomes to group, defaults to all genomes.
+        skip_empty : boolean
+            Flag indicating if genomes without a taxon at this rank should be ignored.
+            
+        Returns
+        -------
+        dict : d[taxon] -> set of genome IDs
+        """
+        
+        row_indices = self._row_indices(gids)
+        codes = self.codes[row_indices, rank_index]
+        
+        skip_codes = set()
+        if skip_empty:
+            skip_codes.add(self._empty_taxa[rank_index])
+            
+        return self._group(codes, row_indices, skip_codes)
+        
+    def binomial_species(self):
+        """Get binomial, including Candidatus, species names.
+        
+        Returns
+        -------
+        dict : d[species] -> set of genome IDs
+        """
+        
+        def binomial_code(code):
+            sp = _binomial_species_name(self.taxon_strings[code])
+            if sp is None:
+                return -1
+            return self.taxon_strings.code(sp)
+            
+        row_indices = self._row_indices(None)
+        codes = self._map_codes(self.species_codes, binomial_code)
+        
+        binomial_names = defaultdict(set)
+        binomial_names.update(self._group(codes, row_indices, set([-1])))
+        
+        return binomial_names
+
     
 def filter_genomes(metadata_file,
                     min_comp,
@@ -467,20 +747,22 @@ def read_gtdb_phylum(metadata_file):
     return genome_phyla
 
 
-def read_gtdb_taxonomy(metadata_file):
+def read_gtdb_taxonomy(metadata_file, taxon_strings=None):
     """Parse GTDB taxonomy from GTDB metadata.
 
     Parameters
     ----------
     metadata_file : str
         Metadata for all genomes.
+    taxon_strings : TaxonStrings
+        Table of taxon strings to share with other taxonomies, defaults to a new table.
 
     Return
     ------
-    dict : d[genome_id] -> taxonomy list
+    TaxonomyTable : d[genome_id] -> tuple of 7 taxa
     """
 
-    taxonomy = {}
+    taxonomy = TaxonomyTable(taxon_strings)
 
     with open(metadata_file) as f:
         headers = f.readline().strip().split('\t')
@@ -527,20 +809,22 @@ def read_gtdb_representative(metadata_file):
     return gtdb_reps
 
 
-def read_gtdb_ncbi_taxonomy(metadata_file):
+def read_gtdb_ncbi_taxonomy(metadata_file, taxon_strings=None):
     """Parse NCBI taxonomy from GTDB metadata.
 
     Parameters
     ----------
     metadata_file : str
         Metadata for all genomes.
+    taxon_strings : TaxonStrings
+        Table of taxon strings to share with other taxonomies, defaults to a new table.
 
     Return
     ------
-    dict : d[genome_id] -> taxonomy list
+    TaxonomyTable : d[genome_id] -> tuple of 7 taxa
     """
 
-    taxonomy = {}
+    taxonomy = TaxonomyTable(taxon_strings)
 
     with open(metadata_file) as f:
         headers = f.readline().strip().split('\t')
@@ -712,13 +996,58 @@ def read_genome_id_file(genome_id_file):
     return ncbi_genome_ids, user_genome_ids
 
 
+def read_alignment_matrix(msa_file):
+    """Read multiple sequence alignment into a byte matrix.
+
+    Parameters
+    ----------
+    msa_file : str
+        Multiple sequence alignment in FASTA format.
+
+    Returns
+    -------
+    list
+        Sequence ids in the order given in the alignment file.
+    numpy.ndarray
+        Alignment as a uint8 matrix with one row per sequence.
+    """
+
+    num_seqs = 0
+    for line in open(msa_file):
+        if line[0] == '>':
+            num_seqs += 1
+
+    seq_ids = []
+    msa = None
+    for seq_id, seq in seq_io.read_seq(msa_file):
+        if msa is None:
+            msa = np.empty((num_seqs, len(seq)), dtype=np.uint8)
+        elif len(seq) != msa.shape[1]:
+            raise GenomeTreeTkError('Sequence %s has length %d, expected %d.' % (seq_id, len(seq), msa.shape[1]))
+
+        msa[len(seq_ids)] = np.frombuffer(seq, dtype=np.uint8)
+        seq_ids.append(seq_id)
+
+    if msa is None:
+        msa = np.empty((0, 0), dtype=np.uint8)
+
+    return seq_ids, msa
+
+
 def create_concatenated_alignment(genome_ids,
                                    marker_genes,
                                    alignment_dir,
                                    concatenated_alignment_file,
-                                   marker_file):
+                                   marker_file,
+                                   memmap_file=None,
+                                   marker_length=None):
     """Create concatenated multiple sequence alignment for all genomes.
 
+    The concatenated alignment is built in a preallocated genome x column
+    byte matrix, with the columns of each marker filled in as its alignment
+    is read. This matrix can optionally be memory-mapped to disk to bound
+    memory usage for large alignments.
+
     Parameters
     ----------
     genome_ids : iterable
@@ -731,24 +1060,24 @@ def create_concatenated_alignment(genome_ids,
         File to containing concatenated alignment.
     marker_file : str
         File indicating length of each marker in the alignment.
+    memmap_file : str
+        Optional file used to memory-map the concatenated alignment; removed once the alignment is written.
+    marker_length : d[marker_id] -> length
+        Optional length of each marker, otherwise determined from the alignments.
     """
 
-    # Read alignment files. Some genomes may have multiple
-    # copies of a marker gene in which case the last one
-    # is arbitrarily taken. This is acceptable as all genes
-    # are already screen to be conspecific.
-    alignments = defaultdict(dict)
-    marker_length = {}
-    for mg in marker_genes:
-        f = mg + '.aln.masked.faa'
-        seqs = seq_io.read_fasta(os.path.join(alignment_dir, f))
-
-        for seq_id, seq in seqs.iteritems():
-            genome_id = seq_id[0:seq_id.find(DefaultValues.SEQ_CONCAT_CHAR)]
-
-            alignments[mg][genome_id] = seq
+    genome_ids = list(genome_ids)
+    marker_genes = list(marker_genes)
+    genome_row = dict((genome_id, i) for i, genome_id in enumerate(genome_ids))
 
-            marker_length[mg] = len(seq)
+    # determine length of each marker from its first aligned sequence
+    if marker_length is None:
+        marker_length = {}
+        for mg in marker_genes:
+            marker_length[mg] = 0
+            for _seq_id, seq in seq_io.read_fasta_seq(os.path.join(alignment_dir, mg + '.aln.masked.faa')):
+                marker_length[mg] = len(seq)
+                break
 
     # create marker file
     fout = open(marker_file, 'w')
@@ -756,19 +1085,106 @@ def create_concatenated_alignment(genome_ids,
         fout.write('%s\t%s\t%s\t%d\n' % (mg, mg, mg, marker_length[mg]))
     fout.close()
 
-    # create concatenated alignment
-    concatenated_seqs = {}
-    for mg in marker_genes:
-        seqs = alignments[mg]
+    # preallocate concatenated alignment with all genes missing
+    shape = (len(genome_ids), sum(marker_length.values()))
+    if memmap_file:
+        concatenated_aln = np.memmap(memmap_file, dtype=np.uint8, mode='w+', shape=shape)
+    else:
+        concatenated_aln = np.empty(shape, dtype=np.uint8)
+    concatenated_aln.fill(ord('-'))
 
-        for genome_id in genome_ids:
-            if genome_id in seqs:
-                # append alignment
-                concatenated_seqs[genome_id] = concatenated_seqs.get(genome_id, '') + seqs[genome_id]
-            else:
-                # missing gene
-                concatenated_seqs[genome_id] = concatenated_seqs.get(genome_id, '') + '-' * marker_length[mg]
+    # Fill in columns of each marker. Some genomes may have multiple
+    # copies of a marker gene in which case the last one
+    # is arbitrarily taken. This is acceptable as all genes
+    # are already screen to be conspecific.
+    start = 0
+    for mg in marker_genes:
+        end = start + marker_length[mg]
+        for seq_id, seq in seq_io.read_fasta_seq(os.path.join(alignment_dir, mg + '.aln.masked.faa')):
+            row = genome_row.get(seq_id[0:seq_id.find(DefaultValues.SEQ_CONCAT_CHAR)], None)
+            if row is not None:
+                concatenated_aln[row, start:end] = np.frombuffer(seq, dtype=np.uint8)
+        start = end
 
     # save concatenated alignment
-    seq_io.write_fasta(concatenated_seqs, concatenated_alignment_file)
+    fout = open(concatenated_alignment_file, 'w')
+    for genome_id, row in zip(genome_ids, concatenated_aln):
+        fout.write('>' + genome_id + '\n')
+        fout.write(row.tostring() + '\n')
+    fout.close()
+
+    if memmap_file:
+        del concatenated_aln
+        os.remove(memmap_file)
+
+def file_signature(path):
+    """Get signature of file given by its size and modification time."""
+
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+
+def load_signed_cache(cache_file, signature):
+    """Load object saved by save_signed_cache().
+
+    Parameters
+    ----------
+    cache_file : str
+        File containing cached object.
+    signature : object
+        Signature the object must have been saved with, e.g. the
+        file_signature() of the file the object was derived from.
+
+    Returns
+    -------
+    object
+        Cached object, or None if the cache is missing, unreadable,
+        or was saved with a different signature.
+    """
+
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        with open(cache_file, 'rb') as f:
+            if cPickle.load(f) == signature:
+                return cPickle.load(f)
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+        pass
+
+    return None
+
+
+def save_signed_cache(cache_file, signature, obj):
+    """Save object along with a signature of the data it was derived from.
+
+    The object is written to a temporary file which is renamed once
+    complete, so an interrupted run never leaves behind a partial cache.
+
+    Parameters
+    ----------
+    cache_file : str
+        File to hold cached object.
+    signature : object
+        Signature required to load the object with load_signed_cache().
+    obj : object
+        Object to cache.
+
+    Returns
+    -------
+    boolean
+        True if the cache was written, else False.
+    """
 
+    tmp_cache_file = cache_file + '.tmp'
+    try:
+        with open(tmp_cache_file, 'wb') as f:
+            cPickle.dump(signature, f, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_cache_file, cache_file)
+    except (IOError, OSError):
+        if os.path.exists(tmp_cache_file):
+            os.remove(tmp_cache_file)
+        return False
+
+    return True
@@ -23,4 +23,6 @@ class DefaultValues():
 
     PROTEIN_FILE_EXTENSION = '_protein.faa'
     PFAM_EXTENSION = '_pfam_tophit.tsv'
-    TIGR_EXTENSION = '_tigrfam_tophit.tsv'
\ No newline at end of file
+    TIGR_EXTENSION = '_tigrfam_tophit.tsv'
+
+    TOPHIT_INDEX_EXTENSION = '.tophit_index.pkl'
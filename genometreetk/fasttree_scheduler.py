@@ -0,0 +1,303 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import sys
+import time
+import errno
+import logging
+import threading
+import subprocess
+from collections import namedtuple
+
+from biolib.external.execute import check_on_path
+
+from genometreetk.exceptions import GenomeTreeTkError
+
+
+def fasttree_command(seq_type, model_str, output_tree_log, msa_file=None, threads=1):
+    """Get command line for inferring tree with FastTree.
+
+    All trees are inferred using the GAMMA distribution to model
+    rate heterogeneity. Nucleotide trees are inferred under the
+    GTR model.
+
+    Parameters
+    ----------
+    seq_type : str
+        Specifies multiple sequences alignment is of 'nt' or 'prot'.
+    model_str : str
+        Specified either the 'wag', 'lg', or 'jtt' model.
+    output_tree_log : str
+        Output file containing information about inferred tree.
+    msa_file : str
+        Fasta file containing multiple sequence alignment, or None to read alignment from stdin.
+    threads : int
+        Number of threads to use, with FastTreeMP used for more than one thread.
+
+    Returns
+    -------
+    list
+        Command line arguments.
+    dict
+        Environment for running command.
+    """
+
+    cmd = []
+    env = os.environ.copy()
+    if threads > 1:
+        cmd.append('FastTreeMP')
+        env['OMP_NUM_THREADS'] = str(threads)
+    else:
+        cmd.append('FastTree')
+
+    cmd += ['-quiet', '-nosupport', '-gamma']
+    if seq_type == 'nt':
+        cmd += ['-nt', '-gtr']
+    elif model_str.upper() == 'WAG':
+        cmd.append('-wag')
+    elif model_str.upper() == 'LG':
+        cmd.append('-lg')
+    cmd += ['-log', output_tree_log]
+
+    if msa_file:
+        cmd.append(msa_file)
+
+    return cmd, env
+
+
+class FastTreeScheduler(object):
+    """Infer trees for a set of alignments sharing a pool of cpus.
+
+    Jobs are started from most to least costly. Jobs accounting for more
+    than a fair share of the total cost are given multiple threads and
+    run with FastTreeMP, while all other jobs are run with single-threaded
+    FastTree. Smaller jobs are started whenever enough cpus are free so
+    no cpus sit idle while jobs remain. Once fewer jobs remain than there
+    are free cpus, the free cpus are shared among the remaining jobs.
+
+    The alignment of a job can either be read from a file or produced
+    on the fly and streamed to FastTree through stdin. Alignments are
+    produced by a writer thread for each running job, so jobs are
+    started and reaped while alignments are being written.
+
+    Jobs where FastTree fails, or where their alignment could not be
+    written in full, are reported together once all other jobs have
+    finished.
+    """
+
+    Job = namedtuple('Job', 'cost msa_file output_tree output_tree_log write_msa done')
+    Job.__new__.__defaults__ = (None, None)
+
+    def __init__(self, cpus):
+        """Initialization.
+
+        Parameters
+        ----------
+        cpus : int
+            Number of cpus to use.
+        """
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.cpus = cpus
+
+        check_on_path('FastTree')
+        self.multithreaded = check_on_path('FastTreeMP', exit_on_fail=False)
+
+        # interval in seconds between checking for completed jobs
+        self.poll_interval = 0.5
+
+    def _threads(self, job, total_cost):
+        """Determine number of threads to give job."""
+
+        if not self.multithreaded or total_cost == 0:
+            return 1
+
+        fair_share = float(total_cost) / self.cpus
+        return max(1, min(self.cpus, int(job.cost / fair_share)))
+
+    def _start(self, job, threads, seq_type, model_str):
+        """Start FastTree process for job.
+
+        If the job has a function for writing its alignment, the
+        alignment is streamed to FastTree through stdin by a writer
+        thread and also written to the job's alignment file when one
+        is given. Otherwise, FastTree reads the job's alignment file.
+
+        Returns
+        -------
+        subprocess.Popen
+            FastTree process.
+        _MsaWriter
+            Thread writing alignment, or None.
+        """
+
+        msa_file = None if job.write_msa else job.msa_file
+
+        cmd, env = fasttree_command(seq_type, model_str, job.output_tree_log, msa_file, threads)
+        with open(job.output_tree, 'w') as fout, open(os.devnull, 'w') as ferr:
+            if not job.write_msa:
+                return subprocess.Popen(cmd, stdout=fout, stderr=ferr, env=env), None
+
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fout, stderr=ferr, env=env)
+
+        writer = _MsaWriter(job, proc)
+        writer.start()
+
+        return proc, writer
+
+    def run(self, jobs, seq_type, model_str):
+        """Infer tree for each job.
+
+        Parameters
+        ----------
+        jobs : iterable of FastTreeScheduler.Job
+            Alignments to infer trees from along with their estimated cost.
+        seq_type : str
+            Specifies multiple sequences alignment is of 'nt' or 'prot'.
+        model_str : str
+            Specified either the 'wag', 'lg', or 'jtt' model.
+
+        Raises
+        ------
+        GenomeTreeTkError
+            If FastTree failed to infer the tree of any job or the
+            alignment of any job could not be written.
+        """
+
+        assert(seq_type.upper() in ['NT', 'PROT'])
+        assert(model_str.upper() in ['WAG', 'LG', 'JTT', 'GTR'])
+
+        pending = sorted(jobs, key=lambda job: job.cost, reverse=True)
+        total_cost = sum(job.cost for job in pending)
+        threads = [self._threads(job, total_cost) for job in pending]
+
+        num_jobs = len(pending)
+        num_processed_jobs = 0
+        free_cpus = self.cpus
+        running = []
+        failed_jobs = []
+        while pending or running:
+            # start most costly pending job fitting on free cpus
+            started = False
+            for i, job in enumerate(pending):
+                if threads[i] <= free_cpus or not running:
+                    job_threads = threads[i]
+                    if self.multithreaded:
+                        # share cpus which would otherwise sit idle
+                        # among the remaining jobs
+                        job_threads = max(job_threads, free_cpus // len(pending))
+
+                    proc, writer = self._start(job, job_threads, seq_type, model_str)
+                    running.append((proc, writer, job, job_threads))
+                    free_cpus -= job_threads
+                    del pending[i]
+                    del threads[i]
+                    started = True
+                    break
+
+            if started:
+                continue
+
+            time.sleep(self.poll_interval)
+            for proc, writer, job, job_threads in list(running):
+                if proc.poll() is not None:
+                    running.remove((proc, writer, job, job_threads))
+                    free_cpus += job_threads
+                    if writer:
+                        writer.join()
+
+                    if writer and writer.error:
+                        # FastTree may succeed on a truncated alignment
+                        self.logger.warning('Failed to write alignment for tree %s: %s' % (job.output_tree, writer.error))
+                        failed_jobs.append(job)
+                    elif proc.returncode != 0:
+                        self.logger.warning('FastTree failed to infer tree: %s' % job.output_tree)
+                        failed_jobs.append(job)
+                    elif job.done:
+                        job.done()
+
+                    num_processed_jobs += 1
+                    statusStr = '==> Finished processing %d of %d (%.2f%%) trees.' % (num_processed_jobs, num_jobs, float(num_processed_jobs) * 100 / num_jobs)
+                    sys.stdout.write('%s\r' % statusStr)
+                    sys.stdout.flush()
+
+        if num_jobs:
+            sys.stdout.write('\n')
+
+        if failed_jobs:
+            raise GenomeTreeTkError('FastTree failed to infer %d of %d trees. See log files:\n%s'
+                                    % (len(failed_jobs),
+                                        num_jobs,
+                                        '\n'.join(job.output_tree_log for job in failed_jobs)))
+
+
+class _MsaWriter(threading.Thread):
+    """Write alignment of job to FastTree, keeping a copy if requested.
+
+    FastTree's stdin is always closed once writing stops so FastTree
+    never waits for further input. Any error raised while writing is
+    kept so the job can be reported as failed, except for FastTree
+    exiting before reading the full alignment, which is reported once
+    the process is polled.
+    """
+
+    def __init__(self, job, proc):
+        """Initialization."""
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.job = job
+        self.proc = proc
+        self.error = None
+
+    def run(self):
+        """Write alignment."""
+
+        try:
+            if self.job.msa_file:
+                with open(self.job.msa_file, 'w') as fout:
+                    self.job.write_msa(_Tee(self.proc.stdin, fout))
+            else:
+                self.job.write_msa(self.proc.stdin)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+
+
+class _Tee(object):
+    """Write data to several output streams."""
+
+    def __init__(self, *outputs):
+        """Initialization."""
+
+        self.outputs = outputs
+
+    def write(self, data):
+        """Write data to all output streams."""
+
+        for output in self.outputs:
+            output.write(data)
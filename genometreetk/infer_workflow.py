@@ -16,7 +16,9 @@
 ###############################################################################
 
 import os
+import shutil
 import logging
+from collections import defaultdict
 
 from biolib.common import make_sure_path_exists
 from biolib.misc.time_keeper import TimeKeeper
@@ -27,7 +29,10 @@ from genometreetk.common import (read_genome_id_file,
                                     read_genome_dir_file,
                                     read_marker_id_file,
                                     create_concatenated_alignment)
+from genometreetk.default_values import DefaultValues
+from genometreetk.exceptions import GenomeTreeTkError
 from genometreetk.markers.align_markers import AlignMarkers
+from genometreetk.markers.hmm_model_index import HmmModelIndex
 
 
 class InferWorkflow(object):
@@ -71,26 +76,20 @@ class InferWorkflow(object):
             Directory to write individual HMM model files.
         """
 
-        marker_id_to_name = {}
-        for line in open(self.pfam_model_file):
-            if 'NAME' in line:
-                name = line.split()[1].rstrip()
-            elif 'ACC' in line:
-                acc = line.split()[1].rstrip()
-                marker_id_to_name[acc] = name
-
+        hmm_model_index = HmmModelIndex()
         fout_model = open(hmm_model_out, 'w')
         for marker_id in marker_genes:
-            output_model_file = os.path.join(output_model_dir, marker_id + '.hmm')
             if 'PF' in marker_id:
-                os.system('hmmfetch ' + self.pfam_model_file + ' ' + marker_id_to_name[marker_id] + ' > ' + output_model_file)
+                model = hmm_model_index.fetch(self.pfam_model_file, marker_id)
             else:
                 input_model_file = os.path.join(self.tigrfams_model_dir, marker_id + '.HMM')
-                os.system('hmmfetch ' + input_model_file + ' ' + marker_id + ' > ' + output_model_file)
+                model = hmm_model_index.fetch(input_model_file, marker_id, persist=False)
 
-            # write model to file
-            for line in open(output_model_file):
-                fout_model.write(line)
+            # write model to individual and combined model files
+            output_model_file = os.path.join(output_model_dir, marker_id + '.hmm')
+            with open(output_model_file, 'w') as fout:
+                fout.write(model)
+            fout_model.write(model)
 
         fout_model.close()
 
@@ -108,12 +107,119 @@ class InferWorkflow(object):
 
         self.logger.info('    HMM information written to: ' + hmm_info_out)
 
+    def _read_previous_alignment(self, prev_output_dir):
+        """Read genomes and markers within a previously concatenated alignment.
+
+        Parameters
+        ----------
+        prev_output_dir : str
+            Output directory of a previous run.
+
+        Returns
+        -------
+        set
+            Genomes in previous alignment.
+        list
+            Marker genes in the order they were concatenated.
+        d[marker_id] -> length
+            Length of each marker in the previous alignment.
+        """
+
+        prev_marker_genes = []
+        marker_length = {}
+        for line in open(os.path.join(prev_output_dir, 'concatenated_markers.tsv')):
+            line_split = line.rstrip('\n').split('\t')
+            prev_marker_genes.append(line_split[0])
+            marker_length[line_split[0]] = int(line_split[3])
+
+        # rows of newly aligned genomes are appended to the previous
+        # alignment so each row must span all markers
+        alignment_file = os.path.join(prev_output_dir, 'concatenated_alignment.faa')
+        alignment_length = sum(marker_length.values())
+        seq_length = defaultdict(int)
+        genome_id = None
+        for line in open(alignment_file):
+            if line[0] == '>':
+                genome_id = line[1:].split(None, 1)[0]
+                seq_length[genome_id] = 0
+            else:
+                seq_length[genome_id] += len(line.rstrip())
+
+        for genome_id, length in seq_length.iteritems():
+            if length != alignment_length:
+                raise GenomeTreeTkError('Genome %s has length %d in %s, expected %d.' % (genome_id, length, alignment_file, alignment_length))
+
+        return set(seq_length), prev_marker_genes, marker_length
+
+    def _check_marker_lengths(self, marker_length, output_model_dir):
+        """Verify markers of a previous alignment match the current HMMs.
+
+        Newly aligned genomes are restricted to the columns modelled by
+        each HMM, so can only be appended to a previous alignment created
+        with HMMs of the same length.
+
+        Parameters
+        ----------
+        marker_length : d[marker_id] -> length
+            Length of each marker in the previous alignment.
+        output_model_dir : str
+            Directory with individual HMM model files.
+        """
+
+        for marker_id, length in marker_length.iteritems():
+            model_file = os.path.join(output_model_dir, marker_id + '.hmm')
+            model = HmmModelParser(model_file).simple_parse().next()
+            if model.leng != length:
+                raise GenomeTreeTkError('Marker %s has length %d in previous alignment, but HMM has length %d.' % (
+                                            marker_id, length, model.leng))
+
+    def _merge_alignments(self, prev_alignment_file, new_alignment_file, genome_ids, output_file):
+        """Append newly aligned genomes to rows retained from a previous alignment.
+
+        The merged alignment is written to a temporary file and moved
+        into place, so the output file may be the previous alignment.
+
+        Parameters
+        ----------
+        prev_alignment_file : str
+            Previously concatenated alignment.
+        new_alignment_file : str
+            Concatenated alignment of genomes absent from the previous alignment, or None.
+        genome_ids : set
+            Genomes to retain from the previous alignment.
+        output_file : str
+            File to contain merged alignment.
+        """
+
+        tmp_output_file = output_file + '.tmp'
+        fout = open(tmp_output_file, 'w')
+
+        keep = False
+        for line in open(prev_alignment_file):
+            if line[0] == '>':
+                keep = line[1:].split(None, 1)[0] in genome_ids
+            if keep:
+                fout.write(line)
+
+        if new_alignment_file:
+            for line in open(new_alignment_file):
+                fout.write(line)
+
+        fout.close()
+        os.rename(tmp_output_file, output_file)
+
     def run(self, genome_id_file,
                     marker_id_file,
                     model,
-                    output_dir):
+                    output_dir,
+                    prev_output_dir=None):
         """Identify phylogenetic tree.
 
+        If the output directory of a previous run is given, only genomes
+        absent from its concatenated alignment are aligned. Alignments are
+        restricted to columns modelled by each HMM so the newly aligned
+        genomes can be appended directly to the previous alignment.
+
         Parameters
         ----------
         genome_id_file : str
@@ -124,6 +230,8 @@ class InferWorkflow(object):
             Model of evolution to use.
         output_dir : str
             Directory to store results.
+        prev_output_dir : str
+            Output directory of a previous run to extend with new genomes.
         """
 
         time_keeper = TimeKeeper()
@@ -149,21 +257,58 @@ class InferWorkflow(object):
         marker_genes = read_marker_id_file(marker_id_file)
         self.logger.info('Read %d marker genes.' % len(marker_genes))
 
+        # only align genomes absent from the previous alignment
+        genomes_to_align = genome_ids
+        marker_length = None
+        if prev_output_dir:
+            prev_genome_ids, prev_marker_genes, marker_length = self._read_previous_alignment(prev_output_dir)
+            if set(prev_marker_genes) != marker_genes:
+                raise GenomeTreeTkError('Marker genes differ from those in previous alignment: %s' % prev_output_dir)
+
+            marker_genes = prev_marker_genes
+            genomes_to_align = genome_ids - prev_genome_ids
+            self.logger.info('Retaining %d genomes from previous alignment.' % len(genome_ids & prev_genome_ids))
+            self.logger.info('Aligning %d genomes absent from previous alignment.' % len(genomes_to_align))
+
         # gather all single-copy HMMs into a single model file
         hmm_model_out = os.path.join(output_dir, 'phylo.hmm')
         hmm_info_out = os.path.join(output_dir, 'phylo.tsv')
         self.logger.info('Generating marker gene HMM model files.')
         self._fetch_marker_models(marker_genes, hmm_model_out, hmm_info_out, output_model_dir)
 
+        if prev_output_dir:
+            self._check_marker_lengths(marker_length, output_model_dir)
+
         # align gene sequences
-        align_markers = AlignMarkers(self.cpus)
-        align_markers.run(genome_ids, genome_dirs, marker_genes, True, output_alignment_dir, output_model_dir)
+        if genomes_to_align:
+            align_markers = AlignMarkers(self.cpus, self.genome_dir_file + DefaultValues.TOPHIT_INDEX_EXTENSION)
+            align_markers.run(genomes_to_align, genome_dirs, marker_genes, True, output_alignment_dir, output_model_dir)
 
         # create concatenated alignment file
         self.logger.info('Concatenating alignments.')
         concatenated_alignment_file = os.path.join(output_dir, 'concatenated_alignment.faa')
         marker_file = os.path.join(output_dir, 'concatenated_markers.tsv')
-        create_concatenated_alignment(genome_ids, marker_genes, output_alignment_dir, concatenated_alignment_file, marker_file)
+        memmap_file = os.path.join(output_dir, 'concatenated_alignment.mmap')
+        if not prev_output_dir:
+            create_concatenated_alignment(genome_ids, marker_genes, output_alignment_dir, concatenated_alignment_file, marker_file, memmap_file)
+        elif not genomes_to_align:
+            # nothing new to align so retain rows of previous alignment
+            prev_marker_file = os.path.join(prev_output_dir, 'concatenated_markers.tsv')
+            if os.path.abspath(prev_marker_file) != os.path.abspath(marker_file):
+                shutil.copyfile(prev_marker_file, marker_file)
+
+            self._merge_alignments(os.path.join(prev_output_dir, 'concatenated_alignment.faa'),
+                                    None,
+                                    genome_ids,
+                                    concatenated_alignment_file)
+        else:
+            new_alignment_file = os.path.join(output_dir, 'concatenated_alignment.new.faa')
+            create_concatenated_alignment(genomes_to_align, marker_genes, output_alignment_dir, new_alignment_file, marker_file, memmap_file, marker_length)
+            self._merge_alignments(os.path.join(prev_output_dir, 'concatenated_alignment.faa'),
+                                    new_alignment_file,
+                                    genome_ids,
+                                    concatenated_alignment_file)
+            os.remove(new_alignment_file)
 
         # create concatenated genome tree
         self.logger.info('Inferring concatenated genome tree.')
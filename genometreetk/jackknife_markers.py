@@ -16,15 +16,18 @@
 ###############################################################################
 
 import os
+import sys
 import logging
-import random
 from math import floor
 
-import biolib.seq_io as seq_io
-from biolib.external.fasttree import FastTree
-from biolib.parallel import Parallel
+import numpy as np
+
 from biolib.common import remove_extension, make_sure_path_exists
-from biolib.bootstrap import bootstrap_support
+
+from genometreetk.common import read_alignment_matrix
+from genometreetk.bipartitions import bootstrap_support
+from genometreetk.fasttree_scheduler import FastTreeScheduler
+from genometreetk.replicate_records import ReplicateRecords, run_signature
 
 
 class JackknifeMarkers(object):
@@ -43,29 +46,39 @@ class JackknifeMarkers(object):
 
         self.cpus = cpus
 
-    def _producer(self, replicated_num):
-        """Infer tree from jackknifed alignments.
+        # number of sequences written to a replicate alignment at a time
+        self.rows_per_write = 1024
+
+    def _job(self, replicated_num):
+        """Create job inferring tree from jackknifed alignment.
 
         Parameters
         ----------
         replicated_num : int
           Unique replicate number.
+
+        Returns
+        -------
+        FastTreeScheduler.Job
+          Job for inferring replicate tree.
         """
 
-        output_msa = os.path.join(self.replicate_dir, 'jk_markers.msa.' + str(replicated_num) + '.faa')
-        self.jackknife_alignment(self.msa, self.perc_markers_to_keep, self.marker_lengths, output_msa)
+        def write_msa(fout):
+            rng = np.random.RandomState([self.seed, replicated_num])
+            self._write_jackknife_alignment(fout, self.seq_ids, self.msa, self.perc_markers_to_keep, self.marker_lengths, rng)
+
+        output_msa = None
+        if self.keep_msa:
+            output_msa = os.path.join(self.replicate_dir, 'jk_markers.msa.' + str(replicated_num) + '.faa')
 
-        fast_tree = FastTree(multithreaded=False)
         output_tree = os.path.join(self.replicate_dir, 'jk_markers.tree.' + str(replicated_num) + '.tre')
         fast_tree_output = os.path.join(self.replicate_dir, 'jk_markers.fasttree.' + str(replicated_num) + '.out')
-        fast_tree.run(output_msa, 'prot', self.model, output_tree, fast_tree_output)
-
-        return True
-
-    def _progress(self, processed_items, total_items):
-        """Report progress of replicates."""
-
-        return '==> Processed %d of %d replicates.' % (processed_items, total_items)
+        return FastTreeScheduler.Job(cost=1,
+                                        msa_file=output_msa,
+                                        output_tree=output_tree + '.tmp',
+                                        output_tree_log=fast_tree_output,
+                                        write_msa=write_msa,
+                                        done=lambda: self.replicates.complete(replicated_num, self.seed, output_tree + '.tmp', output_tree))
 
     def jackknife_alignment(self, msa, perc_markers_to_keep, marker_lengths, output_file):
         """Jackknife alignment to a subset of marker genes.
@@ -84,25 +97,102 @@ class JackknifeMarkers(object):
         output_file : str
           File to write bootstrapped alignment.
         """
-        markers_to_keep = random.sample(xrange(0, len(marker_lengths)), int(floor(perc_markers_to_keep * len(marker_lengths))))
-
-        start_pos = [0]
-        for index, ml in enumerate(marker_lengths):
-            start_pos.append(start_pos[index] + ml)
 
-        mask = [0] * sum(marker_lengths)
-        for marker_index in markers_to_keep:
-            start = start_pos[marker_index]
-            end = start + marker_lengths[marker_index]
-            mask[start:end] = [1] * (end - start)
+        seq_ids = msa.keys()
+        msa_matrix = np.array([np.frombuffer(msa[seq_id], dtype=np.uint8) for seq_id in seq_ids])
 
         fout = open(output_file, 'w')
-        for seq_id, seq in msa.iteritems():
-            fout.write('>' + seq_id + '\n')
-            sub_seq = ''.join([base for base, m in zip(seq, mask) if m == 1])
-            fout.write(sub_seq + '\n')
+        self._write_jackknife_alignment(fout, seq_ids, msa_matrix, perc_markers_to_keep, marker_lengths)
         fout.close()
 
+    def _write_jackknife_alignment(self, fout, seq_ids, msa, perc_markers_to_keep, marker_lengths, rng=None):
+        """Write alignment jackknifed to a subset of marker genes.
+
+        Parameters
+        ----------
+        fout : file
+          Output stream for jackknifed alignment.
+        seq_ids : list
+          Sequence ids in the order of rows in the alignment.
+        msa : numpy.ndarray
+          Full multiple sequence alignment as a uint8 matrix.
+        perc_markers_to_keep : float
+          Percentage of marker genes to keep in each replicate [0, 1].
+        marker_lengths : list
+          Length of each marker gene.
+        rng : np.random.RandomState
+          Random number generator for selecting marker genes.
+        """
+
+        if rng is None:
+            rng = np.random
+
+        markers_to_keep = rng.choice(len(marker_lengths), int(floor(perc_markers_to_keep * len(marker_lengths))), replace=False)
+
+        # columns of kept markers, in the order markers were concatenated
+        keep_marker = np.zeros(len(marker_lengths), dtype=bool)
+        keep_marker[markers_to_keep] = True
+        cols = np.flatnonzero(np.repeat(keep_marker, marker_lengths))
+
+        for start in xrange(0, len(seq_ids), self.rows_per_write):
+            rows = msa[start:start + self.rows_per_write][:, cols]
+            fout.write(''.join(['>%s\n%s\n' % (seq_id, row.tostring())
+                                for seq_id, row in zip(seq_ids[start:start + self.rows_per_write], rows)]))
+
+    def _calculate_replicates(self, msa_file, marker_info_file, mask_file, replicates):
+        """Infer trees for jackknifed replicates.
+
+        Parameters
+        ----------
+        msa_file : str
+          File containing multiple sequence alignment for all taxa.
+        marker_info_file : str
+          File indicating database id, HMM name, description and length of each marker in the alignment.
+        mask_file : str
+          File indicating masking of multiple sequence alignment.
+        replicates : iterable
+          Replicate numbers to infer.
+        """
+
+        marker_lengths = []
+        total_len = 0
+        with open(marker_info_file) as f:
+            f.readline()
+            for line in f:
+                line_split = line.split('\t')
+                ml = int(line_split[3])
+                marker_lengths.append(ml)
+                total_len += ml
+                
+        self.logger.info('Concatenated length of markers: %d' % total_len)
+                
+        # read mask
+        mask = open(mask_file).readline().strip()
+        start = 0
+        self.marker_lengths = []
+        total_mask_len = 0
+        for ml in marker_lengths:
+            end = start + ml
+            zeros = mask[start:end].count('0')
+            start = end
+            
+            self.marker_lengths.append(ml - zeros)
+            total_mask_len += ml - zeros
+            
+        self.logger.info('Concatenated length of filtered MSA: %d' % total_mask_len)
+
+        # read full multiple sequence alignment
+        self.seq_ids, self.msa = read_alignment_matrix(msa_file)
+        
+        if self.msa.shape[1] != total_mask_len:
+            self.logger.error('Length of MSA does not meet length of mask.')
+            sys.exit()
+
+        # calculate replicates, sharing cpus among concurrent replicates
+        self.logger.info('Calculating jackknife marker replicates:')
+        scheduler = FastTreeScheduler(self.cpus)
+        scheduler.run([self._job(rep_index) for rep_index in replicates], 'prot', self.model)
+
     def run(self, input_tree, 
                     msa_file, 
                     marker_info_file, 
@@ -111,7 +201,10 @@ class JackknifeMarkers(object):
                     num_replicates, 
                     model,
                     jk_dir,
-                    output_dir):
+                    output_dir,
+                    keep_msa=False,
+                    seed=None,
+                    support_only=False):
         """Jackknife marker genes.
 
         Marker file should have the format:
@@ -135,12 +228,20 @@ class JackknifeMarkers(object):
           Desired model of evolution.
         output_dir : str
           Output directory for jackkife trees.
+        keep_msa : bool
+          Flag indicating if alignment of each replicate should be written to disk.
+        seed : int
+          Seed for generating replicates, or None to continue with the seed of
+          completed replicates or select a seed at random.
+        support_only : bool
+          Flag indicating support should be calculated from completed replicates only.
         """
 
         assert(model in ['wag', 'jtt'])
 
         self.model = model
         self.perc_markers_to_keep = perc_markers_to_keep
+        self.keep_msa = keep_msa
         
         
         # determine length of each marker gene in alignment
@@ -148,50 +249,31 @@ class JackknifeMarkers(object):
         if not jk_dir:
             self.replicate_dir = os.path.join(output_dir, 'replicates')
             make_sure_path_exists(self.replicate_dir)
-            
-            marker_lengths = []
-            total_len = 0
-            with open(marker_info_file) as f:
-                f.readline()
-                for line in f:
-                    line_split = line.split('\t')
-                    ml = int(line_split[3])
-                    marker_lengths.append(ml)
-                    total_len += ml
-                    
-            self.logger.info('Concatenated length of markers: %d' % total_len)
-                    
-            # read mask
-            mask = open(mask_file).readline().strip()
-            start = 0
-            self.marker_lengths = []
-            total_mask_len = 0
-            for ml in marker_lengths:
-                end = start + ml
-                zeros = mask[start:end].count('0')
-                start = end
-                
-                self.marker_lengths.append(ml - zeros)
-                total_mask_len += ml - zeros
-                
-            self.logger.info('Concatenated length of filtered MSA: %d' % total_mask_len)
 
-            # read full multiple sequence alignment
-            self.msa = seq_io.read(msa_file)
-            
-            if len(self.msa.values()[0]) != total_mask_len:
-                self.logger.error('Length of MSA does not meet length of mask.')
-                sys.exit()
+            signature = run_signature((model, perc_markers_to_keep),
+                                        (msa_file, marker_info_file, mask_file))
+            self.replicates = ReplicateRecords(self.replicate_dir, 'jk_markers', signature)
+            self.seed = self.replicates.seed(seed)
+            completed = self.replicates.completed(self.seed)
+            remaining = [rep_index for rep_index in xrange(num_replicates) if rep_index not in completed]
+            self.logger.info('Generating replicates with seed %d.' % self.seed)
+            if completed:
+                self.logger.info('Found %d completed replicates.' % (num_replicates - len(remaining)))
+
+            if remaining and not support_only:
+                self._calculate_replicates(msa_file, marker_info_file, mask_file, remaining)
+
+                completed = self.replicates.completed(self.seed)
+
+            for rep_index in sorted(completed):
+                if rep_index < num_replicates:
+                    rep_tree_files.append(completed[rep_index])
 
-            # calculate replicates
-            self.logger.info('Calculating jackknife marker replicates:')
-            parallel = Parallel(self.cpus)
-            parallel.run(self._producer, None, xrange(num_replicates), self._progress)
+            if len(rep_tree_files) < num_replicates:
+                self.logger.warning('Only %d of %d replicates are complete.' % (len(rep_tree_files), num_replicates))
 
             # calculate support
-            self.logger.info('Calculating support for %d replicates.' % num_replicates)
-            for rep_index in xrange(num_replicates):
-                rep_tree_files.append(os.path.join(self.replicate_dir, 'jk_markers.tree.' + str(rep_index) + '.tre'))
+            self.logger.info('Calculating support for %d replicates.' % len(rep_tree_files))
         else:
             for f in os.listdir(jk_dir):
                 if f.endswith('.tree') or f.endswith('.tre'):
@@ -17,16 +17,17 @@
 
 import os
 import logging
-import random
 from math import floor
 
+import numpy as np
+
 import biolib.seq_io as seq_io
-from biolib.external.fasttree import FastTree
-from biolib.parallel import Parallel
 from biolib.bootstrap import bootstrap_support
 from biolib.common import remove_extension, make_sure_path_exists
 
 from genometreetk.tree_support import TreeSupport
+from genometreetk.fasttree_scheduler import FastTreeScheduler
+from genometreetk.replicate_records import ReplicateRecords, run_signature
 
 
 class JackknifeTaxa(object):
@@ -45,29 +46,36 @@ class JackknifeTaxa(object):
 
         self.cpus = cpus
 
-    def _producer(self, replicated_num):
-        """Infer tree from jackknifed alignments.
+    def _job(self, replicated_num):
+        """Create job inferring tree from jackknifed alignment.
 
         Parameters
         ----------
         replicated_num : int
           Unique replicate number.
+
+        Returns
+        -------
+        FastTreeScheduler.Job
+          Job for inferring replicate tree.
         """
 
-        output_msa = os.path.join(self.replicate_dir, 'jk_taxa.msa.' + str(replicated_num) + '.fna')
-        self.jackknife_taxa(self.msa, self.perc_taxa_to_keep, self.outgroup_ids, output_msa)
+        def write_msa(fout):
+            rng = np.random.RandomState([self.seed, replicated_num])
+            self._write_jackknife_taxa(fout, self.msa, self.perc_taxa_to_keep, self.outgroup_ids, rng, self.ingroup_taxa)
+
+        output_msa = None
+        if self.keep_msa:
+            output_msa = os.path.join(self.replicate_dir, 'jk_taxa.msa.' + str(replicated_num) + '.fna')
 
-        fast_tree = FastTree(multithreaded=False)
         output_tree = os.path.join(self.replicate_dir, 'jk_taxa.tree.' + str(replicated_num) + '.tre')
         fast_tree_output = os.path.join(self.replicate_dir, 'jk_taxa.fasttree.' + str(replicated_num) + '.out')
-        fast_tree.run(output_msa, 'prot', self.model, output_tree, fast_tree_output)
-
-        return True
-
-    def _progress(self, processed_items, total_items):
-        """Report progress of replicates."""
-
-        return '    Processed %d of %d replicates.' % (processed_items, total_items)
+        return FastTreeScheduler.Job(cost=1,
+                                        msa_file=output_msa,
+                                        output_tree=output_tree + '.tmp',
+                                        output_tree_log=fast_tree_output,
+                                        write_msa=write_msa,
+                                        done=lambda: self.replicates.complete(replicated_num, self.seed, output_tree + '.tmp', output_tree))
 
     def jackknife_taxa(self, msa, perc_taxa_to_keep, outgroup_ids, output_file):
         """Jackknife alignment to a subset of taxa.
@@ -84,22 +92,51 @@ class JackknifeTaxa(object):
           File to write bootstrapped alignment.
         """
 
+        fout = open(output_file, 'w')
+        self._write_jackknife_taxa(fout, msa, perc_taxa_to_keep, outgroup_ids)
+        fout.close()
+
+    def _write_jackknife_taxa(self, fout, msa, perc_taxa_to_keep, outgroup_ids, rng=None, ingroup_taxa=None):
+        """Write alignment jackknifed to a subset of taxa.
+
+        Parameters
+        ----------
+        fout : file
+          Output stream for jackknifed alignment.
+        msa : d[seq_id] -> seq
+          Full multiple sequence alignment.
+        perc_taxa_to_keep : float
+          Percentage of marker genes to keep in each replicate.
+        outgroup_ids : set
+          Labels of outgroup taxa.
+        rng : np.random.RandomState
+          Random number generator for selecting taxa.
+        ingroup_taxa : list
+          Sorted labels of ingroup taxa, or None to determine from alignment.
+        """
+
+        if rng is None:
+            rng = np.random
+
         # randomly select ingroup taxa
-        ingroup_taxa = set(msa.keys()) - outgroup_ids
-        taxa_to_keep = random.sample(ingroup_taxa, int(floor(len(ingroup_taxa) * perc_taxa_to_keep)))
+        if ingroup_taxa is None:
+            ingroup_taxa = sorted(set(msa.keys()) - outgroup_ids)
+        num_taxa_to_keep = int(floor(len(ingroup_taxa) * perc_taxa_to_keep))
+        taxa_to_keep = [ingroup_taxa[i] for i in rng.choice(len(ingroup_taxa), num_taxa_to_keep, replace=False)]
 
         taxa_to_keep = set(taxa_to_keep).union(outgroup_ids)
 
-        fout = open(output_file, 'w')
         for seq_id, seq in msa.iteritems():
             if seq_id in taxa_to_keep:
                 fout.write('>' + seq_id + '\n')
                 fout.write(seq + '\n')
-        fout.close()
 
-    def run(self, input_tree, msa_file, outgroup_file, perc_taxa_to_keep, num_replicates, model, output_dir):
+    def run(self, input_tree, msa_file, outgroup_file, perc_taxa_to_keep, num_replicates, model, output_dir, keep_msa=False, seed=None, support_only=False):
         """Jackknife taxa.
 
+        Completed replicates are recorded in the output directory and
+        are not inferred again when a run is restarted with the same seed.
+
         Parameters
         ----------
         input_tree : str
@@ -116,32 +153,58 @@ class JackknifeTaxa(object):
           Desired model of evolution.
         output_dir : str
           input_tree directory for bootstrap trees.
+        keep_msa : bool
+          Flag indicating if alignment of each replicate should be written to disk.
+        seed : int
+          Seed for generating replicates, or None to continue with the seed of
+          completed replicates or select a seed at random.
+        support_only : bool
+          Flag indicating support should be calculated from completed replicates only.
         """
 
         assert(model in ['wag', 'jtt'])
 
         self.perc_taxa_to_keep = perc_taxa_to_keep
+        self.keep_msa = keep_msa
         self.model = model
         self.replicate_dir = os.path.join(output_dir, 'replicates')
-        make_sure_path_exists(self.replicate_dir)
+        make_sure_path_exists(self.replicate_dir)
         # read outgroup taxa
         self.outgroup_ids = set()
         if outgroup_file:
             for line in open(outgroup_file):
                 self.outgroup_ids.add(line.strip())
 
-        # read full multiple sequence alignment
-        self.msa = seq_io.read(msa_file)
+        signature = run_signature((model, perc_taxa_to_keep, tuple(sorted(self.outgroup_ids))),
+                                    (msa_file,))
+        self.replicates = ReplicateRecords(self.replicate_dir, 'jk_taxa', signature)
+        self.seed = self.replicates.seed(seed)
+        completed = self.replicates.completed(self.seed)
+        remaining = [rep_index for rep_index in xrange(num_replicates) if rep_index not in completed]
+        self.logger.info('Generating replicates with seed %d.' % self.seed)
+        if completed:
+            self.logger.info('Found %d completed replicates.' % (num_replicates - len(remaining)))
+
+        if remaining and not support_only:
+            # read full multiple sequence alignment
+            self.msa = seq_io.read(msa_file)
+            self.ingroup_taxa = sorted(set(self.msa.keys()) - self.outgroup_ids)
 
-        # calculate replicates
-        #***self.logger.info('Calculating jackknife taxa replicates:')
-        #***parallel = Parallel(self.cpus)
-        #***parallel.run(self._producer, None, xrange(num_replicates), self._progress)
+            # calculate replicates, sharing cpus among concurrent replicates
+            self.logger.info('Calculating jackknife taxa replicates:')
+            scheduler = FastTreeScheduler(self.cpus)
+            scheduler.run([self._job(rep_index) for rep_index in remaining], 'prot', self.model)
+
+            completed = self.replicates.completed(self.seed)
 
         # calculate support
         rep_tree_files = []
-        for rep_index in xrange(num_replicates):
-            rep_tree_files.append(os.path.join(self.replicate_dir, 'jk_taxa.tree.' + str(rep_index) + '.tre'))
+        for rep_index in sorted(completed):
+            if rep_index < num_replicates:
+                rep_tree_files.append(completed[rep_index])
+
+        if len(rep_tree_files) < num_replicates:
+            self.logger.warning('Only %d of %d replicates are complete.' % (len(rep_tree_files), num_replicates))
 
         tree_support = TreeSupport()
         output_tree = os.path.join(output_dir, remove_extension(input_tree) + '.jk_taxa.tree')
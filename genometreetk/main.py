@@ -48,6 +48,8 @@ from genometreetk.phylogenetic_diversity import PhylogeneticDiversity
 from genometreetk.arb import Arb
 from genometreetk.derep_tree import DereplicateTree
 from genometreetk.assign_genomes import AssignGenomes
+from genometreetk.rep_compare import RepCompare
+from genometreetk.markers.infer_markers import InferMarkers
 
 
 csv.field_size_limit(sys.maxsize)
@@ -194,7 +196,11 @@ class OptionsParser():
                                     options.base_type,
                                     options.fraction,
                                     options.boot_dir,
-                                    options.output_dir)
+                                    options.output_dir,
+                                    options.seed,
+                                    options.keep_msa,
+                                    options.support_only,
+                                    options.tbe)
 
         self.logger.info('Bootstrapped tree written to: %s' % output_tree)
 
@@ -215,7 +221,10 @@ class OptionsParser():
                                                 options.num_replicates,
                                                 options.model,
                                                 options.jk_dir,
-                                                options.output_dir)
+                                                options.output_dir,
+                                                options.keep_msa,
+                                                options.seed,
+                                                options.support_only)
 
         self.logger.info('Jackknifed marker tree written to: %s' % output_tree)
 
@@ -233,7 +242,10 @@ class OptionsParser():
                                             options.perc_taxa,
                                             options.num_replicates,
                                             options.model,
-                                            options.output_dir)
+                                            options.output_dir,
+                                            options.keep_msa,
+                                            options.seed,
+                                            options.support_only)
 
         self.logger.info('Jackknifed taxa tree written to: %s' % output_tree)
 
@@ -473,96 +485,21 @@ class OptionsParser():
         check_file_exists(options.cur_metadata_file)
         check_file_exists(options.prev_metadata_file)
         
-        # get representatives in current taxonomy
-        cur_gids = set()
-        cur_species = set()
-        cur_genera = set()
-        cur_reps_taxa = {}
-        cur_rep_species = set()
-        cur_rep_genera = set()
-        header = True
-        for row in csv.reader(open(options.cur_metadata_file)):
-            if header:
-                header = False
-                gtdb_rep_index = row.index('gtdb_representative')
-                gtdb_taxonomy_index = row.index('gtdb_taxonomy')
-            else:
-                gid = row[0]
-                cur_gids.add(gid)
-                
-                gtdb_taxonomy = row[gtdb_taxonomy_index]
-                if gtdb_taxonomy:
-                    gtdb_taxa = [t.strip() for t in row[gtdb_taxonomy_index].split(';')]
-                    if gtdb_taxa[6] != 's__':
-                        cur_species.add(gtdb_taxa[6])
-                    if gtdb_taxa[5] != 'g__':
-                        cur_genera.add(gtdb_taxa[5])
-
-                if row[gtdb_rep_index] == 't':
-                    cur_reps_taxa[gid] = gtdb_taxa
-                    
-                    if gtdb_taxa[6] != 's__':
-                        cur_rep_species.add(gtdb_taxa[6])
-                        
-                    if gtdb_taxa[5] != 'g__':
-                        cur_rep_genera.add(gtdb_taxa[5])
-                    
-        # get representatives in previous taxonomy
-        prev_reps_taxa = {}
-        prev_rep_species = set()
-        prev_rep_genera = set()
-        header = True
-        for row in csv.reader(open(options.prev_metadata_file)):
-            if header:
-                header = False
-                gtdb_rep_index = row.index('gtdb_representative')
-                gtdb_taxonomy_index = row.index('gtdb_taxonomy')
-            else:
-                if row[gtdb_rep_index] == 't':
-                    gid = row[0]
-                    gtdb_taxonomy = row[gtdb_taxonomy_index]
-                    if gtdb_taxonomy:
-                        gtdb_taxa = [t.strip() for t in row[gtdb_taxonomy_index].split(';')]
-                            
-                        prev_reps_taxa[gid] = gtdb_taxa
-                        
-                        if gtdb_taxa[6] != 's__':
-                            prev_rep_species.add(gtdb_taxa[6])
-                            
-                        if gtdb_taxa[5] != 'g__':
-                            prev_rep_genera.add(gtdb_taxa[5])
-                    
-        # summarize differences
-        print('No. current representatives: %d' % len(cur_reps_taxa))
-        print('No. previous representatives: %d' % len(prev_reps_taxa))
-        
-        print('')
-        print('No. current species with representatives: %d' % len(cur_rep_species))
-        print('No. previous species with representatives: %d' % len(prev_rep_species))
-        
-        print('')
-        print('No. new representatives: %d' % len(set(cur_reps_taxa) - set(prev_reps_taxa)))
-        print('No. retired representatives: %d' % len(set(prev_reps_taxa) - set(cur_reps_taxa)))
-        
-        print('')
-        print('No. new species with representative: %d' % len(cur_rep_species - prev_rep_species))
-        print('No. new genera with representative: %d' % len(cur_rep_genera - prev_rep_genera))
-        
-        print('')
-        missing_sp_reps = prev_rep_species.intersection(cur_species) - cur_rep_species
-        print('No. species that no longer have a representative: %d' % len(missing_sp_reps))
-        for sp in missing_sp_reps:
-            print('  ' + sp)
-        
-        print('')
-        missing_genera_reps = prev_rep_genera.intersection(cur_genera) - cur_rep_genera
-        print('No. genera that no longer have a representative: %d' % len(missing_genera_reps))
-        for g in missing_genera_reps:
-            print('  ' + g)
-        
-        print('')
-        deprecated_reps = set(prev_reps_taxa).intersection(cur_gids) - set(cur_reps_taxa)
-        print('No. deprecated previous representatives: %d' % len(deprecated_reps))
+        rep_compare = RepCompare()
+        rep_compare.run(options.cur_metadata_file, options.prev_metadata_file)
+
+    def marker_sweep(self, options):
+        """Count marker genes meeting combinations of thresholds."""
+
+        check_file_exists(options.gene_count_matrix)
+
+        infer_markers = InferMarkers(None, None, None, 1)
+        infer_markers.threshold_sweep(options.gene_count_matrix,
+                                        options.ubiquity_thresholds,
+                                        options.single_copy_thresholds,
+                                        options.output_file)
+
+        self.logger.info('Marker gene counts written to: %s' % options.output_file)
 
     def fill_ranks(self, options):
         """Ensure taxonomy strings contain all 7 canonical ranks."""
@@ -869,6 +806,8 @@ class OptionsParser():
             self.assign(options)
         elif options.subparser_name == 'rep_compare':
             self.rep_compare(options)
+        elif options.subparser_name == 'marker_sweep':
+            self.marker_sweep(options)
         elif options.subparser_name == 'propagate':
             self.propagate(options)
         elif options.subparser_name == 'fill_ranks':
@@ -17,35 +17,51 @@
 
 import os
 import sys
+import math
+import shutil
+import string
 import multiprocessing as mp
 import logging
 from collections import defaultdict
 
+import numpy as np
+
 import biolib.seq_io as seq_io
 from biolib.external.hmmer import HMMER
 
 from genometreetk.default_values import DefaultValues
+from genometreetk.markers.tophit_index import TopHitIndex
 
 
 class AlignMarkers(object):
     """Align genes to HMM."""
 
-    def __init__(self, cpus):
+    def __init__(self, cpus, tophit_index_file=None):
         """Initialize.
 
         Parameters
         ----------
         cpus : int
             Number of cpus to use.
+        tophit_index_file : str
+            File used to persist the index of top hits in each genome.
         """
 
         self.logger = logging.getLogger()
 
         self.cpus = cpus
+        self.tophit_index_file = tophit_index_file
 
         self.protein_file_ext = DefaultValues.PROTEIN_FILE_EXTENSION
-        self.pfam_extension = DefaultValues.PFAM_EXTENSION
-        self.tigr_extension = DefaultValues.TIGR_EXTENSION
+
+        self.protein_store_file = 'marker_genes.store'
+
+        # minimum number of sequences to align in a chunk of a marker gene
+        self.min_chunk_size = 1000
+
+        # translation from STOCKHOLM to uppercase FASTA alignment characters
+        self.stockholm_to_fasta = string.maketrans(string.ascii_lowercase + '.',
+                                                    string.ascii_uppercase + '-')
 
     def _genes_in_genomes(self, genome_ids, genome_dirs):
         """Get genes within genomes.
@@ -63,50 +79,11 @@ class AlignMarkers(object):
             Genes within each genome.
         """
 
-        genes_in_genome = {}
-        for genome_id in genome_ids:
-            genome_dir = genome_dirs[genome_id]
+        tophit_index = TopHitIndex(self.cpus)
+        return tophit_index.genes_in_genomes(genome_ids, genome_dirs, self.tophit_index_file)
 
-            marker_id_to_gene_id = defaultdict(list)
-
-            assembly = genome_dir[genome_dir.rfind('/') + 1:]
-            tophit_file = os.path.join(genome_dir, assembly + self.pfam_extension)
-            with open(tophit_file) as f:
-                f.readline()
-                for line in f:
-                    line_split = line.split('\t')
-
-                    gene_id = line_split[0]
-                    hits = line_split[1].split(';')
-                    for hit in hits:
-                        pfam_id, _evalue, bitscore = hit.split(',')
-                        marker_id_to_gene_id[pfam_id].append((gene_id, float(bitscore)))
-
-            tophit_file = os.path.join(genome_dir, assembly + self.tigr_extension)
-            with open(tophit_file) as f:
-                f.readline()
-                for line in f:
-                    line_split = line.split('\t')
-
-                    gene_id = line_split[0]
-                    hits = line_split[1].split(';')
-                    for hit in hits:
-                        tigrfam_id, _evalue, bitscore = hit.split(',')
-                        marker_id_to_gene_id[tigrfam_id].append((gene_id, float(bitscore)))
-
-            genes_in_genome[genome_id] = marker_id_to_gene_id
-
-        return genes_in_genome
-
-    def _run_hmm_align(self, genome_ids,
-                                genome_dirs,
-                                genes_in_genomes,
-                                ignore_multi_copy,
-                                output_msa_dir,
-                                output_model_dir,
-                                queue_in,
-                                queue_out):
-        """Run each marker gene in a separate thread.
+    def _marker_hits(self, genome_ids, genes_in_genomes, marker_genes, ignore_multi_copy):
+        """Determine gene to align from each genome for each marker.
 
         Only the gene with the highest bitscore is used for genomes with
         multiple hits to a given protein family.
@@ -115,73 +92,361 @@ class AlignMarkers(object):
         ----------
         genome_ids : iterable
             Genomes of interest.
-        genome_dirs : d[assembly_accession] -> directory
-            Path to files for individual genomes.
         genes_in_genomes : d[genome_id][family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
             Genes within each genome.
+        marker_genes : iterable
+            Unique ids of marker genes to align.
         ignore_multi_copy : bool
             Flag indicating if genes with multiple hits should be ignored (True) or the gene with the highest bitscore taken (False).
+
+        Returns
+        -------
+        d[marker_id] -> [(genome_id, gene_id), ...]
+            Gene to align from each genome, in the order genomes were given.
+        """
+
+        marker_hits = {}
+        for marker_id in marker_genes:
+            marker_hits[marker_id] = []
+
+        for genome_id in genome_ids:
+            genes_in_genome = genes_in_genomes[genome_id]
+            for marker_id in marker_genes:
+                hits = genes_in_genome.get(marker_id, None)
+                if not hits or (ignore_multi_copy and len(hits) > 1):
+                    continue
+
+                # get gene with highest bitscore
+                gene_id, _bitscore = max(hits, key=lambda x: x[1])
+                marker_hits[marker_id].append((genome_id, gene_id))
+
+        return marker_hits
+
+    def _build_protein_store(self, genome_ids, genome_dirs, marker_hits, store_file):
+        """Pack sequences of all marker hits into a single indexed file.
+
+        Each protein file is read exactly once and only the genes hit by
+        a marker are retained. Records are written in FASTA format so they
+        can be copied directly into the per-marker sequence files.
+
+        Parameters
+        ----------
+        genome_ids : iterable
+            Genomes of interest.
+        genome_dirs : d[assembly_accession] -> directory
+            Path to files for individual genomes.
+        marker_hits : d[marker_id] -> [(genome_id, gene_id), ...]
+            Gene to align from each genome for each marker.
+        store_file : str
+            File to hold sequences of marker hits.
+
+        Returns
+        -------
+        d[(genome_id, gene_id)] -> (offset, length)
+            Byte offset and length of each FASTA record in the store.
+        """
+
+        genes_to_store = defaultdict(set)
+        for hits in marker_hits.itervalues():
+            for genome_id, gene_id in hits:
+                genes_to_store[genome_id].add(gene_id)
+
+        store_index = {}
+        offset = 0
+        fout = open(store_file, 'wb')
+        for genome_id in genome_ids:
+            gene_ids = genes_to_store.get(genome_id, None)
+            if not gene_ids:
+                continue
+
+            genome_dir = genome_dirs[genome_id]
+            assembly = genome_dir[genome_dir.rfind('/') + 1:]
+            genes_file = os.path.join(genome_dir, assembly + self.protein_file_ext)
+            for gene_id, seq in seq_io.read_fasta_seq(genes_file):
+                if gene_id not in gene_ids:
+                    continue
+
+                record = '>' + genome_id + DefaultValues.SEQ_CONCAT_CHAR + gene_id + '\n' + seq + '\n'
+                fout.write(record)
+                store_index[(genome_id, gene_id)] = (offset, len(record))
+                offset += len(record)
+        fout.close()
+
+        return store_index
+
+    def _model_length(self, model_file):
+        """Get number of match states in HMM."""
+
+        for line in open(model_file):
+            if line.startswith('LENG'):
+                return int(line.split()[1])
+
+        return 0
+
+    def _alignment_jobs(self, marker_hits, output_model_dir):
+        """Split marker genes into alignment jobs ordered by estimated cost.
+
+        The cost of aligning a marker gene is estimated as the number of
+        sequences to align times the length of its HMM. Marker genes whose
+        cost exceeds a fair share of the total cost are split into chunks
+        which are aligned independently.
+
+        Parameters
+        ----------
+        marker_hits : d[marker_id] -> [(genome_id, gene_id), ...]
+            Gene to align from each genome for each marker.
+        output_model_dir : str
+            Directory containing HMMs.
+
+        Returns
+        -------
+        list
+            Alignment jobs (marker_id, job_prefix, start, end) from most to least costly.
+        d[marker_id] -> [job_prefix_1, ..., job_prefix_N]
+            Chunks of marker genes split across multiple jobs.
+        """
+
+        model_length = {}
+        for marker_id in marker_hits:
+            model_length[marker_id] = self._model_length(os.path.join(output_model_dir, marker_id + '.hmm'))
+
+        total_cost = sum(len(hits) * model_length[marker_id] for marker_id, hits in marker_hits.iteritems())
+        max_job_cost = max(float(total_cost) / self.cpus, 1)
+
+        jobs = []
+        chunked_markers = {}
+        for marker_id, hits in marker_hits.iteritems():
+            cost = len(hits) * model_length[marker_id]
+            num_chunks = min(int(math.ceil(cost / max_job_cost)), len(hits) // self.min_chunk_size)
+            if num_chunks <= 1:
+                jobs.append((cost, (marker_id, marker_id, 0, len(hits))))
+                continue
+
+            chunked_markers[marker_id] = []
+            for i in xrange(num_chunks):
+                start = len(hits) * i // num_chunks
+                end = len(hits) * (i + 1) // num_chunks
+                job_prefix = marker_id + '.chunk_%d' % i
+                jobs.append(((end - start) * model_length[marker_id], (marker_id, job_prefix, start, end)))
+                chunked_markers[marker_id].append(job_prefix)
+
+        jobs.sort(key=lambda x: x[0], reverse=True)
+
+        return [job for _cost, job in jobs], chunked_markers
+
+    def _read_stockholm(self, input_file):
+        """Read alignment in STOCKHOLM format produced by HMMER.
+
+        Parameters
+        ----------
+        input_file : str
+            Input sequence file in STOCKHOLM format.
+
+        Returns
+        -------
+        list
+            Identifiers of aligned sequences.
+        list
+            Aligned sequences.
+        d[seq_id] -> posterior probabilities
+            Posterior probability annotation of each sequence.
+        str
+            Reference annotation indicating columns covered by the model.
+        """
+
+        seq_ids = []
+        seqs = []
+        post_probs = {}
+        mask = None
+        for line in open(input_file):
+            line = line.rstrip()
+            if line == '' or line[0] == '#' or line == '//':
+                if 'GC RF' in line:
+                    mask = line.split('GC RF')[1].strip()
+                elif line.startswith('#=GR'):
+                    line_split = line.split()
+                    if line_split[2] == 'PP':
+                        post_probs[line_split[1]] = line_split[3]
+                continue
+            else:
+                line_split = line.split()
+                seq_ids.append(line_split[0])
+                seqs.append(line_split[1])
+
+        return seq_ids, seqs, post_probs, mask
+
+    def _merge_stockholm(self, input_files, output_file):
+        """Merge STOCKHOLM alignments of sequences against the same HMM.
+
+        Columns covered by the model are shared by all alignments, while
+        the number of insert columns preceding each of these columns can
+        differ between alignments. Each run of insert columns is padded
+        to the longest run in any alignment, with inserted residues
+        placed at the start of the run.
+
+        Parameters
+        ----------
+        input_files : list
+            Input sequence files in STOCKHOLM format.
+        output_file : str
+            Output sequence file in STOCKHOLM format.
+        """
+
+        alignments = [self._read_stockholm(input_file) for input_file in input_files]
+
+        # number of insert columns preceding each model column,
+        # with the last entry giving trailing insert columns
+        insert_counts = []
+        for _seq_ids, _seqs, _post_probs, mask in alignments:
+            match_cols = np.flatnonzero(np.frombuffer(mask, dtype=np.uint8) == ord('x'))
+            insert_counts.append(np.diff(np.concatenate(([-1], match_cols, [len(mask)]))) - 1)
+
+        merged_insert_counts = np.max(insert_counts, axis=0)
+        merged_starts = np.concatenate(([0], np.cumsum(merged_insert_counts + 1)[:-1]))
+        merged_len = merged_insert_counts.sum() + len(merged_insert_counts) - 1
+
+        seq_ids = []
+        seqs = []
+        post_probs = []
+        for (chunk_seq_ids, chunk_seqs, chunk_post_probs, mask), counts in zip(alignments, insert_counts):
+            if not chunk_seqs:
+                continue
+
+            # map each column to its position in the merged alignment
+            is_match = np.frombuffer(mask, dtype=np.uint8) == ord('x')
+            segment = np.cumsum(is_match) - is_match
+            starts = np.concatenate(([0], np.cumsum(counts + 1)[:-1]))
+            offset = np.where(is_match, merged_insert_counts[segment], np.arange(len(mask)) - starts[segment])
+            cols = merged_starts[segment] + offset
+
+            aln = np.empty((len(chunk_seqs), merged_len), dtype=np.uint8)
+            aln.fill(ord('.'))
+            aln[:, cols] = np.frombuffer(''.join(chunk_seqs), dtype=np.uint8).reshape(len(chunk_seqs), len(mask))
+
+            pp = np.empty((len(chunk_seqs), merged_len), dtype=np.uint8)
+            pp.fill(ord('.'))
+            pp[:, cols] = np.frombuffer(''.join(chunk_post_probs.get(seq_id, '.' * len(mask)) for seq_id in chunk_seq_ids),
+                                        dtype=np.uint8).reshape(len(chunk_seqs), len(mask))
+
+            seq_ids.extend(chunk_seq_ids)
+            seqs.extend(row.tostring() for row in aln)
+            post_probs.extend(row.tostring() for row in pp)
+
+        merged_mask = np.empty(merged_len, dtype=np.uint8)
+        merged_mask.fill(ord('.'))
+        merged_mask[merged_starts[:-1] + merged_insert_counts[:-1]] = ord('x')
+
+        labels = seq_ids + ['#=GR %s PP' % seq_id for seq_id in seq_ids] + ['#=GC RF']
+        width = max(len(label) for label in labels) + 1
+
+        fout = open(output_file, 'w')
+        fout.write('# STOCKHOLM 1.0\n\n')
+        for seq_id, seq, pp in zip(seq_ids, seqs, post_probs):
+            fout.write(seq_id.ljust(width) + seq + '\n')
+            fout.write(('#=GR %s PP' % seq_id).ljust(width) + pp + '\n')
+        fout.write('#=GC RF'.ljust(width) + merged_mask.tostring() + '\n')
+        fout.write('//\n')
+        fout.close()
+
+    def _merge_chunks(self, chunked_markers, output_msa_dir):
+        """Merge sequences and alignments of chunked marker genes.
+
+        Masked alignments only contain columns modelled by the HMM so the
+        alignments of each chunk can be concatenated directly. The STOCKHOLM
+        alignments of individual chunks are merged by padding insert columns.
+
+        Parameters
+        ----------
+        chunked_markers : d[marker_id] -> [job_prefix_1, ..., job_prefix_N]
+            Chunks of marker genes split across multiple jobs.
+        output_msa_dir : str
+            Output directory for multiple sequence alignments.
+        """
+
+        for marker_id, job_prefixes in chunked_markers.iteritems():
+            for ext in ['.faa', '.aln.masked.faa']:
+                fout = open(os.path.join(output_msa_dir, marker_id + ext), 'w')
+                for job_prefix in job_prefixes:
+                    with open(os.path.join(output_msa_dir, job_prefix + ext)) as f:
+                        shutil.copyfileobj(f, fout)
+                fout.close()
+
+            self._merge_stockholm([os.path.join(output_msa_dir, job_prefix + '.aln.faa') for job_prefix in job_prefixes],
+                                    os.path.join(output_msa_dir, marker_id + '.aln.faa'))
+
+            for job_prefix in job_prefixes:
+                for ext in ['.faa', '.aln.faa', '.aln.masked.faa']:
+                    os.remove(os.path.join(output_msa_dir, job_prefix + ext))
+
+    def _run_hmm_align(self, marker_hits,
+                                store_file,
+                                store_index,
+                                output_msa_dir,
+                                output_model_dir,
+                                queue_in,
+                                queue_out):
+        """Run each alignment job in a separate thread.
+
+        Parameters
+        ----------
+        marker_hits : d[marker_id] -> [(genome_id, gene_id), ...]
+            Gene to align from each genome for each marker.
+        store_file : str
+            File holding sequences of marker hits.
+        store_index : d[(genome_id, gene_id)] -> (offset, length)
+            Byte offset and length of each FASTA record in the store.
         output_msa_dir : str
             Output directory for multiple sequence alignment.
         output_model_dir : str
             Output directory for HMMs.
         queue_in : Queue
-            Input queue for parallel processing.
+            Input queue of alignment jobs (marker_id, job_prefix, start, end).
         queue_out : Queue
             Output queue for parallel processing.
         """
 
+        store = open(store_file, 'rb')
         while True:
-            marker_id = queue_in.get(block=True, timeout=None)
-            if marker_id == None:
+            job = queue_in.get(block=True, timeout=None)
+            if job == None:
                 break
 
-            marker_seq_file = os.path.join(output_msa_dir, marker_id + '.faa')
-            fout = open(marker_seq_file, 'w')
-            for genome_id in genome_ids:
-                genome_dir = genome_dirs[genome_id]
-
-                assembly = genome_dir[genome_dir.rfind('/') + 1:]
-                genes_file = os.path.join(genome_dir, assembly + self.protein_file_ext)
-                seqs = seq_io.read_fasta(genes_file)
-
-                hits = genes_in_genomes[genome_id].get(marker_id, None)
-                if not hits or (ignore_multi_copy and len(hits) > 1):
-                    continue
-
-                # get gene with highest bitscore
-                hits.sort(key=lambda x: x[1], reverse=True)
-                gene_id, _bitscore = hits[0]
+            marker_id, job_prefix, start, end = job
 
-                fout.write('>' + genome_id + DefaultValues.SEQ_CONCAT_CHAR + gene_id + '\n')
-                fout.write(seqs[gene_id] + '\n')
+            marker_seq_file = os.path.join(output_msa_dir, job_prefix + '.faa')
+            fout = open(marker_seq_file, 'w')
+            for hit in marker_hits[marker_id][start:end]:
+                offset, length = store_index[hit]
+                store.seek(offset)
+                fout.write(store.read(length))
             fout.close()
 
             hmmer = HMMER('align')
-            hmmer.align(os.path.join(output_model_dir, marker_id + '.hmm'), marker_seq_file, os.path.join(output_msa_dir, marker_id + '.aln.faa'), trim=False, outputFormat='Pfam')
-            self._mask_alignment(os.path.join(output_msa_dir, marker_id + '.aln.faa'), os.path.join(output_msa_dir, marker_id + '.aln.masked.faa'))
+            hmmer.align(os.path.join(output_model_dir, marker_id + '.hmm'), marker_seq_file, os.path.join(output_msa_dir, job_prefix + '.aln.faa'), trim=False, outputFormat='Pfam')
+            self._mask_alignment(os.path.join(output_msa_dir, job_prefix + '.aln.faa'), os.path.join(output_msa_dir, job_prefix + '.aln.masked.faa'))
 
-            queue_out.put(marker_id)
+            queue_out.put(job_prefix)
+        store.close()
 
-    def _report_threads(self, num_genes, writer_queue):
+    def _report_threads(self, num_jobs, writer_queue):
         """Report progress of parallel processing.
 
         Parameters
         ----------
-        num_genes : int
-            Number of genes being processed.
+        num_jobs : int
+            Number of alignment jobs being processed.
         writer_queue : Queue
             Output queue for parallel processing.
         """
 
-        num_processed_genes = 0
+        num_processed_jobs = 0
         while True:
-            marker_id = writer_queue.get(block=True, timeout=None)
-            if marker_id == None:
+            job_prefix = writer_queue.get(block=True, timeout=None)
+            if job_prefix == None:
                 break
 
-            num_processed_genes += 1
-            statusStr = '==> Finished processing %d of %d (%.2f%%) marker genes.' % (num_processed_genes, num_genes, float(num_processed_genes) * 100 / num_genes)
+            num_processed_jobs += 1
+            statusStr = '==> Finished processing %d of %d (%.2f%%) alignment jobs.' % (num_processed_jobs, num_jobs, float(num_processed_jobs) * 100 / num_jobs)
             sys.stdout.write('%s\r' % statusStr)
             sys.stdout.flush()
 
@@ -198,25 +463,20 @@ class AlignMarkers(object):
             Output sequence file in FASTA format.
         """
 
-        # read STOCKHOLM alignment
-        seqs = {}
-        for line in open(input_file):
-            line = line.rstrip()
-            if line == '' or line[0] == '#' or line == '//':
-                if 'GC RF' in line:
-                    mask = line.split('GC RF')[1].strip()
-                continue
-            else:
-                line_split = line.split()
-                seqs[line_split[0]] = line_split[1].upper().replace('.', '-').strip()
+        seq_ids, seqs, _post_probs, mask = self._read_stockholm(input_file)
 
-        # output masked sequences in FASTA format
         fout = open(output_file, 'w')
-        for seq_id, seq in seqs.iteritems():
-            fout.write('>' + seq_id + '\n')
-
-            masked_seq = ''.join([seq[i] for i in xrange(0, len(seq)) if mask[i] == 'x'])
-            fout.write(masked_seq + '\n')
+        if seqs:
+            # convert alignment into a byte matrix with one row per sequence
+            # and select columns covered by the model
+            aln = np.frombuffer(''.join(seqs).translate(self.stockholm_to_fasta), dtype=np.uint8)
+            aln = aln.reshape(len(seqs), len(mask))
+            masked_aln = aln[:, np.frombuffer(mask, dtype=np.uint8) == ord('x')]
+
+            # output masked sequences in FASTA format
+            for seq_id, masked_seq in zip(seq_ids, masked_aln):
+                fout.write('>' + seq_id + '\n')
+                fout.write(masked_seq.tostring() + '\n')
         fout.close()
 
     def run(self, genome_ids, genome_dirs, marker_genes, ignore_multi_copy, output_msa_dir, output_model_dir):
@@ -241,28 +501,34 @@ class AlignMarkers(object):
         # get mapping of marker ids to gene ids for each genome
         self.logger.info('Determining genes in genomes of interest.')
         genes_in_genomes = self._genes_in_genomes(genome_ids, genome_dirs)
+        marker_hits = self._marker_hits(genome_ids, genes_in_genomes, marker_genes, ignore_multi_copy)
+
+        # read each protein file once, retaining only genes to be aligned
+        self.logger.info('Indexing sequences of marker genes.')
+        store_file = os.path.join(output_msa_dir, self.protein_store_file)
+        store_index = self._build_protein_store(genome_ids, genome_dirs, marker_hits, store_file)
 
         # align marker genes
         self.logger.info('Aligning marker genes:')
         worker_queue = mp.Queue()
         writer_queue = mp.Queue()
 
-        for _, marker_id in enumerate(marker_genes):
-            worker_queue.put(marker_id)
+        jobs, chunked_markers = self._alignment_jobs(marker_hits, output_model_dir)
+        for job in jobs:
+            worker_queue.put(job)
 
         for _ in range(self.cpus):
             worker_queue.put(None)
 
         try:
-            calc_proc = [mp.Process(target=self._run_hmm_align, args=(genome_ids,
-                                                                      genome_dirs,
-                                                                      genes_in_genomes,
-                                                                      ignore_multi_copy,
+            calc_proc = [mp.Process(target=self._run_hmm_align, args=(marker_hits,
+                                                                      store_file,
+                                                                      store_index,
                                                                       output_msa_dir,
                                                                       output_model_dir,
                                                                       worker_queue,
                                                                       writer_queue)) for _ in range(self.cpus)]
-            write_proc = mp.Process(target=self._report_threads, args=(len(marker_genes), writer_queue))
+            write_proc = mp.Process(target=self._report_threads, args=(len(jobs), writer_queue))
 
             write_proc.start()
 
@@ -274,6 +540,10 @@ class AlignMarkers(object):
 
             writer_queue.put(None)
             write_proc.join()
+
+            os.remove(store_file)
+
+            self._merge_chunks(chunked_markers, output_msa_dir)
         except:
             for p in calc_proc:
                 p.terminate()
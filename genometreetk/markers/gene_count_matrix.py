@@ -0,0 +1,157 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import numpy as np
+
+
+class GeneCountMatrix(object):
+    """Sparse count matrix of genes hit by each protein family in each genome.
+
+    The matrix is stored in coordinate format with one entry for
+    each family and genome pair where the family hits at least one
+    gene. Rows correspond to protein families and columns to genomes.
+    """
+
+    def __init__(self, markers, genomes, rows, cols, counts):
+        """Initialization.
+
+        Parameters
+        ----------
+        markers : list
+            Protein family of each row.
+        genomes : list
+            Genome of each column.
+        rows : array
+            Row of each non-zero entry.
+        cols : array
+            Column of each non-zero entry.
+        counts : array
+            Number of genes hit in each non-zero entry.
+        """
+
+        self.markers = list(markers)
+        self.genomes = list(genomes)
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.int32)
+
+    @classmethod
+    def from_table(cls, genome_ids, gene_count_table):
+        """Build matrix from table of genes hit by each protein family.
+
+        Parameters
+        ----------
+        genome_ids : iterable
+            Genomes of interest.
+        gene_count_table : d[family_id][genome_id] -> set([gene_id_1, ..., gene_id_N])
+            Gene location of protein families within each genome.
+        """
+
+        genomes = sorted(genome_ids)
+        genome_index = dict((genome_id, i) for i, genome_id in enumerate(genomes))
+        markers = sorted(gene_count_table)
+
+        rows = []
+        cols = []
+        counts = []
+        for row, marker_id in enumerate(markers):
+            for genome_id, gene_ids in gene_count_table[marker_id].iteritems():
+                col = genome_index.get(genome_id, None)
+                if col is None or not gene_ids:
+                    continue
+
+                rows.append(row)
+                cols.append(col)
+                counts.append(len(gene_ids))
+
+        return cls(markers, genomes, rows, cols, counts)
+
+    @classmethod
+    def load(cls, matrix_file):
+        """Load matrix written by save()."""
+
+        data = np.load(matrix_file)
+        return cls(data['markers'].tolist(),
+                    data['genomes'].tolist(),
+                    data['rows'],
+                    data['cols'],
+                    data['counts'])
+
+    def save(self, matrix_file):
+        """Save matrix in NumPy's compressed format."""
+
+        with open(matrix_file, 'wb') as f:
+            np.savez_compressed(f,
+                                markers=np.array(self.markers, dtype=str),
+                                genomes=np.array(self.genomes, dtype=str),
+                                rows=self.rows,
+                                cols=self.cols,
+                                counts=self.counts)
+
+    def ubiquity(self):
+        """Number of genomes containing each protein family."""
+
+        return np.bincount(self.rows, minlength=len(self.markers))
+
+    def single_copy(self):
+        """Number of genomes with a single copy of each protein family."""
+
+        return np.bincount(self.rows[self.counts == 1], minlength=len(self.markers))
+
+    def passing(self, ubiquity_threshold, single_copy_threshold):
+        """Identify protein families meeting ubiquity and single-copy thresholds.
+
+        Returns
+        -------
+        array
+            Boolean mask indicating families meeting both thresholds.
+        """
+
+        ubiquity = self.ubiquity()
+        single_copy = self.single_copy()
+
+        return ((ubiquity >= ubiquity_threshold * len(self.genomes))
+                & (single_copy >= single_copy_threshold * ubiquity))
+
+    def sweep(self, ubiquity_thresholds, single_copy_thresholds):
+        """Count protein families meeting each combination of thresholds.
+
+        Parameters
+        ----------
+        ubiquity_thresholds : iterable
+            Thresholds for defining ubiquitous marker genes [0, 1].
+        single_copy_thresholds : iterable
+            Thresholds for defining single-copy marker genes [0, 1].
+
+        Returns
+        -------
+        array
+            Number of families passing each ubiquity (rows) and single-copy (columns) threshold.
+        """
+
+        ubiquity = self.ubiquity()
+        single_copy = self.single_copy()
+
+        ut = np.asarray(ubiquity_thresholds, dtype=float)[:, np.newaxis]
+        st = np.asarray(single_copy_thresholds, dtype=float)[:, np.newaxis]
+
+        # families x thresholds for each criterion, then count families
+        # passing both criteria for every pair of thresholds
+        u_pass = (ubiquity >= ut * len(self.genomes)).astype(np.int32)
+        s_pass = (single_copy >= st * ubiquity).astype(np.int32)
+
+        return np.dot(u_pass, s_pass.T)
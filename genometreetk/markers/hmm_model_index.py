@@ -0,0 +1,147 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import sys
+import logging
+
+from genometreetk.common import (file_signature,
+                                load_signed_cache,
+                                save_signed_cache)
+
+
+HMM_MODEL_INDEX_EXT = '.model_index.pkl'
+
+
+class HmmModelIndex(object):
+    """Byte-offset index of models within HMMER3 model libraries.
+
+    Models can be looked up by either their name or accession. The index
+    of a library can be persisted alongside the library and is considered
+    valid as long as the size and modification time of the library are
+    unchanged.
+    """
+
+    def __init__(self):
+        """Initialization."""
+
+        self.logger = logging.getLogger()
+
+        self.indices = {}
+
+    def _build_index(self, hmm_file):
+        """Determine byte offset and length of each model in HMM library.
+
+        Parameters
+        ----------
+        hmm_file : str
+            HMMER3 model library.
+
+        Returns
+        -------
+        d[name or accession] -> (offset, length)
+            Location of each model in the library.
+        """
+
+        index = {}
+        offset = 0
+        model_start = 0
+        model_ids = []
+        with open(hmm_file, 'rb') as f:
+            for line in f:
+                if line.startswith('HMMER'):
+                    model_start = offset
+                    model_ids = []
+                elif line.startswith('NAME ') or line.startswith('ACC '):
+                    model_ids.append(line.split()[1])
+                elif line.startswith('//'):
+                    for model_id in model_ids:
+                        index[model_id] = (model_start, offset + len(line) - model_start)
+
+                offset += len(line)
+
+        return index
+
+    def index(self, hmm_file, persist=True):
+        """Get index of HMM library.
+
+        Parameters
+        ----------
+        hmm_file : str
+            HMMER3 model library.
+        persist : bool
+            Flag indicating if index should be read from, and written to, disk.
+
+        Returns
+        -------
+        d[name or accession] -> (offset, length)
+            Location of each model in the library.
+        """
+
+        if hmm_file in self.indices:
+            return self.indices[hmm_file]
+
+        if not persist:
+            self.indices[hmm_file] = self._build_index(hmm_file)
+            return self.indices[hmm_file]
+
+        index_file = hmm_file + HMM_MODEL_INDEX_EXT
+        signature = file_signature(hmm_file)
+
+        index = load_signed_cache(index_file, signature)
+        if index is not None:
+            self.indices[hmm_file] = index
+            return index
+
+        if os.path.exists(index_file):
+            self.logger.info('Model index for %s is out of date.' % hmm_file)
+
+        index = self._build_index(hmm_file)
+        self.indices[hmm_file] = index
+
+        if not save_signed_cache(index_file, signature, index):
+            self.logger.warning('Unable to write model index for %s.' % hmm_file)
+
+        return index
+
+    def fetch(self, hmm_file, model_id, persist=True):
+        """Get model from HMM library.
+
+        Parameters
+        ----------
+        hmm_file : str
+            HMMER3 model library.
+        model_id : str
+            Name or accession of model.
+        persist : bool
+            Flag indicating if index of library should be persisted.
+
+        Returns
+        -------
+        str
+            Model in HMMER3 format.
+        """
+
+        location = self.index(hmm_file, persist).get(model_id, None)
+        if not location:
+            self.logger.error('Model %s not found in %s.' % (model_id, hmm_file))
+            sys.exit(-1)
+
+        offset, length = location
+        with open(hmm_file, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
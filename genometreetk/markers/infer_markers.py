@@ -17,18 +17,20 @@
 
 import os
 import sys
-import shutil
 import logging
-import ntpath
+from itertools import combinations
 from collections import defaultdict
 
 from genometreetk.default_values import DefaultValues
 from genometreetk.markers.align_markers import AlignMarkers
+from genometreetk.markers.tophit_index import TopHitIndex
+from genometreetk.markers.gene_count_matrix import GeneCountMatrix
+from genometreetk.markers.hmm_model_index import HmmModelIndex
 from genometreetk.common import read_genome_id_file, read_genome_dir_file
-
-from biolib.external.fasttree import FastTree
+from genometreetk.fasttree_scheduler import FastTreeScheduler
 
 import dendropy
+import numpy as np
 
 import pickle  # ***
 
@@ -66,41 +68,9 @@ class InferMarkers(object):
         self.cpus = cpus
 
         self.protein_file_ext = DefaultValues.PROTEIN_FILE_EXTENSION
-        self.pfam_extension = DefaultValues.PFAM_EXTENSION
-        self.tigr_extension = DefaultValues.TIGR_EXTENSION
-
-    def _read_gene_hits(self, table, genome_ids, genome_dirs, extension):
-        """Read gene annotations from top hit file.
-
-        Parameters
-        ----------
-        table : defaultdict(lambda: defaultdict(set))
-            Table to populate with gene information.
-        genome_ids : iterable
-            Genomes of interest.
-        genome_dirs : d[assembly_accession] -> directory
-            Path to files for individual genomes.
-        extension : str
-            Extension of file containing top hits to each gene.
-        """
-
-        for genome_id in genome_ids:
-            genome_dir = genome_dirs[genome_id]
-
-            assembly = genome_dir[genome_dir.rfind('/') + 1:]
-            tophit_file = os.path.join(genome_dir, assembly + extension)
-
-            with open(tophit_file) as f:
-                f.readline()
-
-                for line in f:
-                    line_split = line.split('\t')
-
-                    gene_id = line_split[0]
-                    hits = line_split[1].split(';')
-                    for hit in hits:
-                        protein_family, _evalue, _bitscore = hit.split(',')
-                        table[protein_family][genome_id].add(gene_id)
+        self.tophit_index_file = None
+        if genome_dir_file:
+            self.tophit_index_file = genome_dir_file + DefaultValues.TOPHIT_INDEX_EXTENSION
 
     def _gene_count_table(self, genome_ids, genome_dirs):
         """Get Pfam and TIGRFAMs annotations for genomes.
@@ -118,21 +88,23 @@ class InferMarkers(object):
             Gene location of protein families within each genome.
         """
 
+        tophit_index = TopHitIndex(self.cpus)
+        genes_in_genomes = tophit_index.genes_in_genomes(genome_ids, genome_dirs, self.tophit_index_file)
+
         table = defaultdict(lambda: defaultdict(set))
-        self._read_gene_hits(table, genome_ids, genome_dirs, self.pfam_extension)
-        self._read_gene_hits(table, genome_ids, genome_dirs, self.tigr_extension)
+        for genome_id, marker_id_to_gene_id in genes_in_genomes.iteritems():
+            for protein_family, hits in marker_id_to_gene_id.iteritems():
+                table[protein_family][genome_id].update(gene_id for gene_id, _bitscore in hits)
 
         return table
 
-    def _marker_genes(self, genome_ids, gene_count_table, ubiquity_threshold, single_copy_threshold, output_file):
+    def _marker_genes(self, gene_count_matrix, ubiquity_threshold, single_copy_threshold, output_file):
         """Identify genes meeting ubiquity and single-copy thresholds.
 
         Parameters
         ----------
-        genome_ids : iterable
-            Genomes of interest.
-        gene_count_table : d[family_id][genome_id] -> set([gene_id_1, ..., gene_id_N])
-            Gene location of protein families within each genome.
+        gene_count_matrix : GeneCountMatrix
+            Number of genes hit by each protein family within each genome.
         ubiquity_threshold : float
             Threshold for defining a ubiquitous marker genes [0, 1].
         single_copy_threshold : float
@@ -150,34 +122,61 @@ class InferMarkers(object):
             self.logger.error('Ubiquity or single-copy threshold is invalid: %f, %f' % (ubiquity_threshold, single_copy_threshold))
             sys.exit(0)
 
+        ubiquity = gene_count_matrix.ubiquity()
+        single_copy = gene_count_matrix.single_copy()
+        u = ubiquity * 100.0 / len(gene_count_matrix.genomes)
+        s = single_copy * 100.0 / np.maximum(ubiquity, 1)
+
+        # find genes meeting ubiquity and single-copy thresholds
+        passing = gene_count_matrix.passing(ubiquity_threshold, single_copy_threshold)
+
         fout = open(output_file, 'w')
         fout.write('Model accession\tUbiquity\tSingle copy\n')
 
-        # find genes meeting ubiquity and single-copy thresholds
         markers = {}
-        for protein_family, genes_in_genomes in gene_count_table.iteritems():
-            ubiquity = 0
-            single_copy = 0
+        for i, protein_family in enumerate(gene_count_matrix.markers):
+            fout.write('%s\t%.1f\t%.1f\n' % (protein_family, u[i], s[i]))
+
+            if passing[i]:
+                markers[protein_family] = (u[i], s[i])
+
+        fout.close()
+
+        return markers
 
-            for genome_id in genome_ids:
-                count = len(genes_in_genomes.get(genome_id, []))
+    def threshold_sweep(self, gene_count_matrix_file, ubiquity_thresholds, single_copy_thresholds, output_file):
+        """Report number of marker genes meeting combinations of thresholds.
 
-                if count > 0:
-                    ubiquity += 1
+        Parameters
+        ----------
+        gene_count_matrix_file : str
+            Gene count matrix saved by identify_marker_genes().
+        ubiquity_thresholds : iterable
+            Thresholds for defining ubiquitous marker genes [0, 1].
+        single_copy_thresholds : iterable
+            Thresholds for defining single-copy marker genes [0, 1].
+        output_file : str
+            Output file indicating number of marker genes for each pair of thresholds.
 
-                if count == 1:
-                    single_copy += 1
+        Returns
+        -------
+        array
+            Number of marker genes for each ubiquity (rows) and single-copy (columns) threshold.
+        """
 
-            u = ubiquity * 100.0 / len(genome_ids)
-            s = single_copy * 100.0 / ubiquity
-            fout.write('%s\t%.1f\t%.1f\n' % (protein_family, u, s))
+        gene_count_matrix = GeneCountMatrix.load(gene_count_matrix_file)
+        self.logger.info('Read counts for %d protein families across %d genomes.' % (len(gene_count_matrix.markers), len(gene_count_matrix.genomes)))
 
-            if ubiquity >= (ubiquity_threshold * len(genome_ids)) and single_copy >= (single_copy_threshold * ubiquity):
-                markers[protein_family] = (u, s)
+        num_markers = gene_count_matrix.sweep(ubiquity_thresholds, single_copy_thresholds)
 
+        fout = open(output_file, 'w')
+        fout.write('Ubiquity\tSingle copy\tNo. marker genes\n')
+        for i, ubiquity_threshold in enumerate(ubiquity_thresholds):
+            for j, single_copy_threshold in enumerate(single_copy_thresholds):
+                fout.write('%.3f\t%.3f\t%d\n' % (ubiquity_threshold, single_copy_threshold, num_markers[i, j]))
         fout.close()
 
-        return markers
+        return num_markers
 
     def _identify_redundant_hmms(self, marker_genes, gene_count_table, redundancy, output_file):
         """Identify HMMs that consistently hit the same gene.
@@ -216,20 +215,30 @@ class InferMarkers(object):
 
         marker_gene_list = list(marker_genes)
 
-        # count number of times HMMs hit the same gene
+        # build inverted index indicating the HMMs hitting each gene
+        markers_hitting_gene = defaultdict(lambda: defaultdict(list))
+        for i, marker_gene in enumerate(marker_gene_list):
+            for genome_id, gene_ids in gene_count_table[marker_gene].iteritems():
+                for gene_id in gene_ids:
+                    markers_hitting_gene[genome_id][gene_id].append(i)
+
+        # count number of genomes in which HMMs hit the same gene, only
+        # considering HMMs which share at least one gene
+        pair_count = defaultdict(int)
+        for genes_in_genome in markers_hitting_gene.itervalues():
+            shared_pairs = set()
+            for marker_indices in genes_in_genome.itervalues():
+                if len(marker_indices) > 1:
+                    shared_pairs.update(combinations(marker_indices, 2))
+
+            for pair in shared_pairs:
+                pair_count[pair] += 1
+
+        # populate pairs in marker order so redundant pairs below are
+        # resolved in the same order as an exhaustive pairwise comparison
         redundancy_count = defaultdict(lambda: defaultdict(int))
-        for i in xrange(0, len(marker_gene_list)):
-            marker_gene_i = marker_gene_list[i]
-            genes_in_genomes_i = gene_count_table[marker_gene_i]
-
-            for j in xrange(i + 1, len(marker_genes)):
-                marker_gene_j = marker_gene_list[j]
-                genes_in_genomes_j = gene_count_table[marker_gene_j]
-
-                for genome_id in genes_in_genomes_i:
-                    if genome_id in genes_in_genomes_j:
-                        if genes_in_genomes_i[genome_id].intersection(genes_in_genomes_j[genome_id]):
-                            redundancy_count[marker_gene_i][marker_gene_j] += 1
+        for i, j in sorted(pair_count):
+            redundancy_count[marker_gene_list[i]][marker_gene_list[j]] = pair_count[(i, j)]
 
         # Identify HMMs consistently hitting the same gene across genomes.
         #
@@ -300,20 +309,16 @@ class InferMarkers(object):
             Directory to store HMM models.
         """
 
-        marker_id_to_name = {}
-        for line in open(self.pfam_model_file):
-            if 'NAME' in line:
-                name = line.split()[1].rstrip()
-            elif 'ACC' in line:
-                acc = line.split()[1].rstrip()
-                marker_id_to_name[acc] = name
-
+        hmm_model_index = HmmModelIndex()
         for marker_id in marker_genes:
             if 'PF' in marker_id:
-                os.system('hmmfetch ' + self.pfam_model_file + ' ' + marker_id_to_name[marker_id] + ' > ' + os.path.join(output_model_dir, marker_id + '.hmm'))
+                model = hmm_model_index.fetch(self.pfam_model_file, marker_id)
             else:
                 model_file = os.path.join(self.tigrfams_model_dir, marker_id + '.HMM')
-                os.system('hmmfetch ' + model_file + ' ' + marker_id + ' > ' + os.path.join(output_model_dir, marker_id + '.hmm'))
+                model = hmm_model_index.fetch(model_file, marker_id, persist=False)
+
+            with open(os.path.join(output_model_dir, marker_id + '.hmm'), 'w') as fout:
+                fout.write(model)
 
     def identify_marker_genes(self, ingroup_file,
                             ubiquity_threshold, single_copy_threshold, redundancy,
@@ -353,7 +358,12 @@ class InferMarkers(object):
         self.logger.info('Identifying marker genes.')
         gene_stats_file = os.path.join(output_model_dir, '..', 'gene_stats.all.tsv')
         gene_count_table = self._gene_count_table(genome_ids, genome_dirs)
-        marker_gene_stats = self._marker_genes(genome_ids, gene_count_table, ubiquity_threshold, single_copy_threshold, gene_stats_file)
+
+        # persist counts so thresholds can be explored with threshold_sweep()
+        gene_count_matrix = GeneCountMatrix.from_table(genome_ids, gene_count_table)
+        gene_count_matrix.save(os.path.join(output_model_dir, '..', 'gene_count_matrix.npz'))
+
+        marker_gene_stats = self._marker_genes(gene_count_matrix, ubiquity_threshold, single_copy_threshold, gene_stats_file)
 
         # with open('tmp_marker_gene_list', 'wb') as f:
         #    pickle.dump(marker_gene_stats, f)
@@ -379,14 +389,53 @@ class InferMarkers(object):
         self._fetch_marker_models(marker_genes, output_model_dir)
 
         # align gene sequences
-        align_markers = AlignMarkers(self.cpus)
+        align_markers = AlignMarkers(self.cpus, self.tophit_index_file)
         align_markers.run(genome_ids, genome_dirs, marker_genes, False, output_msa_dir, output_model_dir)
 
         return len(genome_ids), len(ncbi_genome_ids), len(user_genome_ids), genome_ids, marker_gene_stats, marker_genes
 
+    def _strip_stop_codons(self, msa_file):
+        """Remove trailing stop codons from sequences in multiple sequence alignment.
+
+        Parameters
+        ----------
+        msa_file : str
+            Multiple sequence alignment to modify in place.
+
+        Returns
+        -------
+        int
+            Number of taxa in alignment.
+        int
+            Number of columns in alignment.
+        """
+
+        num_taxa = 0
+        num_columns = 0
+
+        tmp_msa_file = msa_file + '.tmp'
+        fout = open(tmp_msa_file, 'w')
+        for line in open(msa_file):
+            if line[0] == '>':
+                num_taxa += 1
+            else:
+                # remove trailing star
+                line = line.rstrip('\n').rstrip('*') + '\n'
+                if num_taxa == 1:
+                    num_columns += len(line) - 1
+            fout.write(line)
+        fout.close()
+        os.rename(tmp_msa_file, msa_file)
+
+        return num_taxa, num_columns
+
     def infer_gene_trees(self, msa_dir, output_dir, extension):
         """Infer gene trees.
 
+        Trees are inferred from largest to smallest alignment, as
+        measured by the number of taxa times the number of columns,
+        with the largest alignments given multiple threads.
+
         Parameters
         ----------
         msa_dir : str
@@ -397,41 +446,29 @@ class InferMarkers(object):
             Extension of multiple sequence alignment files.
         """
 
-        files = os.listdir(msa_dir)
-        msa_files = []
-        for f in files:
+        jobs = []
+        tree_prefixes = []
+        for f in os.listdir(msa_dir):
             if f.endswith(extension):
                 msa_file = os.path.join(msa_dir, f)
-                msa_files.append(msa_file)
+                num_taxa, num_columns = self._strip_stop_codons(msa_file)
 
-                fin = open(msa_file)
-                data = fin.readlines()
-                fin.close()
+                tree_prefix = f[0:f.find('.')]
+                if tree_prefix.startswith('PF'):
+                    # retain version number of Pfam families
+                    tree_prefix = '.'.join(f.split('.')[0:2])
+                tree_prefixes.append(tree_prefix)
 
-                fout = open(msa_file, 'w')
-                for line in data:
-                    if line[0] != '>':
-                        # remove trailing star
-                        if line[-1] == '*':
-                            line = line[0:-1]
-                    fout.write(line)
-                fout.close()
+                jobs.append(FastTreeScheduler.Job(cost=num_taxa * num_columns,
+                                                    msa_file=msa_file,
+                                                    output_tree=os.path.join(output_dir, tree_prefix + '.tree'),
+                                                    output_tree_log=os.path.join(output_dir, tree_prefix + '.log')))
 
-        fasttree = FastTree(multithreaded=False)
-        fasttree.parallel_run(msa_files, 'prot', 'wag', output_dir, self.cpus)
+        fasttree = FastTreeScheduler(self.cpus)
+        fasttree.run(jobs, 'prot', 'wag')
 
         # create gene tree without gene ids for visualization in ARB
-        for msa_file in msa_files:
-            tree_filename = ntpath.basename(msa_file)
-            tree_prefix = tree_filename[0:tree_filename.find('.')]
-
-            if tree_prefix.startswith('PF'):
-                # patch up output file for Pfam trees
-                old_tree_prefix = tree_prefix
-                tree_prefix = '.'.join(tree_filename.split('.')[0:2])
-                shutil.move(os.path.join(output_dir, old_tree_prefix + '.tree'),
-                                os.path.join(output_dir, tree_prefix + '.tree'))
-
+        for tree_prefix in tree_prefixes:
             gene_tree_file = os.path.join(output_dir, tree_prefix + '.tree')
             gene_tree = dendropy.Tree.get_from_path(gene_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
 
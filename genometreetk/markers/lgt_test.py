@@ -16,9 +16,10 @@
 ###############################################################################
 
 import os
-import sys
+import math
 import logging
 
+from biolib.parallel import Parallel
 from biolib.external.fasttree import FastTree
 from biolib.common import make_sure_path_exists
 
@@ -38,6 +39,12 @@ class LgtTest(object):
          where at least a certain percentage of the taxa fall on each side of the split
       3) determine how many of these "well-support, internal" splits are recovered in each gene tree
       4) filter gene trees which do not recover a specific percentage of these splits
+
+    The genome tree is encoded once as the bitmask of genomes below each
+    node. Gene trees are encoded in the same way, and both trees are
+    restricted to the genomes in a gene tree by masking rather than by
+    pruning a copy of the genome tree. Gene trees are compared to the
+    genome tree in parallel.
     """
 
     def __init__(self, cpus):
@@ -53,6 +60,217 @@ class LgtTest(object):
 
         self.cpus = cpus
 
+    def _clade_bitmasks(self, tree, leaf_bitmask):
+        """Encode clade below each node of a tree as a bitmask of genomes.
+
+        Parameters
+        ----------
+        tree : dendropy.Tree
+            Tree to encode.
+        leaf_bitmask : function
+            Function giving bitmask of a leaf from its label.
+
+        Returns
+        -------
+        list of (bitmask, edge length)
+            Clade below each node along with the length of its edge.
+        d[node] -> bitmask
+            Clade below each node.
+        """
+
+        clade_mask = {}
+        clades = []
+        for node in tree.postorder_node_iter():
+            if node.is_leaf():
+                mask = leaf_bitmask(node.taxon.label)
+            else:
+                mask = 0
+                for child in node.child_node_iter():
+                    mask |= clade_mask[child]
+            clade_mask[node] = mask
+            clades.append((mask, node.edge_length))
+
+        return clades, clade_mask
+
+    def _split_lengths(self, clades, taxa_mask):
+        """Determine length of each split of a tree restricted to a set of genomes.
+
+        Clades are restricted by masking out all other genomes. Edges
+        which no longer separate any genomes are dropped, and edges
+        which now separate the same genomes are merged by summing their
+        lengths. This matches pruning the tree to the set of genomes.
+
+        Parameters
+        ----------
+        clades : list of (bitmask, edge length)
+            Clade below each node of tree along with the length of its edge.
+        taxa_mask : int
+            Bitmask of genomes to restrict tree to.
+
+        Returns
+        -------
+        d[split] -> length
+            Length of each split, with splits given as normalized bitmasks.
+        float
+            Total length of all edges.
+        """
+
+        split_length = {}
+        total_length = 0.0
+        for mask, edge_length in clades:
+            mask &= taxa_mask
+            if mask == 0:
+                continue
+
+            split = self._normalize(mask, taxa_mask)
+            length = edge_length if edge_length else 0.0
+            split_length[split] = split_length.get(split, 0.0) + length
+            total_length += length
+
+        return split_length, total_length
+
+    def _normalize(self, mask, taxa_mask):
+        """Normalize split so the side containing the lowest genome is excluded."""
+
+        if mask & taxa_mask & -taxa_mask:
+            return mask ^ taxa_mask
+
+        return mask
+
+    def _compatible(self, split, gene_splits):
+        """Determine if a normalized split is compatible with all splits of a tree.
+
+        Normalized splits never contain the lowest genome, so the union
+        of two normalized splits never covers all genomes.
+        """
+
+        for gene_split in gene_splits:
+            if (split & gene_split
+                    and split & ~gene_split
+                    and gene_split & ~split):
+                return False
+
+        return True
+
+    def _producer(self, marker_gene):
+        """Compare gene tree to genome tree.
+
+        Parameters
+        ----------
+        marker_gene : str
+            Unique id of marker gene.
+
+        Returns
+        -------
+        str
+            Unique id of marker gene.
+        tuple
+            Percentage of recovered splits, percentage of compatible splits, normalized
+            length of compatible splits, and weighted Robinson-Foulds and Euclidean
+            distances to the genome tree.
+        """
+
+        # read gene tree
+        gene_tree_file = os.path.join(self.gene_tree_dir, marker_gene + '.tree')
+        gene_tree = dendropy.Tree.get_from_path(gene_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
+
+        # mask out genes so each genome is present exactly once
+        processed_genome_ids = set()
+
+        def leaf_bitmask(label):
+            genome_id = label.split(DefaultValues.SEQ_CONCAT_CHAR)[0]
+            if genome_id in processed_genome_ids or genome_id not in self.genome_ids:
+                return 0
+
+            processed_genome_ids.add(genome_id)
+            return self.genome_bit[genome_id]
+
+        gene_tree_clades, _clade_mask = self._clade_bitmasks(gene_tree, leaf_bitmask)
+        taxa_mask = 0
+        for genome_id in processed_genome_ids:
+            taxa_mask |= self.genome_bit[genome_id]
+
+        gene_split_length, gene_tree_edge_len = self._split_lengths(gene_tree_clades, taxa_mask)
+
+        # splits of a single genome are compatible with all other splits
+        internal_gene_splits = [split for split in gene_split_length if split & (split - 1)]
+
+        # determine number of splits recovered by or compatible with this gene tree
+        recovered_splits = 0
+        compatible_splits = 0
+        compatible_edge_length = 0
+        for split, edge_length in self.splits:
+            common_split = self._normalize(split & taxa_mask, taxa_mask)
+
+            if common_split in gene_split_length:
+                recovered_splits += 1
+                compatible_splits += 1
+                compatible_edge_length += edge_length
+            elif self._compatible(common_split, internal_gene_splits):
+                compatible_splits += 1
+                compatible_edge_length += edge_length
+
+        perc_recovered_splits = recovered_splits * 100.0 / len(self.splits)
+        perc_comp_splits = compatible_splits * 100.0 / len(self.splits)
+        norm_comp_edge_length = float(compatible_edge_length) / sum([s[1] for s in self.splits])
+
+        # calculate weighted Robinson-Foulds (Manhattan) and Felsenstein's Euclidean
+        # distances to the concatenated genome tree restricted to genomes in the gene tree
+        genome_split_length, genome_tree_edge_len = self._split_lengths(self.genome_tree_clades, taxa_mask)
+
+        manhattan = 0.0
+        euclidean = 0.0
+        for split in set(genome_split_length).union(gene_split_length):
+            d = (genome_split_length.get(split, 0.0) / genome_tree_edge_len
+                    - gene_split_length.get(split, 0.0) / gene_tree_edge_len)
+            manhattan += abs(d)
+            euclidean += d * d
+        euclidean = math.sqrt(euclidean)
+
+        return (marker_gene, (perc_recovered_splits, perc_comp_splits, norm_comp_edge_length, manhattan, euclidean))
+
+    def _consumer(self, produced_data, consumer_data):
+        """Consume results from producer processes.
+
+        Parameters
+        ----------
+        produced_data : tuple
+            Marker gene and distances of gene tree to genome tree.
+        consumer_data : d[marker_gene] -> distances
+            Distances of each gene tree to genome tree.
+
+        Returns
+        -------
+        consumer_data
+            The consumer data structure or None must be returned
+        """
+
+        if consumer_data is None:
+            consumer_data = {}
+
+        marker_gene, distances = produced_data
+        consumer_data[marker_gene] = distances
+
+        return consumer_data
+
+    def _progress(self, processed_items, total_items):
+        """Report progress of consumer processes.
+
+        Parameters
+        ----------
+        processed_items : int
+            Number of gene trees processed.
+        total_items : int
+            Total number of gene trees to process.
+
+        Returns
+        -------
+        str
+            String indicating progress of data processing.
+        """
+
+        return '==> Processed %d of %d (%.2f) gene trees.' % (processed_items, total_items, processed_items * 100.0 / total_items)
+
     def run(self, genome_ids,
                     marker_genes,
                     hmm_model_file,
@@ -114,22 +332,27 @@ class LgtTest(object):
         tree = dendropy.Tree.get_from_path(jackknife_tree, schema='newick', rooting='force-unrooted', preserve_underscores=True)
         num_leaves = len(tree.leaf_nodes())
 
+        # assign a bit to each genome and encode genome tree
+        self.genome_ids = set(genome_ids)
+        taxa = sorted(self.genome_ids.union(leaf.taxon.label for leaf in tree.leaf_node_iter()))
+        self.genome_bit = dict((genome_id, 1 << i) for i, genome_id in enumerate(taxa))
+        self.genome_tree_clades, clade_mask = self._clade_bitmasks(tree, lambda label: self.genome_bit[label])
+
         num_internal_nodes = 0
         num_major_splits = 0
         well_supported_major_splits = 0
 
-        splits = []
+        self.splits = []
         for node in tree.internal_nodes():
             num_internal_nodes += 1
 
-            num_node_leaves = len(node.leaf_nodes())
+            num_node_leaves = bin(clade_mask[node]).count('1')
             if min(num_node_leaves, num_leaves - num_node_leaves) >= max(min_per_taxa * num_leaves, 2):
                 num_major_splits += 1
 
                 if int(node.label) > (min_support * 100.0):
                     well_supported_major_splits += 1
-                    split = set([x.taxon.label for x in node.leaf_nodes()])
-                    splits.append((split, node.edge_length))
+                    self.splits.append((clade_mask[node], node.edge_length))
 
         self.logger.info('# internal nodes: %d' % num_internal_nodes)
         self.logger.info('# major splits: %d' % num_major_splits)
@@ -138,80 +361,8 @@ class LgtTest(object):
         # filter gene trees that do not recover well-support, internal splits
         self.logger.info('Filtering gene trees.')
 
-        distances = {}
-        for i, mg in enumerate(sorted(marker_genes)):
-            sys.stdout.write('==> Processed %d of %d (%.2f) gene trees.\r' % (i + 1, len(marker_genes), (i + 1) * 100.0 / len(marker_genes)))
-            sys.stdout.flush()
-
-            # read gene tree
-            f = mg + '.tree'
-            gene_tree_file = os.path.join(gene_tree_dir, f)
-            gene_tree = dendropy.Tree.get_from_path(gene_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
-
-            # prune gene tree so each genome is present exactly once
-            processed_genome_ids = set()
-            taxa_to_prune = []
-            for node in gene_tree.leaf_nodes():
-                genome_id = node.taxon.label.split(DefaultValues.SEQ_CONCAT_CHAR)[0]
-
-                if genome_id in processed_genome_ids or genome_id not in genome_ids:
-                    taxa_to_prune.append(node.taxon)
-
-                processed_genome_ids.add(genome_id)
-
-            gene_tree.prune_taxa(taxa_to_prune)
-
-            # rename nodes to contain only genome id
-            gene_tree_taxa_set = set()
-            for node in gene_tree.leaf_nodes():
-                genome_id = node.taxon.label.split(DefaultValues.SEQ_CONCAT_CHAR)[0]
-                node.taxon.label = genome_id
-                gene_tree_taxa_set.add(genome_id)
-
-            # re-encode the split system over the new taxon namespace
-            gene_tree.migrate_taxon_namespace(dendropy.TaxonNamespace(gene_tree_taxa_set))
-            gene_tree.encode_bipartitions()
-            split_bitmasks = set(b.split_bitmask for b in gene_tree.bipartition_encoding)
-
-            # determine number of splits recovered by or compatible with this gene tree
-            recovered_splits = 0
-            compatible_splits = 0
-            compatible_edge_length = 0
-            for split, edge_length in splits:
-                common_taxa_labels = split.intersection(gene_tree_taxa_set)
-
-                common_split = gene_tree.taxon_namespace.taxa_bitmask(labels=common_taxa_labels)
-                normalized_split = dendropy.Bipartition.normalize_bitmask(
-                                    bitmask=common_split,
-                                    fill_bitmask=gene_tree.taxon_namespace.all_taxa_bitmask(),
-                                    lowest_relevant_bit=1)
-
-                if normalized_split in split_bitmasks:
-                    recovered_splits += 1
-
-                if gene_tree.is_compatible_with_bipartition(dendropy.Bipartition(bitmask=normalized_split, is_rooted=False)):
-                    compatible_splits += 1
-                    compatible_edge_length += edge_length
-
-            perc_recovered_splits = recovered_splits * 100.0 / len(splits)
-            perc_comp_splits = compatible_splits * 100.0 / len(splits)
-            norm_comp_edge_length = float(compatible_edge_length) / sum([s[1] for s in splits])
-
-            # calculate weighted Robinson-Foulds (Manhattan) and Felsenstein's Euclidean
-            # distances to the concatenated genome tree
-            pruned_tree = tree.clone(depth=2)
-            pruned_tree.retain_taxa_with_labels(gene_tree.taxon_namespace.labels())
-            pruned_tree.migrate_taxon_namespace(gene_tree.taxon_namespace)
-            pruned_tree.encode_bipartitions()
-
-            pruned_tree_edge_len = sum([e.length for e in pruned_tree.edges() if e.length])
-            gene_tree_edge_len = sum([e.length for e in gene_tree.edges() if e.length])
-            pruned_tree.scale_edges(1.0 / pruned_tree_edge_len)
-            gene_tree.scale_edges(1.0 / gene_tree_edge_len)
-
-            manhattan = dendropy.calculate.treecompare.weighted_robinson_foulds_distance(pruned_tree, gene_tree)
-            euclidean = dendropy.calculate.treecompare.euclidean_distance(pruned_tree, gene_tree)
-
-            distances[mg] = (perc_recovered_splits, perc_comp_splits, norm_comp_edge_length, manhattan, euclidean)
+        self.gene_tree_dir = gene_tree_dir
+        parallel = Parallel(self.cpus)
+        distances = parallel.run(self._producer, self._consumer, sorted(marker_genes), self._progress)
 
         return distances, num_internal_nodes, num_major_splits, well_supported_major_splits
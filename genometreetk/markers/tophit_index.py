@@ -0,0 +1,180 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import logging
+
+from biolib.parallel import Parallel
+
+from genometreetk.default_values import DefaultValues
+from genometreetk.common import (file_signature,
+                                load_signed_cache,
+                                save_signed_cache)
+
+
+class TopHitIndex(object):
+    """Persisted index of Pfam and TIGRFAMs top hits for each genome.
+
+    The index records the genes hit by each protein family within each
+    genome, along with the size and modification time of the top hit
+    files it was built from. Only genomes whose top hit files have
+    changed since the index was written are parsed again.
+    """
+
+    def __init__(self, cpus):
+        """Initialization.
+
+        Parameters
+        ----------
+        cpus : int
+            Number of cpus to use.
+        """
+
+        self.logger = logging.getLogger()
+
+        self.cpus = cpus
+
+        self.pfam_extension = DefaultValues.PFAM_EXTENSION
+        self.tigr_extension = DefaultValues.TIGR_EXTENSION
+
+        # signature of persisted index, as each genome within the
+        # index holds the signature of its own top hit files
+        self.index_version = ('tophit_index', 1)
+
+    def _tophit_files(self, genome_dir):
+        """Get Pfam and TIGRFAMs top hit files for genome."""
+
+        assembly = genome_dir[genome_dir.rfind('/') + 1:]
+        return (os.path.join(genome_dir, assembly + self.pfam_extension),
+                os.path.join(genome_dir, assembly + self.tigr_extension))
+
+    def _signature(self, tophit_files):
+        """Get size and modification time of top hit files."""
+
+        return tuple(file_signature(tophit_file) for tophit_file in tophit_files)
+
+    def _producer(self, data_item):
+        """Parse top hit files of a single genome.
+
+        Parameters
+        ----------
+        data_item : (genome_id, genome_dir)
+            Genome to process.
+
+        Returns
+        -------
+        (genome_id, signature, d[family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)])
+            Genes hit by each protein family within the genome.
+        """
+
+        genome_id, genome_dir = data_item
+
+        tophit_files = self._tophit_files(genome_dir)
+        signature = self._signature(tophit_files)
+
+        marker_id_to_gene_id = {}
+        for tophit_file in tophit_files:
+            with open(tophit_file) as f:
+                f.readline()
+                for line in f:
+                    line_split = line.split('\t')
+
+                    gene_id = line_split[0]
+                    hits = line_split[1].split(';')
+                    for hit in hits:
+                        family_id, _evalue, bitscore = hit.split(',')
+                        marker_id_to_gene_id.setdefault(family_id, []).append((gene_id, float(bitscore)))
+
+        return genome_id, signature, marker_id_to_gene_id
+
+    def _consumer(self, produced_data, consumer_data):
+        """Add parsed genome to index."""
+
+        if consumer_data == None:
+            consumer_data = {}
+
+        genome_id, signature, marker_id_to_gene_id = produced_data
+        consumer_data[genome_id] = (signature, marker_id_to_gene_id)
+
+        return consumer_data
+
+    def _progress(self, processed_items, total_items):
+        """Report progress of parsing."""
+
+        return '    Parsed top hits of %d of %d genomes.' % (processed_items, total_items)
+
+    def _read_index(self, index_file):
+        """Read previously persisted index."""
+
+        if not index_file or not os.path.exists(index_file):
+            return {}
+
+        index = load_signed_cache(index_file, self.index_version)
+        if index is None:
+            self.logger.warning('Unable to read top hit index %s; index will be rebuilt.' % index_file)
+            return {}
+
+        return index
+
+    def _write_index(self, index_file, index):
+        """Persist index."""
+
+        if not save_signed_cache(index_file, self.index_version, index):
+            self.logger.warning('Unable to write top hit index %s.' % index_file)
+
+    def genes_in_genomes(self, genome_ids, genome_dirs, index_file=None):
+        """Get genes hit by each protein family within genomes.
+
+        Parameters
+        ----------
+        genome_ids : iterable
+            Genomes of interest.
+        genome_dirs : d[assembly_accession] -> directory
+            Path to files for individual genomes.
+        index_file : str
+            File used to persist the index between runs.
+
+        Returns
+        -------
+        d[genome_id][family_id] -> [(gene_id_1, bitscore), ..., (gene_id_N, bitscore)]
+            Genes within each genome.
+        """
+
+        index = self._read_index(index_file)
+
+        stale_genomes = []
+        for genome_id in genome_ids:
+            genome_dir = genome_dirs[genome_id]
+            entry = index.get(genome_id, None)
+            if not entry or entry[0] != self._signature(self._tophit_files(genome_dir)):
+                stale_genomes.append((genome_id, genome_dir))
+
+        if index:
+            self.logger.info('Top hit index is out of date for %d of %d genomes.' % (len(stale_genomes), len(genome_ids)))
+
+        if stale_genomes:
+            parallel = Parallel(self.cpus)
+            index.update(parallel.run(self._producer, self._consumer, stale_genomes, self._progress))
+
+            if index_file:
+                self._write_index(index_file, index)
+
+        genes_in_genome = {}
+        for genome_id in genome_ids:
+            genes_in_genome[genome_id] = index[genome_id][1]
+
+        return genes_in_genome
@@ -168,7 +168,7 @@ class QcGenomes(object):
 
             if passed_qc:
                 num_retained += 1
-                fout_retained.write('%s\t%s' % (gid, ncbi_taxonomy[gid][6]))
+                fout_retained.write('%s\t%s' % (gid, ncbi_taxonomy.species(gid)))
                 fout_retained.write('\t%.2f\t%.2f\t%.2f\t%s\t%.2f\t%d\t%d\t%d\n' % (
                                         quality_metadata[gid].checkm_completeness,
                                         quality_metadata[gid].checkm_contamination,
@@ -180,7 +180,7 @@ class QcGenomes(object):
                                         quality_metadata[gid].ambiguous_bases))
             else:
                 num_filtered += 1 
-                fout_failed.write('%s\t%s' % (gid, ncbi_taxonomy[gid][6]))
+                fout_failed.write('%s\t%s' % (gid, ncbi_taxonomy.species(gid)))
                 fout_failed.write('\t%.2f\t%.2f\t%.2f\t%s\t%.2f\t%d\t%d\t%d' % (
                                         quality_metadata[gid].checkm_completeness,
                                         quality_metadata[gid].checkm_contamination,
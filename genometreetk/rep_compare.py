@@ -0,0 +1,173 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import sys
+import csv
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+
+# make sure large CSV files can be read
+csv.field_size_limit(sys.maxsize)
+
+
+class RepCompare(object):
+    """Compare representatives between two GTDB metadata snapshots.
+
+    Only the columns required for the comparison are read from each
+    snapshot and they are held as typed arrays. All comparisons are
+    performed as set operations over these arrays.
+    """
+
+    Snapshot = namedtuple('Snapshot', 'gids is_rep has_taxonomy genera species')
+
+    def __init__(self):
+        """Initialization."""
+
+        self.logger = logging.getLogger()
+
+    def _read_snapshot(self, metadata_file):
+        """Read columns required for comparison from GTDB metadata file.
+
+        Parameters
+        ----------
+        metadata_file : str
+            Metadata for all genomes in CSV file.
+
+        Returns
+        -------
+        Snapshot
+            Accession, representative status, and GTDB genus and species of each genome.
+        """
+
+        gids = []
+        is_rep = []
+        genera = []
+        species = []
+        with open(metadata_file) as f:
+            header = next(csv.reader([f.readline()]))
+            gtdb_rep_index = header.index('gtdb_representative')
+            gtdb_taxonomy_index = header.index('gtdb_taxonomy')
+
+            # only split rows up to the last required column, falling
+            # back to the CSV parser for rows with quoted fields
+            max_split = max(gtdb_rep_index, gtdb_taxonomy_index) + 1
+            for line in f:
+                if '"' in line:
+                    # quoted fields may span several lines
+                    while line.count('"') % 2:
+                        line += next(f)
+                    row = next(csv.reader([line]))
+                else:
+                    row = line.rstrip('\r\n').split(',', max_split)
+
+                gids.append(row[0])
+                is_rep.append(row[gtdb_rep_index] == 't')
+
+                gtdb_taxonomy = row[gtdb_taxonomy_index]
+                if gtdb_taxonomy:
+                    gtdb_taxa = gtdb_taxonomy.split(';')
+                    genera.append(gtdb_taxa[5].strip())
+                    species.append(gtdb_taxa[6].strip())
+                else:
+                    genera.append('')
+                    species.append('')
+
+        genera = np.array(genera)
+        species = np.array(species)
+
+        return self.Snapshot(gids=np.array(gids),
+                                is_rep=np.array(is_rep, dtype=bool),
+                                has_taxonomy=(genera != ''),
+                                genera=genera,
+                                species=species)
+
+    def _named(self, taxa, mask, rank_prefix):
+        """Get unique named taxa within the rows selected by mask."""
+
+        taxa = taxa[mask]
+        return np.unique(taxa[(taxa != rank_prefix) & (taxa != '')])
+
+    def run(self, cur_metadata_file, prev_metadata_file):
+        """Compare current and previous representatives.
+
+        Parameters
+        ----------
+        cur_metadata_file : str
+            Metadata for all genomes in current GTDB release.
+        prev_metadata_file : str
+            Metadata for all genomes in previous GTDB release.
+        """
+
+        cur = self._read_snapshot(cur_metadata_file)
+        prev = self._read_snapshot(prev_metadata_file)
+
+        all_genomes = np.ones(len(cur.gids), dtype=bool)
+
+        # get representatives in current taxonomy
+        cur_gids = np.unique(cur.gids)
+        cur_species = self._named(cur.species, all_genomes, 's__')
+        cur_genera = self._named(cur.genera, all_genomes, 'g__')
+        cur_reps = np.unique(cur.gids[cur.is_rep])
+        cur_rep_species = self._named(cur.species, cur.is_rep, 's__')
+        cur_rep_genera = self._named(cur.genera, cur.is_rep, 'g__')
+
+        # get representatives in previous taxonomy
+        prev_rep_mask = prev.is_rep & prev.has_taxonomy
+        prev_reps = np.unique(prev.gids[prev_rep_mask])
+        prev_rep_species = self._named(prev.species, prev_rep_mask, 's__')
+        prev_rep_genera = self._named(prev.genera, prev_rep_mask, 'g__')
+
+        # summarize differences
+        print('No. current representatives: %d' % len(cur_reps))
+        print('No. previous representatives: %d' % len(prev_reps))
+
+        print('')
+        print('No. current species with representatives: %d' % len(cur_rep_species))
+        print('No. previous species with representatives: %d' % len(prev_rep_species))
+
+        print('')
+        print('No. new representatives: %d' % len(np.setdiff1d(cur_reps, prev_reps, assume_unique=True)))
+        print('No. retired representatives: %d' % len(np.setdiff1d(prev_reps, cur_reps, assume_unique=True)))
+
+        print('')
+        print('No. new species with representative: %d' % len(np.setdiff1d(cur_rep_species, prev_rep_species, assume_unique=True)))
+        print('No. new genera with representative: %d' % len(np.setdiff1d(cur_rep_genera, prev_rep_genera, assume_unique=True)))
+
+        print('')
+        missing_sp_reps = np.setdiff1d(np.intersect1d(prev_rep_species, cur_species, assume_unique=True),
+                                        cur_rep_species,
+                                        assume_unique=True)
+        print('No. species that no longer have a representative: %d' % len(missing_sp_reps))
+        for sp in missing_sp_reps:
+            print('  ' + sp)
+
+        print('')
+        missing_genera_reps = np.setdiff1d(np.intersect1d(prev_rep_genera, cur_genera, assume_unique=True),
+                                            cur_rep_genera,
+                                            assume_unique=True)
+        print('No. genera that no longer have a representative: %d' % len(missing_genera_reps))
+        for g in missing_genera_reps:
+            print('  ' + g)
+
+        print('')
+        deprecated_reps = np.setdiff1d(np.intersect1d(prev_reps, cur_gids, assume_unique=True),
+                                        cur_reps,
+                                        assume_unique=True)
+        print('No. deprecated previous representatives: %d' % len(deprecated_reps))
@@ -0,0 +1,198 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import logging
+from collections import Counter
+
+import numpy as np
+
+from genometreetk.common import (file_signature,
+                                    load_signed_cache,
+                                    save_signed_cache)
+
+
+def run_signature(settings, input_files):
+    """Get signature identifying the settings and input files of a run.
+
+    Parameters
+    ----------
+    settings : iterable
+        Settings affecting the generated replicates.
+    input_files : iterable
+        Files replicates are generated from, or None for files not provided.
+
+    Returns
+    -------
+    tuple
+        Settings along with the path, size and modification time of each input file.
+    """
+
+    file_signatures = []
+    for input_file in input_files:
+        if input_file and os.path.exists(input_file):
+            file_signatures.append((os.path.abspath(input_file),) + file_signature(input_file))
+        else:
+            file_signatures.append(input_file)
+
+    return tuple(settings) + tuple(file_signatures)
+
+
+class ReplicateRecords(object):
+    """Records of completed replicates within a replicate directory.
+
+    A replicate is recorded only after its tree has been moved into
+    place, and both the tree and its record are written under a
+    temporary name and then renamed. A replicate interrupted at any
+    point is therefore either fully recorded or not recorded at all,
+    and a rerun in the same directory only needs to infer replicates
+    without a record. Each record holds the seed used to generate
+    the replicate so replicates from different seeds are never mixed.
+    Each record also holds a signature of the settings and input files
+    of the run, and records from runs with a different signature are
+    ignored.
+    """
+
+    def __init__(self, replicate_dir, prefix, signature):
+        """Initialization.
+
+        Parameters
+        ----------
+        replicate_dir : str
+            Directory containing replicates.
+        prefix : str
+            Prefix of record files.
+        signature : tuple
+            Signature of run, as given by run_signature().
+        """
+
+        self.logger = logging.getLogger()
+
+        self.replicate_dir = replicate_dir
+        self.prefix = prefix
+        self.signature = signature
+        self.record_extension = '.done.pkl'
+        self.reported_mismatch = False
+
+    def _record_file(self, replicated_num):
+        """Get record file of replicate."""
+
+        return os.path.join(self.replicate_dir, '%s.r_%d%s' % (self.prefix, replicated_num, self.record_extension))
+
+    def _read(self):
+        """Read all records.
+
+        Returns
+        -------
+        d[replicated_num] -> (seed, tree_file)
+            Seed and tree of each completed replicate.
+        """
+
+        records = {}
+        num_mismatched = 0
+        for f in os.listdir(self.replicate_dir):
+            if not f.startswith(self.prefix + '.r_') or not f.endswith(self.record_extension):
+                continue
+
+            record = load_signed_cache(os.path.join(self.replicate_dir, f), self.signature)
+            if record is None:
+                num_mismatched += 1
+                continue
+
+            replicated_num, seed, tree_file = record
+            tree_file = os.path.join(self.replicate_dir, tree_file)
+            if os.path.exists(tree_file):
+                records[replicated_num] = (seed, tree_file)
+
+        if num_mismatched and not self.reported_mismatch:
+            self.logger.warning('Ignoring %d replicates with unreadable records or completed with different settings or input files.' % num_mismatched)
+            self.reported_mismatch = True
+
+        return records
+
+    def seed(self, seed):
+        """Get seed for generating replicates.
+
+        Parameters
+        ----------
+        seed : int
+            Requested seed, or None to continue with the seed of
+            previously completed replicates or select one at random.
+
+        Returns
+        -------
+        int
+            Seed for generating replicates.
+        """
+
+        if seed is not None:
+            return seed
+
+        # continue with the seed of the most completed replicates
+        seeds = Counter(record_seed for record_seed, _tree_file in self._read().values())
+        if seeds:
+            return seeds.most_common(1)[0][0]
+
+        return np.random.randint(0, 2**31 - 1)
+
+    def completed(self, seed):
+        """Get replicates completed with a given seed.
+
+        Parameters
+        ----------
+        seed : int
+            Seed used to generate replicates.
+
+        Returns
+        -------
+        d[replicated_num] -> tree_file
+            Tree of each completed replicate.
+        """
+
+        completed = {}
+        for replicated_num, (record_seed, tree_file) in self._read().iteritems():
+            if record_seed == seed:
+                completed[replicated_num] = tree_file
+
+        return completed
+
+    def complete(self, replicated_num, seed, tmp_tree_file, tree_file):
+        """Record replicate as completed.
+
+        Parameters
+        ----------
+        replicated_num : int
+            Unique replicate number.
+        seed : int
+            Seed used to generate replicate.
+        tmp_tree_file : str
+            Temporary file containing inferred tree.
+        tree_file : str
+            File to hold tree of replicate.
+        """
+
+        # remove any record of a replicate generated with another seed
+        # or signature before its tree is replaced
+        record_file = self._record_file(replicated_num)
+        if os.path.exists(record_file):
+            os.remove(record_file)
+
+        os.rename(tmp_tree_file, tree_file)
+
+        record = (replicated_num, seed, os.path.basename(tree_file))
+        if not save_signed_cache(record_file, self.signature, record):
+            self.logger.warning('Unable to write record of replicate %d; it will be inferred again if restarted.' % replicated_num)
@@ -35,7 +35,6 @@ from numpy import (mean as np_mean,
 from genometreetk.common import (parse_genome_path,
                                     binomial_species,
                                     genome_species_assignments,
-                                    canonical_species_name,
                                     read_gtdb_metadata,
                                     read_gtdb_taxonomy,
                                     read_gtdb_ncbi_taxonomy)
@@ -56,6 +55,73 @@ from genometreetk.type_genome_utils import (NCBI_TYPE_SPECIES,
 from genometreetk.ani_cache import ANI_Cache
 from genometreetk.mash import Mash
 
+class TypeGenomeContext(object):
+    """Metadata required to select GTDB type genomes.
+    
+    All inputs derived from the GTDB metadata file are read once
+    at the start of a run and shared by all helper methods.
+    """
+    
+    TYPE_FIELDS = ['ncbi_refseq_category',
+                    'ncbi_strain_identifiers',
+                    'ncbi_type_material_designation',
+                    'gtdb_type_designation',
+                    'gtdb_type_designation_sources']
+                    
+    QUALITY_FIELDS = ['checkm_completeness',
+                        'checkm_contamination',
+                        'checkm_strain_heterogeneity_100',
+                        'contig_count',
+                        'scaffold_count',
+                        'n50_contigs',
+                        'ambiguous_bases',
+                        'gtdb_taxonomy',
+                        'ssu_count',
+                        'ssu_length',
+                        'total_gap_length',
+                        'ncbi_assembly_level',
+                        'ncbi_genome_representation',
+                        'ncbi_molecule_count',
+                        'ncbi_unspanned_gaps',
+                        'ncbi_spanned_gaps',
+                        'ncbi_refseq_category',
+                        'ncbi_type_material_designation',
+                        'mimag_high_quality',
+                        'genome_size',
+                        'ncbi_genome_category']
+                        
+    PRIORITY_FIELDS = ['gtdb_type_designation',
+                        'lpsn_priority_year', 
+                        'dsmz_priority_year', 
+                        'straininfo_priority_year']
+    
+    def __init__(self, metadata_file):
+        """Read all required metadata.
+        
+        Parameters
+        ----------
+        metadata_file : str
+            Metadata for all genomes.
+        """
+        
+        self.ncbi_taxonomy = read_gtdb_ncbi_taxonomy(metadata_file)
+        self.gtdb_taxonomy = read_gtdb_taxonomy(metadata_file)
+        
+        fields = []
+        for field in self.TYPE_FIELDS + self.QUALITY_FIELDS + self.PRIORITY_FIELDS:
+            if field not in fields:
+                fields.append(field)
+                
+        # d[genome_id] -> namedtuple with type, quality, and priority fields
+        self.metadata = read_gtdb_metadata(metadata_file, fields)
+        
+        # derived values, set by SelectTypeGenomes
+        self.genome_quality = None
+        self.gid_to_species = None
+        self.year_of_priority = None
+        self.type_metadata = None
+        
+
 class SelectTypeGenomes(object):
     """Select GTDB type genomes for named species."""
 
@@ -78,30 +144,35 @@ class SelectTypeGenomes(object):
         
         self.BlastHit = namedtuple('BlastHit', ['ltp_species', 'ssu_len', 'align_len', 'perc_identity', 'bitscore', 'evalue'])
         
-    def  _type_metadata(self, metadata_file):
-        """Read and parse type material metadata."""
+    def  _type_metadata(self, metadata):
+        """Parse type material metadata.
         
-        type_metadata = read_gtdb_metadata(metadata_file, ['ncbi_refseq_category',
-                                                                'ncbi_strain_identifiers',
-                                                                'ncbi_type_material_designation',
-                                                                'gtdb_type_designation',
-                                                                'gtdb_type_designation_sources'])
-                                                                
-        for gid in type_metadata:
+        Parameters
+        ----------
+        metadata : d[genome_id] -> namedtuple
+            Metadata for all genomes, which is left unchanged.
+            
+        Returns
+        -------
+        d[genome_id] -> namedtuple
+            Metadata with strain identifiers and type designation sources parsed into sets.
+        """
+        
+        type_metadata = {}
+        for gid, m in metadata.iteritems():
             strain_ids = set()
-            if type_metadata[gid].ncbi_strain_identifiers:
-                s = [s.strip() for s in str(type_metadata[gid].ncbi_strain_identifiers).split(';')]
+            if m.ncbi_strain_identifiers:
+                s = [s.strip() for s in str(m.ncbi_strain_identifiers).split(';')]
                 for strain_id in s:
                     if strain_id:
                         strain_ids.add(strain_id)
-                    
-            type_metadata[gid] = type_metadata[gid]._replace(ncbi_strain_identifiers = strain_ids)
             
-            if type_metadata[gid].gtdb_type_designation_sources:
-                sources = set([t.strip() for t in type_metadata[gid].gtdb_type_designation_sources.split(';')])
-                type_metadata[gid] = type_metadata[gid]._replace(gtdb_type_designation_sources = sources)
-            else:
-                type_metadata[gid] = type_metadata[gid]._replace(gtdb_type_designation_sources = set())
+            sources = set()
+            if m.gtdb_type_designation_sources:
+                sources = set([t.strip() for t in m.gtdb_type_designation_sources.split(';')])
+                
+            type_metadata[gid] = m._replace(ncbi_strain_identifiers = strain_ids,
+                                            gtdb_type_designation_sources = sources)
                 
         return type_metadata
         
@@ -161,7 +232,7 @@ class SelectTypeGenomes(object):
                         self.logger.warning('Genome %s is missing NCBI taxonomy information.' % gid)
                         continue
                         
-                    ncbi_sp = ncbi_taxonomy[gid][6]
+                    ncbi_sp = ncbi_taxonomy.species(gid)
                     if ltp_sp_canonical == ncbi_sp:
                         if "l[T]" in strain_info: # type strain according to LTP
                             if type_info == "type sp.":
@@ -174,34 +245,12 @@ class SelectTypeGenomes(object):
 
         return ltp_type_species_of_genus, ltp_type_strain_of_species, ltp_type_strain_of_subspecies, ltp_top_blast_hit
         
-    def _genome_quality(self, metadata_file):
+    def _genome_quality(self, quality_metadata):
         """Calculate quality of genomes."""
 
-        quality_metadata = read_gtdb_metadata(metadata_file, ['checkm_completeness',
-                                                                'checkm_contamination',
-                                                                'checkm_strain_heterogeneity_100',
-                                                                'contig_count',
-                                                                'scaffold_count',
-                                                                'n50_contigs',
-                                                                'ambiguous_bases',
-                                                                'gtdb_taxonomy',
-                                                                'ssu_count',
-                                                                'ssu_length',
-                                                                'total_gap_length',
-                                                                'ncbi_assembly_level',
-                                                                'ncbi_genome_representation',
-                                                                'ncbi_molecule_count',
-                                                                'ncbi_unspanned_gaps',
-                                                                'ncbi_spanned_gaps',
-                                                                'ncbi_refseq_category',
-                                                                'ncbi_type_material_designation',
-                                                                'mimag_high_quality',
-                                                                'genome_size',
-                                                                'ncbi_genome_category'])
-                                                    
         quality = quality_score(quality_metadata.keys(), quality_metadata)
  
-        return quality, quality_metadata
+        return quality
         
     def _select_highest_quality(self, gids, genome_quality):
         """Select highest quality genome."""
@@ -303,8 +352,7 @@ class SelectTypeGenomes(object):
             if gid not in passed_qc:
                 continue
                 
-            ncbi_taxa = ncbi_taxonomy[gid]
-            ncbi_species = ncbi_taxa[6]
+            ncbi_species = ncbi_taxonomy.species(gid)
             
             # sanity check NCBI species assignments for all designated GTDB type material
             if (metadata.gtdb_type_designation 
@@ -902,10 +950,9 @@ class SelectTypeGenomes(object):
 
         # compare genomes in the same genus
         genus_ani_pairs = []
-        for rep_idA, rep_idB in combinations(type_genomes.values(), 2):
-            ncbi_genusA = ncbi_taxonomy[rep_idA][5]
-            ncbi_genusB = ncbi_taxonomy[rep_idB][5]
-            if ncbi_genusA == ncbi_genusB:
+        ncbi_genera = ncbi_taxonomy.genomes_by_rank(5, type_genomes.values(), skip_empty=False)
+        for genus_gids in ncbi_genera.values():
+            for rep_idA, rep_idB in combinations(genus_gids, 2):
                 genus_ani_pairs.append((rep_idA, rep_idB))
                 genus_ani_pairs.append((rep_idB, rep_idA))
         
@@ -951,7 +998,7 @@ class SelectTypeGenomes(object):
                 assert(test_ani == ani)
                 assert(test_af == af)
                 
-                sp2 = ncbi_taxonomy[gid2][6]
+                sp2 = ncbi_taxonomy.species(gid2)
                 fout.write('%s\t%s\t%s\t%s' % (sp1, gid1, sp2, gid2))
                 fout.write('\t%.2f\t%.2f\t%.2f\t%.2f\t%.2f\t%.2f\n' % (
                             ani, af,
@@ -965,18 +1012,14 @@ class SelectTypeGenomes(object):
         
         return ani_neighbours
         
-    def _year_of_priority(self, metadata_file, ncbi_taxonomy):
+    def _year_of_priority(self, ctx):
         """Get year of priority for type strains of species."""
         
         NO_PRIORITY_YEAR = 1e6
         PriorityYear = namedtuple('PriorityYear', 'lpsn dsmz straininfo')
         
-        
-        gid_to_species = genome_species_assignments(ncbi_taxonomy)
-        priority = read_gtdb_metadata(metadata_file, ['gtdb_type_designation',
-                                                        'lpsn_priority_year', 
-                                                        'dsmz_priority_year', 
-                                                        'straininfo_priority_year'])
+        gid_to_species = ctx.gid_to_species
+        priority = ctx.metadata
                                                         
         gtdb_type_species = gtdb_type_strain_of_species(priority)
         
@@ -1025,15 +1068,14 @@ class SelectTypeGenomes(object):
                                         ncbi_proxy,
                                         ncbi_type_subsp,
                                         ncbi_reps,
-                                        genome_quality,
-                                        ncbi_taxonomy,
-                                        metadata_file):
+                                        ctx):
         """Resolve type genomes that have ANI neighbours deemed to be too close."""
 
         self.logger.info('Resolving %d type genomes with one or more neighbours within a %.1f%% ANI radius.' % (len(ani_neighbours), self.max_ani_neighbour))
         
         # get priority dates
-        year_of_priority = self._year_of_priority(metadata_file, ncbi_taxonomy)
+        year_of_priority = ctx.year_of_priority
+        genome_quality = ctx.genome_quality
         
         # sanity check ANI neighbours
         for cur_gid in ani_neighbours:
@@ -1043,7 +1085,7 @@ class SelectTypeGenomes(object):
                     sys.exit(-1)
         
         # get species for each genome
-        gid_to_species = genome_species_assignments(ncbi_taxonomy)
+        gid_to_species = ctx.gid_to_species
 
         # get type status of each genome
         type_status = defaultdict(lambda: [])
@@ -1155,14 +1197,12 @@ class SelectTypeGenomes(object):
                             excluded_gids,
                             gtdb_type_sp,
                             ncbi_type_sp,
-                            type_metadata,
-                            ncbi_taxonomy,
-                            metadata_file):
+                            ctx):
         """Create table indicating species names that should be considered synonyms based on ANI."""
         
-        year_of_priority = self._year_of_priority(metadata_file, ncbi_taxonomy)
-        
-        gid_to_species = genome_species_assignments(ncbi_taxonomy)
+        year_of_priority = ctx.year_of_priority
+        gid_to_species = ctx.gid_to_species
+        type_metadata = ctx.type_metadata
         
         out_file = os.path.join(self.output_dir, 'synonyms.tsv')
         self.logger.info('Writing synonyms to: %s' % out_file)
@@ -1221,12 +1261,14 @@ class SelectTypeGenomes(object):
         passed_qc = read_qc_file(qc_file)
         self.logger.info('Identified %d genomes passing QC.' % len(passed_qc))
 
-        # get GTDB and NCBI taxonomy strings for each genome
-        self.logger.info('Reading NCBI taxonomy from GTDB metadata file.')
-        ncbi_taxonomy = read_gtdb_ncbi_taxonomy(metadata_file)
-        gtdb_taxonomy = read_gtdb_taxonomy(metadata_file)
+        # read all required information from GTDB metadata file
+        self.logger.info('Reading taxonomy, quality, and type material metadata from GTDB metadata file.')
+        ctx = TypeGenomeContext(metadata_file)
+        ncbi_taxonomy = ctx.ncbi_taxonomy
+        gtdb_taxonomy = ctx.gtdb_taxonomy
         self.logger.info('Read NCBI taxonomy for %d genomes.' % len(ncbi_taxonomy))
         self.logger.info('Read GTDB taxonomy for %d genomes.' % len(gtdb_taxonomy))
+        ctx.gid_to_species = genome_species_assignments(ncbi_taxonomy)
 
         # get path to genome FASTA files
         self.logger.info('Reading path to genome FASTA files.')
@@ -1239,7 +1281,9 @@ class SelectTypeGenomes(object):
         
         # calculate quality score for genomes
         self.logger.info('Calculate quality score for all genomes.')
-        genome_quality, quality_metadata = self._genome_quality(metadata_file)
+        quality_metadata = ctx.metadata
+        genome_quality = self._genome_quality(quality_metadata)
+        ctx.genome_quality = genome_quality
         marker_perc = parse_marker_percentages(gtdb_domain_report)
         self.logger.info('Read genome quality for %d genomes.' % len(genome_quality))
         
@@ -1265,8 +1309,10 @@ class SelectTypeGenomes(object):
         fout.write('%s\t%d\t%d\n' % ('LTP type strain of subspecies', len(ltp_type_strain_of_subspecies), sum([len(gids) for gids in ltp_type_strain_of_subspecies.values()])))
 
         # get type material designations for each genome
-        self.logger.info('Reading type material designations for genomes from GTDB metadata file.')
-        type_metadata = self._type_metadata(metadata_file)
+        self.logger.info('Parsing type material designations for genomes.')
+        type_metadata = self._type_metadata(ctx.metadata)
+        ctx.type_metadata = type_metadata
+        ctx.year_of_priority = self._year_of_priority(ctx)
                                                                 
         d = self._get_type_designations(ncbi_taxonomy, type_metadata, passed_qc)
         gtdb_type_sp, gtdb_type_subsp, ncbi_type_sp, ncbi_proxy, ncbi_type_subsp, ncbi_reps = d
@@ -1338,9 +1384,7 @@ class SelectTypeGenomes(object):
                                                             ncbi_proxy,
                                                             ncbi_type_subsp,
                                                             ncbi_reps,
-                                                            genome_quality,
-                                                            ncbi_taxonomy,
-                                                            metadata_file)
+                                                            ctx)
                                                             
         self.write_final_type_genomes(os.path.join(self.output_dir, 'gtdb_type_genomes_initial.tsv'), excluded_gids)
         
@@ -1349,6 +1393,4 @@ class SelectTypeGenomes(object):
                                     excluded_gids, 
                                     gtdb_type_sp, 
                                     ncbi_type_sp,
-                                    type_metadata,
-                                    ncbi_taxonomy,
-                                    metadata_file)
+                                    ctx)
@@ -0,0 +1,414 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import logging
+
+import dendropy
+
+import numpy as np
+
+from biolib.parallel import Parallel
+from biolib.newick import parse_label, create_label
+
+from genometreetk.bipartitions import BipartitionHasher
+from genometreetk.exceptions import GenomeTreeTkError
+
+
+class SegmentTree(object):
+    """Lazy segment tree supporting addition to ranges of values.
+
+    Additions covering a node are kept at the node rather than being
+    pushed down to its children, and each node stores the minimum
+    and maximum of its values including these additions. Adding a
+    value to a range therefore updates O(log n) nodes and the minimum
+    and maximum of all values are stored at the root. Additions to
+    several ranges are applied together, one level of the tree at a
+    time.
+    """
+
+    def __init__(self, values, padding):
+        """Initialization.
+
+        Parameters
+        ----------
+        values : iterable
+            Initial values.
+        padding : int
+            Value of leaves beyond the initial values, which must never change the minimum or maximum.
+        """
+
+        self.depth = 0
+        while (1 << self.depth) < len(values):
+            self.depth += 1
+        self.num_leaves = 1 << self.depth
+
+        # each node holds the minimum and negated maximum of its
+        # values followed by the addition to all of its values, so
+        # additions and updates of both are done together
+        self.sign = np.array([1, -1, 1, -1], dtype=np.int64)
+        self.nodes = np.zeros((2 * self.num_leaves, 4), dtype=np.int64)
+        leaf_values = np.empty(self.num_leaves, dtype=np.int64)
+        leaf_values.fill(padding)
+        leaf_values[:len(values)] = values
+        self.nodes[self.num_leaves:, 0] = leaf_values
+        self.nodes[self.num_leaves:, 1] = -leaf_values
+
+        for level in xrange(self.depth - 1, -1, -1):
+            nodes = np.arange(1 << level, 2 << level)
+            self.nodes[nodes, :2] = np.minimum(self.nodes[2 * nodes, :2], self.nodes[2 * nodes + 1, :2])
+
+    def add(self, starts, ends, value):
+        """Add value to ranges of values.
+
+        Parameters
+        ----------
+        starts : np.array
+            First position of each range.
+        ends : np.array
+            Position following the last position of each range.
+        value : int
+            Value to add to each position within each range.
+        """
+
+        left = starts + self.num_leaves
+        right = ends + self.num_leaves
+        boundary = np.unique(np.concatenate((left, right - 1)))
+
+        # add value to the nodes covering each range, from the leaves up,
+        # with nodes shared by overlapping ranges receiving it once per range
+        change = value * self.sign
+        while len(left):
+            left_odd = (left & 1) == 1
+            right_odd = (right & 1) == 1
+            right[right_odd] -= 1
+            np.add.at(self.nodes, np.concatenate((left[left_odd], right[right_odd])), change)
+            left[left_odd] += 1
+
+            left >>= 1
+            right >>= 1
+            active = left < right
+            left = left[active]
+            right = right[active]
+
+        # update ancestors of the leaves at each end of the ranges,
+        # which are the only nodes with descendants changed by the additions
+        nodes = boundary
+        for _level in xrange(self.depth):
+            nodes >>= 1
+            self.nodes[nodes, :2] = np.minimum(self.nodes[2 * nodes, :2], self.nodes[2 * nodes + 1, :2]) + self.nodes[nodes, 2:]
+
+    def min_value(self):
+        """Minimum of all values."""
+
+        return self.nodes[1, 0]
+
+    def max_value(self):
+        """Maximum of all values."""
+
+        return -self.nodes[1, 1]
+
+
+class TransferSupport(object):
+    """Calculate transfer bootstrap expectation (TBE) support values.
+
+    The transfer distance between a bipartition A|B of the input tree
+    and a replicate tree is the smallest number of taxa that must be
+    moved to turn A|B into a bipartition of the replicate. The TBE of
+    a bipartition is one minus its average transfer distance over all
+    replicates, normalized by one less than the size of its smaller
+    side [Lemoine et al., Nature, 2018].
+
+    Transfer distances are computed without comparing all pairs of
+    bipartitions. The taxa of each clade of the input tree are added
+    to a set in small-to-large order, so each taxon is added
+    O(log n) times in total. Adding a taxon changes the overlap of
+    the set with every clade on the path from the taxon to the root
+    of the replicate tree. This path is split into O(log n) ranges
+    using a heavy-path decomposition of the replicate tree and the
+    ranges are updated in a lazy segment tree, which allows the
+    transfer distance of each clade to be read off from the minimum
+    and maximum stored at its root.
+    """
+
+    def __init__(self, cpus=1):
+        """Initialization.
+
+        Parameters
+        ----------
+        cpus : int
+            Number of cpus to use.
+        """
+
+        self.logger = logging.getLogger('timestamp')
+
+        self.cpus = cpus
+
+    def _read_input_tree(self, input_tree):
+        """Read input tree and determine order for adding taxa of its clades.
+
+        Taxa are ordered so the taxa of every clade are contiguous and
+        the largest child of every node is placed last. The taxa of a
+        node not already in the set after processing its largest child
+        are then those immediately preceding the taxa of this child.
+        """
+
+        tree = dendropy.Tree.get_from_path(input_tree,
+                                            schema='newick',
+                                            rooting='force-unrooted',
+                                            preserve_underscores=True)
+        tree.collapse_basal_bifurcation()
+
+        size = {}
+        heavy = {}
+        for node in tree.postorder_node_iter():
+            if node.is_leaf():
+                size[node] = 1
+            else:
+                children = node.child_nodes()
+                size[node] = sum(size[child] for child in children)
+                heavy[node] = max(children, key=lambda child: size[child])
+
+        start = {tree.seed_node: 0}
+        taxa = [None] * size[tree.seed_node]
+        for node in tree.preorder_node_iter():
+            if node.is_leaf():
+                taxa[start[node]] = node.taxon.label
+                continue
+
+            offset = start[node]
+            light = [child for child in node.child_node_iter() if child != heavy[node]]
+            for child in light + [heavy[node]]:
+                start[child] = offset
+                offset += size[child]
+
+        # schedule for adding and removing ranges of taxa, with each
+        # internal node answered once the taxa of its clade are added
+        schedule = []
+        stack = [(tree.seed_node, True, False)]
+        while stack:
+            node, keep, expanded = stack.pop()
+            h = heavy[node]
+            if expanded:
+                end = start[h] if not h.is_leaf() else start[node] + size[node]
+                schedule.append((start[node], end, -2, node))
+                if not keep:
+                    schedule.append((start[node], start[node] + size[node], 2, None))
+                continue
+
+            stack.append((node, keep, True))
+            if not h.is_leaf():
+                stack.append((h, True, False))
+            for child in node.child_node_iter():
+                if child != h and not child.is_leaf():
+                    stack.append((child, False, False))
+
+        return tree, taxa, size, schedule
+
+    def _path_ranges(self, tree):
+        """Decompose path from each taxon to root of replicate tree into ranges.
+
+        Parameters
+        ----------
+        tree : NewickTree
+            Replicate tree.
+
+        Returns
+        -------
+        list
+            Size of clade at each position.
+        np.array
+            Start of each range.
+        np.array
+            End of each range.
+        np.array
+            Index of first range of each taxon in order of the input tree.
+        """
+
+        parents = tree.parents
+        num_clades = len(parents)
+
+        # clades are in postorder so children always precede their parent
+        size = [0] * num_clades
+        heavy = [-1] * num_clades
+        for leaf in tree.leaves:
+            size[leaf] = 1
+        for v in xrange(num_clades):
+            p = parents[v]
+            if p != -1:
+                size[p] += size[v]
+                if heavy[p] == -1 or size[v] > size[heavy[p]]:
+                    heavy[p] = v
+
+        # place clades along each heavy path at consecutive positions
+        pos = [0] * num_clades
+        head = [0] * num_clades
+        next_pos = 0
+        for v in xrange(num_clades - 1, -1, -1):
+            if parents[v] != -1 and heavy[parents[v]] == v:
+                continue
+
+            u = v
+            while u != -1:
+                pos[u] = next_pos
+                head[u] = v
+                next_pos += 1
+                u = heavy[u]
+
+        leaf_clade = dict(zip(tree.taxa, tree.leaves))
+        range_start = []
+        range_end = []
+        first_range = [0]
+        for taxon in self.taxa:
+            v = leaf_clade[taxon]
+            while v != -1:
+                h = head[v]
+                range_start.append(pos[h])
+                range_end.append(pos[v] + 1)
+                v = parents[h]
+            first_range.append(len(range_start))
+
+        size_at_pos = [0] * num_clades
+        for v in xrange(num_clades):
+            size_at_pos[pos[v]] = size[v]
+
+        return (size_at_pos,
+                np.array(range_start, dtype=np.int64),
+                np.array(range_end, dtype=np.int64),
+                np.array(first_range, dtype=np.int64))
+
+    def _transfer_distances(self, tree):
+        """Calculate transfer distance of each bipartition to a replicate tree.
+
+        For a set of taxa A and clade C of the replicate tree, the
+        Hamming distance between the bipartitions A|~A and C|~C is
+        min(|A| + |C| - 2|A & C|, n - |A| - |C| + 2|A & C|). The value
+        |C| - 2|A & C| is tracked for all clades, including single taxa,
+        so the transfer distance of A is given by the minimum and
+        maximum of this value over the replicate tree.
+
+        Parameters
+        ----------
+        tree : NewickTree
+            Replicate tree.
+
+        Returns
+        -------
+        np.array
+            Transfer distance of bipartition of each node in schedule.
+        """
+
+        n = len(self.taxa)
+
+        size_at_pos, range_start, range_end, first_range = self._path_ranges(tree)
+
+        # positions beyond the last clade act as a taxon outside of A,
+        # which never changes the minimum or maximum since A never
+        # spans more than n - 2 taxa when a distance is required
+        segment_tree = SegmentTree(size_at_pos, 1)
+
+        distances = np.zeros(len(self.schedule))
+        set_size = 0
+        for op_index, (a, b, change, answer) in enumerate(self.schedule):
+            if a < b:
+                segment_tree.add(range_start[first_range[a]:first_range[b]],
+                                    range_end[first_range[a]:first_range[b]],
+                                    change)
+                set_size += (b - a) if change < 0 else -(b - a)
+
+            if answer is not None and 2 <= set_size <= n - 2:
+                distances[op_index] = min(set_size + segment_tree.min_value(),
+                                            n - set_size - segment_tree.max_value())
+
+        return distances
+
+    def _producer(self, replicate_tree_file):
+        """Calculate transfer distances to trees in a replicate file."""
+
+        distances = np.zeros(len(self.schedule))
+        num_trees = 0
+        for tree in self.hasher.parse_newick(replicate_tree_file):
+            self.hasher.check_taxa(replicate_tree_file, tree.taxa, tree.taxa_hash)
+            distances += self._transfer_distances(tree)
+            num_trees += 1
+
+        return (distances, num_trees)
+
+    def _consumer(self, produced_data, consumer_data):
+        """Sum transfer distances over all replicates."""
+
+        if consumer_data is None:
+            consumer_data = [np.zeros(len(self.schedule)), 0]
+
+        distances, num_trees = produced_data
+        consumer_data[0] += distances
+        consumer_data[1] += num_trees
+
+        return consumer_data
+
+    def _progress(self, processed_items, total_items):
+        """Report progress of consumer processes."""
+
+        return '    Processed %d of %d replicate tree files.' % (processed_items, total_items)
+
+    def run(self, input_tree, replicate_trees, output_tree):
+        """Calculate TBE support for tree with replicates covering the same taxon set.
+
+        Parameters
+        ----------
+        input_tree : str
+          Tree inferred from complete data.
+        replicate_trees : iterable
+          Files containing replicate trees.
+        output_tree: str
+          Name of output tree with support values.
+        """
+
+        tree, self.taxa, size, self.schedule = self._read_input_tree(input_tree)
+        self.hasher = BipartitionHasher(self.taxa)
+
+        replicate_trees = list(replicate_trees)
+        parallel = Parallel(self.cpus)
+        consumer_data = parallel.run(self._producer, self._consumer, replicate_trees, self._progress)
+        if not consumer_data or consumer_data[1] == 0:
+            raise GenomeTreeTkError('No replicate trees were provided.')
+
+        distances, num_trees = consumer_data
+
+        n = len(self.taxa)
+        support = {}
+        for op_index, (a, b, _change, node) in enumerate(self.schedule):
+            if node is None:
+                continue
+
+            # trivial bipartitions are found in every replicate
+            p = min(size[node], n - size[node])
+            tbe = 1.0
+            if p >= 2:
+                tbe = 1.0 - distances[op_index] / num_trees / (p - 1)
+            support[node] = int(tbe * 100)
+
+        for node in tree.internal_nodes():
+            if node.label:
+                _support, taxon, aux_info = parse_label(node.label)
+                node.label = create_label(support[node], taxon, aux_info)
+            else:
+                node.label = str(support[node])
+
+        tree.write_to_path(output_tree,
+                            schema='newick',
+                            suppress_rooting=True,
+                            unquoted_underscores=True)
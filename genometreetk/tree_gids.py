@@ -53,7 +53,7 @@ class TreeGIDs(object):
         fout.write('\tGTDB taxonomy\tNCBI taxonomy\n')
         num_diff_specific = 0
         for rid, sp in species.items():
-            prev_gtdb_sp = prev_gtdb_taxonomy[rid][6]
+            prev_gtdb_sp = prev_gtdb_taxonomy.species(rid)
             if prev_gtdb_sp == 's__':
                 continue
                 
@@ -87,7 +87,7 @@ class TreeGIDs(object):
         fout.write('\tGTDB taxonomy\tNCBI taxonomy\n')
         num_diff_genus = 0
         for rid, sp in species.items():
-            prev_gtdb_sp = prev_gtdb_taxonomy[rid][6]
+            prev_gtdb_sp = prev_gtdb_taxonomy.species(rid)
             if prev_gtdb_sp == 's__':
                 continue
                 
@@ -179,7 +179,7 @@ class TreeGIDs(object):
         fout_ar_can.write('#Accession\tSpecies\tNote\n')
    
         for rid in sp_clusters:
-            domain = prev_gtdb_taxonomy[rid][0]
+            domain = prev_gtdb_taxonomy.rank(rid, 0)
             if domain == 'd__Bacteria':
                 fout_val = fout_bac_val
                 fout_can = fout_bac_can
@@ -198,7 +198,7 @@ class TreeGIDs(object):
             # substitute proposed species name into GTDB taxonomy
             sp = species[rid]
             canonical_sp = parse_canonical_sp(sp)
-            taxa = prev_gtdb_taxonomy[rid][0:6] + [canonical_sp]
+            taxa = prev_gtdb_taxonomy[rid][0:6] + (canonical_sp,)
             new_gtdb_str = '; '.join(taxa)
             fout_can_gtdb.write('%s\t%s\n' % (rid, new_gtdb_str))
             fout_val_gtdb.write('%s\t%s\n' % (rid, new_gtdb_str))
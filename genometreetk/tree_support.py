@@ -15,12 +15,15 @@
 #                                                                             #
 ###############################################################################
 
+import sys
 import logging
 
 from math import floor
 
 import dendropy
 
+from genometreetk.bipartitions import BipartitionHasher
+
 
 class TreeSupport():
     """Calculate support values for clades."""
@@ -32,6 +35,11 @@ class TreeSupport():
     def subset_taxa(self, input_tree, replicate_trees, output_tree):
         """Calculate support for tree with replicates containing a subset of taxa.
 
+        The taxa below each node of the input tree are represented
+        by a hashed bitset, which is restricted to the taxa within
+        each replicate in a single postorder pass. Bipartitions of
+        a replicate are then looked up directly.
+
         Parameters
         ----------
         input_tree : str
@@ -43,37 +51,65 @@ class TreeSupport():
         """
 
         tree = dendropy.Tree.get_from_path(input_tree, schema='newick', rooting='force-unrooted', preserve_underscores=True)
-        for node in tree.internal_nodes():
-            node.label = 0
-            node.nontrivial_splits = 0
-
-        for rep_tree_file in replicate_trees:
-            print rep_tree_file
-            rep_tree = dendropy.Tree.get_from_path(rep_tree_file, schema='newick', rooting='force-unrooted', preserve_underscores=True)
-
-            rep_tree_list = dendropy.TreeList([rep_tree])
-
-            rep_tree_taxa_set = set([x.taxon.label for x in rep_tree.leaf_nodes()])
-
-            for i, node in enumerate(tree.internal_nodes()):
-                print i
-                taxa_labels = set([x.taxon.label for x in node.leaf_nodes()]).intersection(rep_tree_taxa_set)
-
-                split = rep_tree.taxon_namespace.taxa_bitmask(labels=taxa_labels)
-                normalized_split = dendropy.Bipartition.normalize_bitmask(
-                                    bitmask=split,
-                                    fill_bitmask=rep_tree.taxon_namespace.all_taxa_bitmask(),
-                                    lowest_relevant_bit=1)
-
-                if len(taxa_labels) > 1:
-                    # tabulate results for non-trivial splits
-                    node.label += int(rep_tree_list.frequency_of_bipartition(split_bitmask=normalized_split))
-                    node.nontrivial_splits += 1
 
-        for node in tree.internal_nodes():
-            if node.nontrivial_splits > 0:
-                node.label = str(int(floor(node.label * 100.0 / node.nontrivial_splits)))
+        hasher = BipartitionHasher(leaf.taxon.label for leaf in tree.leaf_node_iter())
+
+        # children of each node given as indices into postorder traversal
+        nodes = list(tree.postorder_node_iter())
+        node_index = dict((node, i) for i, node in enumerate(nodes))
+        children = []
+        leaf_taxa = {}
+        for i, node in enumerate(nodes):
+            children.append([node_index[child] for child in node.child_node_iter()])
+            if node.is_leaf():
+                leaf_taxa[i] = node.taxon.label
+        internal = [i for i, node in enumerate(nodes) if not node.is_leaf()]
+
+        support = [0] * len(nodes)
+        nontrivial_splits = [0] * len(nodes)
+
+        replicate_trees = list(replicate_trees)
+        for rep_index, rep_tree_file in enumerate(replicate_trees):
+            for bipartitions, rep_taxa in hasher.newick_bipartitions(rep_tree_file, subset=True):
+                rep_taxa = set(rep_taxa)
+
+                # hash and number of replicate taxa below each node
+                clade_hash = [0] * len(nodes)
+                clade_size = [0] * len(nodes)
+                taxa_hash = 0
+                for i in xrange(len(nodes)):
+                    if i in leaf_taxa:
+                        if leaf_taxa[i] in rep_taxa:
+                            clade_hash[i] = hasher.taxon_hash[leaf_taxa[i]]
+                            clade_size[i] = 1
+                            taxa_hash ^= clade_hash[i]
+                    else:
+                        h = 0
+                        size = 0
+                        for child in children[i]:
+                            h ^= clade_hash[child]
+                            size += clade_size[child]
+                        clade_hash[i] = h
+                        clade_size[i] = size
+
+                for i in internal:
+                    if clade_size[i] > 1:
+                        # tabulate results for non-trivial splits
+                        if hasher.key(clade_hash[i], taxa_hash) in bipartitions:
+                            support[i] += 1
+                        nontrivial_splits[i] += 1
+
+            statusStr = '    Processed %d of %d replicate trees.' % (rep_index + 1, len(replicate_trees))
+            sys.stdout.write('%s\r' % statusStr)
+            sys.stdout.flush()
+
+        if replicate_trees:
+            sys.stdout.write('\n')
+
+        for i in internal:
+            if nontrivial_splits[i] > 0:
+                nodes[i].label = str(int(floor(support[i] * 100.0 / nontrivial_splits[i])))
             else:
-                node.label = 'NA'
+                nodes[i].label = 'NA'
 
         tree.write_to_path(output_tree, schema='newick', suppress_rooting=True, unquoted_underscores=True)
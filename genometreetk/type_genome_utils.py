@@ -19,11 +19,15 @@ import os
 import csv
 import sys
 import ntpath
+import logging
 from collections import defaultdict, namedtuple
 
 from numpy import (mean as np_mean)
 
-from genometreetk.common import read_gtdb_metadata
+from genometreetk.common import (read_gtdb_metadata,
+                                    file_signature,
+                                    load_signed_cache,
+                                    save_signed_cache)
 
 
 NCBI_TYPE_SPECIES = set(['assembly from type material', 
@@ -36,6 +40,8 @@ GTDB_TYPE_SPECIES = set(['type strain of species', 'type strain of neotype'])
 GTDB_TYPE_SUBSPECIES = set(['type strain of subspecies', 'type strain of heterotypic synonym'])
 GTDB_NOT_TYPE_MATERIAL = set(['not type material'])
 
+EXCLUDE_FROM_REFSEQ_CACHE_EXT = '.excluded_from_refseq.pkl'
+
 
 def parse_canonical_sp(sp):
     """Get canonical binomial species name."""
@@ -224,21 +230,60 @@ def gtdb_type_strain_of_species(type_metadata):
     return type_gids
             
     
+def _parse_excluded_from_refseq(assembly_file):
+    """Parse exclude from RefSeq field from a single NCBI assembly file."""
+    
+    excluded_from_refseq_note = {}
+    for line in open(assembly_file):
+        if line[0] == '#':
+            if line.startswith('# assembly_accession'):
+                header = line.strip().split('\t')
+                exclude_index = header.index('excluded_from_refseq')
+        else:
+            line_split = line.strip('\n\r').split('\t')
+            gid = line_split[0]
+            gid = gid.replace('GCA_','GB_GCA_').replace('GCF_', 'RS_GCF_')
+            
+            # notes are drawn from a small vocabulary so interning them
+            # keeps both the in-memory dictionary and the cache compact
+            excluded_from_refseq_note[gid] = intern(line_split[exclude_index])
+            
+    return excluded_from_refseq_note
+    
+    
+def _excluded_from_refseq_cached(assembly_file):
+    """Get exclude from RefSeq field for NCBI assembly file using a cached index where possible.
+    
+    The parsed assembly file is stored alongside the original file and is
+    considered valid as long as the size and modification time of the
+    assembly file are unchanged.
+    """
+    
+    logger = logging.getLogger('timestamp')
+    
+    cache_file = assembly_file + EXCLUDE_FROM_REFSEQ_CACHE_EXT
+    signature = file_signature(assembly_file)
+    
+    excluded_from_refseq_note = load_signed_cache(cache_file, signature)
+    if excluded_from_refseq_note is not None:
+        return excluded_from_refseq_note
+        
+    if os.path.exists(cache_file):
+        logger.info('Cached index for %s is out of date.' % assembly_file)
+        
+    excluded_from_refseq_note = _parse_excluded_from_refseq(assembly_file)
+    if not save_signed_cache(cache_file, signature, excluded_from_refseq_note):
+        logger.warning('Unable to write cached index for %s.' % assembly_file)
+        
+    return excluded_from_refseq_note
+    
+    
 def exclude_from_refseq(refseq_assembly_file, genbank_assembly_file):
     """Parse exclude from RefSeq field from NCBI assembly files."""
     
     excluded_from_refseq_note = {}
     for assembly_file in [refseq_assembly_file, genbank_assembly_file]:
-            for line in open(assembly_file):
-                if line[0] == '#':
-                    if line.startswith('# assembly_accession'):
-                        header = line.strip().split('\t')
-                        exclude_index = header.index('excluded_from_refseq')
-                else:
-                    line_split = line.strip('\n\r').split('\t')
-                    gid = line_split[0]
-                    gid = gid.replace('GCA_','GB_GCA_').replace('GCF_', 'RS_GCF_')
-                    excluded_from_refseq_note[gid] = line_split[exclude_index]
+        excluded_from_refseq_note.update(_excluded_from_refseq_cached(assembly_file))
     
     return excluded_from_refseq_note
     
@@ -0,0 +1,118 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from genometreetk.exceptions import GenomeTreeTkError
+from genometreetk.fasttree_scheduler import FastTreeScheduler
+
+
+# stand-in for FastTree which reads the full alignment from stdin
+# before writing a tree, and so waits for as long as stdin is open
+FAST_TREE_STUB = """#!/bin/sh
+cat > /dev/null
+echo "(a,b,c);"
+"""
+
+
+class TestFastTreeScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+        bin_dir = os.path.join(self.output_dir, 'bin')
+        os.mkdir(bin_dir)
+        fast_tree = os.path.join(bin_dir, 'FastTree')
+        with open(fast_tree, 'w') as fout:
+            fout.write(FAST_TREE_STUB)
+        os.chmod(fast_tree, 0o755)
+
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+
+        # fail rather than hang if FastTree is left waiting on stdin
+        signal.alarm(30)
+
+    def tearDown(self):
+        signal.alarm(0)
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.output_dir)
+
+    def _job(self, name, write_msa, msa_file=None):
+        """Create job writing alignment with the given function."""
+
+        return FastTreeScheduler.Job(cost=1,
+                                        msa_file=msa_file,
+                                        output_tree=os.path.join(self.output_dir, name + '.tree'),
+                                        output_tree_log=os.path.join(self.output_dir, name + '.log'),
+                                        write_msa=write_msa,
+                                        done=lambda: self.completed.append(name))
+
+    def _run(self, jobs):
+        """Run jobs, returning error raised by scheduler."""
+
+        self.completed = []
+        scheduler = FastTreeScheduler(1)
+        scheduler.multithreaded = False
+        scheduler.poll_interval = 0.01
+        try:
+            scheduler.run(jobs, 'prot', 'wag')
+        except GenomeTreeTkError as e:
+            return e
+
+        return None
+
+    def test_streamed_alignment(self):
+        def write_msa(fout):
+            fout.write('>a\nMK\n>b\nMK\n>c\nMK\n')
+
+        msa_file = os.path.join(self.output_dir, 'ok.faa')
+        error = self._run([self._job('ok', write_msa, msa_file)])
+
+        self.assertIsNone(error)
+        self.assertEqual(self.completed, ['ok'])
+        with open(msa_file) as f:
+            self.assertEqual(f.read(), '>a\nMK\n>b\nMK\n>c\nMK\n')
+
+    def test_failed_writer(self):
+        def write_msa(fout):
+            fout.write('>a\nMK\n')
+            raise ValueError('invalid alignment')
+
+        def write_complete_msa(fout):
+            fout.write('>a\nMK\n>b\nMK\n>c\nMK\n')
+
+        # alignment copy can not be written to a missing directory
+        missing_msa_file = os.path.join(self.output_dir, 'missing', 'copy.faa')
+
+        error = self._run([self._job('raises', write_msa),
+                            self._job('no_copy', write_complete_msa, missing_msa_file),
+                            self._job('ok', write_complete_msa)])
+
+        self.assertIsNotNone(error)
+        self.assertIn(os.path.join(self.output_dir, 'raises.log'), str(error))
+        self.assertIn(os.path.join(self.output_dir, 'no_copy.log'), str(error))
+        self.assertNotIn(os.path.join(self.output_dir, 'ok.log'), str(error))
+        self.assertEqual(self.completed, ['ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import dendropy
+
+import numpy as np
+
+from genometreetk.transfer_support import SegmentTree, TransferSupport
+
+
+def random_tree(taxa, rng, multifurcating):
+    """Generate random unrooted tree in Newick format."""
+
+    nodes = ['%s:0.1' % taxon for taxon in taxa]
+    while len(nodes) > 3:
+        num_children = 2
+        if multifurcating and len(nodes) > 4 and rng.random() < 0.3:
+            num_children = 3
+
+        children = [nodes.pop(rng.randrange(len(nodes))) for _ in xrange(num_children)]
+        label = '%d' % rng.randrange(100) if rng.random() < 0.5 else ''
+        nodes.append('(%s)%s:0.1' % (','.join(children), label))
+
+    return '(%s);\n' % ','.join(nodes)
+
+
+def read_tree(tree_file):
+    """Read unrooted tree as done when calculating support."""
+
+    tree = dendropy.Tree.get_from_path(tree_file,
+                                        schema='newick',
+                                        rooting='force-unrooted',
+                                        preserve_underscores=True)
+    tree.collapse_basal_bifurcation()
+
+    return tree
+
+
+def clades(tree):
+    """Get taxa of each clade in tree."""
+
+    return [frozenset(leaf.taxon.label for leaf in node.leaf_iter())
+            for node in tree.preorder_node_iter()]
+
+
+def brute_force_support(input_tree, replicate_trees, taxa):
+    """Calculate TBE support by comparing all pairs of bipartitions."""
+
+    n = len(taxa)
+    replicate_clades = []
+    for tree_file in replicate_trees:
+        for tree in dendropy.TreeList.get_from_path(tree_file,
+                                                    schema='newick',
+                                                    rooting='force-unrooted',
+                                                    preserve_underscores=True):
+            replicate_clades.append(clades(tree) + [frozenset([taxon]) for taxon in taxa])
+
+    support = []
+    for node in read_tree(input_tree).preorder_internal_node_iter():
+        clade = frozenset(leaf.taxon.label for leaf in node.leaf_iter())
+        p = min(len(clade), n - len(clade))
+        if p < 2:
+            support.append(100)
+            continue
+
+        total_distance = 0
+        for rep_clades in replicate_clades:
+            total_distance += min(min(len(clade ^ c), n - len(clade ^ c)) for c in rep_clades)
+        support.append(int((1.0 - float(total_distance) / len(replicate_clades) / (p - 1)) * 100))
+
+    return support
+
+
+class TestSegmentTree(unittest.TestCase):
+
+    def test_random_additions(self):
+        rng = np.random.RandomState(1)
+        for num_values in [1, 2, 5, 16, 37]:
+            values = rng.randint(-5, 5, num_values)
+            segment_tree = SegmentTree(values, 0)
+            for _ in xrange(50):
+                starts = rng.randint(0, num_values, 4)
+                ends = starts + 1 + rng.randint(0, num_values, 4) % (num_values - starts)
+                value = rng.randint(-3, 4)
+                segment_tree.add(starts, ends, value)
+                for start, end in zip(starts, ends):
+                    values[start:end] += value
+
+                # leaves beyond the values hold the padding
+                padded_values = values
+                if num_values & (num_values - 1):
+                    padded_values = np.append(values, 0)
+                self.assertEqual(segment_tree.min_value(), padded_values.min())
+                self.assertEqual(segment_tree.max_value(), padded_values.max())
+
+
+class TestTransferSupport(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_matches_brute_force(self):
+        for trial in xrange(40):
+            rng = random.Random(trial)
+            taxa = ['t_%d' % i for i in xrange(rng.randrange(4, 30))]
+
+            input_tree = os.path.join(self.output_dir, 'input.tree')
+            with open(input_tree, 'w') as fout:
+                fout.write(random_tree(taxa, rng, trial % 3 == 0))
+
+            replicate_trees = []
+            for rep_index in xrange(rng.randrange(1, 4)):
+                tree_file = os.path.join(self.output_dir, 'replicate.%d.tree' % rep_index)
+                with open(tree_file, 'w') as fout:
+                    for tree_index in xrange(rng.randrange(1, 3)):
+                        fout.write(random_tree(taxa, rng, (rep_index + tree_index) % 2 == 0))
+                replicate_trees.append(tree_file)
+
+            output_tree = os.path.join(self.output_dir, 'output.tree')
+            TransferSupport(1).run(input_tree, replicate_trees, output_tree)
+
+            support = [int(node.label.split(':')[0])
+                        for node in read_tree(output_tree).preorder_internal_node_iter()]
+            self.assertEqual(support, brute_force_support(input_tree, replicate_trees, taxa))
+
+
+if __name__ == '__main__':
+    unittest.main()